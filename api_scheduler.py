@@ -0,0 +1,234 @@
+import os
+import asyncio
+import bisect
+import itertools
+import logging
+import time
+
+from telegram.error import RetryAfter
+
+from metrics import registry
+from ttl_cache import TTLCache
+
+API_GLOBAL_RATE = float(os.getenv('API_GLOBAL_RATE', '30'))  # 全局每秒请求数
+API_GLOBAL_BURST = int(os.getenv('API_GLOBAL_BURST', '30'))
+API_CHAT_RATE = float(os.getenv('API_CHAT_RATE', '1'))  # 单个聊天每秒请求数
+API_CHAT_BURST = int(os.getenv('API_CHAT_BURST', '3'))
+API_CONCURRENCY = int(os.getenv('API_CONCURRENCY', '8'))  # 与 HTTPXRequest 连接池大小一致
+API_UPLOAD_CONCURRENCY = max(1, API_CONCURRENCY - 2)  # 为普通请求保留连接，上传不会占满连接池
+API_MAX_RETRIES = 3  # 收到 RetryAfter 后重新排队的次数，上传请求不重新排队，见 _execute
+
+# 优先级，数值越小越先发出
+PRIORITY_HIGH = 0  # 上传和最终结果
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2  # 进度等中间状态
+PRIORITY_NAMES = {PRIORITY_HIGH: 'high', PRIORITY_NORMAL: 'normal', PRIORITY_LOW: 'low'}
+
+API_LATENCY = registry.histogram(
+    'dumper_telegram_api_seconds', 'Telegram Bot API call latency, excluding queueing', ['method'],
+)
+API_QUEUE_WAIT = registry.histogram(
+    'dumper_telegram_api_queue_wait_seconds', 'Time Bot API calls wait for rate limits and priority', ['priority'],
+)
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """距离有一个可用令牌还需要等待的秒数。"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _Request:
+    __slots__ = (
+        'priority', 'seq', 'chat_id', 'upload', 'func', 'args', 'kwargs', 'future', 'attempts', 'queued_at',
+    )
+
+    def __init__(self, priority, seq, chat_id, upload, func, args, kwargs, future):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.upload = upload
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts = 0
+        self.queued_at = time.monotonic()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+def retry_seconds(error):
+    """RetryAfter 要求等待的秒数，兼容 int 和 timedelta 两种形式。"""
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+
+
+class ApiScheduler:
+    """所有 Bot API 请求的统一出口。
+
+    用令牌桶同时限制全局和每个聊天的请求速率，按优先级发出请求；
+    某个聊天受限时只跳过它的请求，不会阻塞其他聊天。RetryAfter 在这里统一处理：
+    暂停对应聊天（没有聊天时暂停全部请求）后重新排队。上传的文件流只能读取一次，
+    上传请求的 RetryAfter 在暂停后直接交给调用方，由 upload_pool 重新打开文件后重试。
+    """
+
+    def __init__(self, global_rate=API_GLOBAL_RATE, global_burst=API_GLOBAL_BURST,
+                 chat_rate=API_CHAT_RATE, chat_burst=API_CHAT_BURST,
+                 concurrency=API_CONCURRENCY, upload_concurrency=API_UPLOAD_CONCURRENCY):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global_rate = global_rate
+        self._global_burst = global_burst
+        self._global = None
+        self._chats = TTLCache(maxsize=10000, ttl=600)  # chat_id -> TokenBucket
+        self._paused = {}  # chat_id（None 表示全局）-> 暂停到的时间
+        self._pending = []  # 按 (优先级, 序号) 排序
+        self._seq = itertools.count()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._upload_slots = asyncio.Semaphore(upload_concurrency)
+        self._wakeup = None
+        self._dispatcher = None
+        self._tasks = set()  # 执行中的请求，事件循环只保留任务的弱引用
+        self.calls = 0
+        self.retry_after = 0
+
+    @property
+    def queued(self):
+        return len(self._pending)
+
+    async def call(self, func, *args, chat=None, priority=PRIORITY_NORMAL, upload=False, **kwargs):
+        """
+        排队执行 func(*args, **kwargs) 并返回其结果。
+
+        Args:
+            chat: 按哪个聊天限速，省略时取 kwargs 中的 chat_id；都没有时只受全局限速。
+            priority: PRIORITY_HIGH / PRIORITY_NORMAL / PRIORITY_LOW。
+            upload: 上传文件的请求，占用单独的上传并发额度。
+        """
+        if chat is None:
+            chat = kwargs.get('chat_id')
+        loop = asyncio.get_running_loop()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._global = TokenBucket(self._global_rate, self._global_burst, loop.time())
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        request = _Request(priority, next(self._seq), chat, upload, func, args, kwargs, loop.create_future())
+        self._enqueue(request)
+        return await request.future
+
+    def _enqueue(self, request):
+        bisect.insort(self._pending, request)
+        self._wakeup.set()
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst, now)
+            self._chats.set(chat_id, bucket)
+        return bucket
+
+    def _pause_remaining(self, chat_id, now):
+        """剩余暂停时间，已到期的暂停记录在这里删除。"""
+        until = self._paused.get(chat_id)
+        if until is None:
+            return 0
+        if until <= now:
+            del self._paused[chat_id]
+            return 0
+        return until - now
+
+    def _chat_delay(self, chat_id, now):
+        paused = self._pause_remaining(chat_id, now)
+        if chat_id is None:
+            return paused
+        return max(paused, self._chat_bucket(chat_id, now).delay(now))
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = loop.time()
+            global_delay = max(self._pause_remaining(None, now), self._global.delay(now))
+            chosen = None
+            wait = None
+            if global_delay <= 0:
+                for request in self._pending:
+                    delay = self._chat_delay(request.chat_id, now)
+                    if delay <= 0:
+                        chosen = request
+                        break
+                    wait = delay if wait is None else min(wait, delay)
+            else:
+                wait = global_delay
+
+            if chosen is None:
+                # 等到有请求可以发出，或有新请求加入后重新选择
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._pending.remove(chosen)
+            self._global.take(now)
+            if chosen.chat_id is not None:
+                self._chat_bucket(chosen.chat_id, now).take(now)
+            task = asyncio.create_task(self._execute(chosen))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, request):
+        API_QUEUE_WAIT.observe(time.monotonic() - request.queued_at, priority=PRIORITY_NAMES[request.priority])
+        method = getattr(request.func, '__name__', 'unknown')
+        try:
+            if request.upload:
+                async with self._upload_slots, self._slots:
+                    with API_LATENCY.time(method=method):
+                        result = await request.func(*request.args, **request.kwargs)
+            else:
+                async with self._slots:
+                    with API_LATENCY.time(method=method):
+                        result = await request.func(*request.args, **request.kwargs)
+        except RetryAfter as e:
+            self.retry_after += 1
+            seconds = retry_seconds(e)
+            loop = asyncio.get_running_loop()
+            self._paused[request.chat_id] = max(self._paused.get(request.chat_id, 0), loop.time() + seconds)
+            logging.warning(f"RetryAfter {seconds}s for chat {request.chat_id}, attempt {request.attempts + 1}")
+            if not request.upload and request.attempts < API_MAX_RETRIES:
+                request.attempts += 1
+                request.queued_at = time.monotonic()
+                self._enqueue(request)
+            elif not request.future.done():
+                request.future.set_exception(e)
+        except BaseException as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+        else:
+            self.calls += 1
+            if not request.future.done():
+                request.future.set_result(result)
@@ -0,0 +1,232 @@
+import os
+import re
+import sys
+import time
+import shutil
+import sqlite3
+import tempfile
+
+from storage import DB_PATH, SCHEMA, sync_connection
+
+ARTIFACT_DIR = "output"
+ARTIFACT_CACHE_BYTES = int(os.getenv('ARTIFACT_CACHE_BYTES', str(10 * 1024 ** 3)))  # output/ 的磁盘预算
+ARTIFACT_EVICTION = os.getenv('ARTIFACT_EVICTION', 'lru')  # lru：最久未访问优先；lfu：命中次数最少优先
+ARTIFACT_MIN_AGE = int(os.getenv('ARTIFACT_MIN_AGE', '600'))  # 最近访问过的文件可能正在上传，不淘汰（秒）
+# 不登记的文件：临时文件，以及分卷清单（只有几十字节，淘汰后所有分卷都无法找到）
+UNTRACKED_SUFFIXES = ('.tmp', '.parts')
+# 临时文件和临时目录名中带有创建者的进程号，进程被终止后可以识别为孤儿并清理
+TEMP_DIR_PREFIX = "dumper-"
+_TEMP_FILE_PID = re.compile(r'\.(\d+)\.tmp$')
+_TEMP_DIR_PID = re.compile(rf'^{TEMP_DIR_PREFIX}(\d+)-')
+
+_EVICTION_ORDER = {
+    'lru': 'a.last_access',
+    'lfu': 'a.hits, a.last_access',
+}
+
+
+def _touch(conn, path):
+    with conn:
+        conn.execute('UPDATE artifacts SET hits = hits + 1, last_access = ? WHERE path = ?', (time.time(), path))
+
+
+def _insert(conn, path, size, hits=0):
+    with conn:
+        conn.execute(
+            'INSERT OR REPLACE INTO artifacts (path, file_name, size, last_access, hits) VALUES (?, ?, ?, ?, ?)',
+            (path, os.path.basename(path), size, time.time(), hits),
+        )
+
+
+def has_file_id(path, conn=None):
+    """该文件是否已经上传过，可以直接用 Telegram file_id 发送。"""
+    row = (conn or sync_connection()).execute(
+        'SELECT 1 FROM file_cache WHERE file_name = ? AND file_id IS NOT NULL', (os.path.basename(path),)
+    ).fetchone()
+    return row is not None
+
+
+def lookup(path, remote_ok=False, conn=None):
+    """
+    检查产物是否可用并记录一次命中。
+
+    Args:
+        path: 产物路径。
+        remote_ok: 为 True 时，本地文件已被淘汰但仍有 file_id 的产物也算可用。
+        conn: 使用的数据库连接，默认为工作进程的同步连接。bot 通过 Storage.call 传入自己的连接。
+
+    Returns:
+        bool: 产物可用。
+    """
+    conn = conn or sync_connection()
+    tracked = conn.execute('SELECT 1 FROM artifacts WHERE path = ?', (path,)).fetchone() is not None
+    if os.path.exists(path):
+        if tracked:
+            _touch(conn, path)
+        else:
+            # 引入缓存管理之前生成的文件
+            _insert(conn, path, os.path.getsize(path), hits=1)
+        return True
+    if tracked:
+        with conn:
+            conn.execute('DELETE FROM artifacts WHERE path = ?', (path,))
+    return remote_ok and has_file_id(path, conn)
+
+
+def register(path):
+    """登记新生成的产物，并在超出预算时淘汰旧产物。"""
+    conn = sync_connection()
+    _insert(conn, path, os.path.getsize(path))
+    evict(conn, keep=path)
+
+
+def evict(conn=None, keep=None, budget=ARTIFACT_CACHE_BYTES):
+    """
+    淘汰产物直到总大小不超过预算。
+
+    已经有 file_id 的产物优先淘汰，之后仍可通过 file_id 发送；其余按 ARTIFACT_EVICTION 排序。
+
+    Returns:
+        int: 释放的字节数。
+    """
+    conn = conn or sync_connection()
+    total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM artifacts').fetchone()[0]
+    if total <= budget:
+        return 0
+    order = _EVICTION_ORDER.get(ARTIFACT_EVICTION, _EVICTION_ORDER['lru'])
+    candidates = conn.execute(
+        'SELECT a.path, a.size FROM artifacts a '
+        'LEFT JOIN file_cache f ON f.file_name = a.file_name AND f.file_id IS NOT NULL '
+        'WHERE a.last_access < ? '
+        f'ORDER BY f.file_id IS NULL, {order}',
+        (time.time() - ARTIFACT_MIN_AGE,),
+    ).fetchall()
+    freed = 0
+    evicted = []
+    for path, size in candidates:
+        if total - freed <= budget:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Failed to evict {path}: {e}", file=sys.stderr)
+            continue
+        evicted.append((path,))
+        freed += size
+    if evicted:
+        with conn:
+            conn.executemany('DELETE FROM artifacts WHERE path = ?', evicted)
+    return freed
+
+
+def temp_path(path):
+    """写入 path 时使用的临时文件，完成后用 os.replace 换成 path。"""
+    return f"{path}.{os.getpid()}.tmp"
+
+
+def make_tempdir():
+    """创建当前进程专用的临时目录。"""
+    return tempfile.mkdtemp(prefix=f"{TEMP_DIR_PREFIX}{os.getpid()}-")
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _tree_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(path)
+        for name in files
+    )
+
+
+def remove_orphans(directory=ARTIFACT_DIR):
+    """
+    删除已退出（超时被终止或崩溃）的进程留下的临时文件和临时目录。
+
+    不带进程号的 .tmp 文件来自旧版本，同样视为孤儿。
+
+    Returns:
+        int: 释放的字节数。
+    """
+    freed = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if not name.endswith('.tmp'):
+                continue
+            match = _TEMP_FILE_PID.search(name)
+            if match and _pid_alive(int(match.group(1))):
+                continue
+            path = os.path.join(root, name)
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                print(f"Failed to remove {path}: {e}", file=sys.stderr)
+                continue
+            freed += size
+    tempdir = tempfile.gettempdir()
+    for name in os.listdir(tempdir):
+        match = _TEMP_DIR_PID.match(name)
+        if not match or _pid_alive(int(match.group(1))):
+            continue
+        path = os.path.join(tempdir, name)
+        freed += _tree_size(path)
+        shutil.rmtree(path, ignore_errors=True)
+    return freed
+
+
+def reconcile(directory=ARTIFACT_DIR):
+    """
+    让 artifacts 表与磁盘一致：清理孤儿临时文件，登记未记录的文件，删除文件已不存在的记录，然后按预算淘汰。
+
+    Returns:
+        tuple: (登记的文件数, 删除的记录数, 释放的字节数)。
+    """
+    orphaned = remove_orphans(directory)
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        for statement in SCHEMA:
+            conn.execute(statement)
+        tracked = {path for path, in conn.execute('SELECT path FROM artifacts')}
+        found = set()
+        now = time.time()
+        rows = []
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if name.endswith(UNTRACKED_SUFFIXES):
+                    continue
+                path = os.path.join(root, name)
+                found.add(path)
+                if path not in tracked:
+                    stat = os.stat(path)
+                    rows.append((path, name, stat.st_size, min(stat.st_mtime, now), 0))
+        missing = [(path,) for path in tracked - found]
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO artifacts (path, file_name, size, last_access, hits) VALUES (?, ?, ?, ?, ?)',
+                rows,
+            )
+            conn.executemany('DELETE FROM artifacts WHERE path = ?', missing)
+        freed = orphaned + evict(conn)
+        return len(rows), len(missing), freed
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    added, removed, freed = reconcile()
+    print(f"registered={added} removed={removed} freed={freed}")
@@ -0,0 +1,430 @@
+"""/webhook 压力测试。
+
+在本进程中用 uvicorn 启动 bot，Bot API 指向本地模拟服务（benchmarks.mock_bot_api），
+ROM 链接指向本地 Range 服务器上的合成 OTA 包。虚拟用户按 --rate 到达，每个用户依次
+发送链接、翻页回调和分区点击，每次都等 bot 显示出分区键盘后再发出下一个操作。结束后
+报告 webhook 响应延迟 p50/p95/p99、事件循环延迟，以及每种用户操作引起的 Bot API 调用次数。
+
+    python -m benchmarks.load_webhook --users 200 --rate 20 --api-latency 0.05 --output load.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from collections import Counter
+
+import httpx
+
+from benchmarks.run import REPO_DIR, build_ota, _git_revision
+from benchmarks.synthetic_ota import parse_ops, parse_partitions
+
+TOKEN = '123456:benchmark'
+ROM_NAME = 'benchmark_rom_ota_full.zip'
+LAG_INTERVAL = 0.01  # 事件循环延迟的采样间隔（秒）
+KEYBOARD_POLL_INTERVAL = 0.05  # 轮询模拟服务调用记录的间隔（秒）
+
+
+def percentile(values, p):
+    """最近秩法百分位数，空列表返回 None。"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values) + 0.5) - 1))]
+
+
+def latency_summary(values):
+    """秒 -> 毫秒的 p50/p95/p99/max 汇总。"""
+    summary = {"count": len(values)}
+    for name, p in (("p50", 50), ("p95", 95), ("p99", 99), ("max", 100)):
+        value = percentile(values, p)
+        summary[f"{name}_ms"] = round(value * 1000, 2) if value is not None else None
+    return summary
+
+
+def start_service(argv, env=None):
+    """启动一个 benchmarks 子进程服务，从第一行输出中取出它的地址。"""
+    process = subprocess.Popen(
+        [sys.executable, '-m', *argv, '--port', '0'],
+        cwd=REPO_DIR, env=env, stdout=subprocess.PIPE, text=True,
+    )
+    line = process.stdout.readline()
+    match = re.search(r'(http://\S+)', line)
+    if not match:
+        process.kill()
+        raise RuntimeError(f"{argv[0]} failed to start: {line!r}")
+    return process, match.group(1)
+
+
+class UpdateFactory:
+    """生成与 Telegram 推送格式一致的更新。"""
+
+    def __init__(self):
+        self._update_ids = 0
+        self._callback_ids = 0
+
+    def _next_update_id(self):
+        self._update_ids += 1
+        return self._update_ids
+
+    @staticmethod
+    def _user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "language_code": "en"}
+
+    @staticmethod
+    def _chat(user_id):
+        return {"id": user_id, "type": "private", "first_name": f"user{user_id}"}
+
+    def message(self, user_id, text):
+        update_id = self._next_update_id()
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": self._chat(user_id),
+                "from": self._user(user_id),
+                "text": text,
+            },
+        }
+
+    def callback(self, user_id, data, message_id=1):
+        self._callback_ids += 1
+        return {
+            "update_id": self._next_update_id(),
+            "callback_query": {
+                # 模拟服务按此 ID 把 answerCallbackQuery 归到对应用户
+                "id": f"{user_id}-{self._callback_ids}",
+                "chat_instance": str(user_id),
+                "from": self._user(user_id),
+                "data": data,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": self._chat(user_id),
+                    "from": {"id": 123456, "is_bot": True, "first_name": "bot"},
+                    "text": "ROM",
+                },
+            },
+        }
+
+
+class LoopLagMonitor:
+    """定期 sleep，记录实际唤醒时间超出预期的部分。"""
+
+    def __init__(self, interval=LAG_INTERVAL):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+class LoadGenerator:
+    """
+    按到达率启动虚拟用户，记录每次 POST 的响应延迟和操作时间。
+
+    Args:
+        client: 指向 bot 的 httpx.AsyncClient。
+        api_client: 指向模拟 Bot API 根地址的 httpx.AsyncClient，用于查询调用记录。
+        rom_url: ROM 链接。
+        partitions: 用户可能点击的分区名。
+        think_time: 同一用户两次操作之间的平均间隔（秒），按指数分布随机。
+        seed: 随机种子。
+        keyboard_timeout: 等待 bot 显示键盘的最长时间（秒），超时后该用户不再继续操作。
+    """
+
+    def __init__(self, client, api_client, rom_url, partitions, think_time, seed, keyboard_timeout=60):
+        self.client = client
+        self.api_client = api_client
+        self.keyboard_timeout = keyboard_timeout
+        self.rom_url = rom_url
+        self.partitions = partitions
+        self.think_time = think_time
+        self.random = random.Random(seed)
+        self.factory = UpdateFactory()
+        self.latencies = {}  # 操作 -> [webhook 响应延迟]
+        self.actions = []  # (用户, 操作, 发出时间, 回调 ID)
+        self.errors = Counter()
+
+    async def post(self, user_id, action, payload):
+        started = time.time()
+        callback_id = payload.get("callback_query", {}).get("id")
+        self.actions.append((user_id, action, started, callback_id))
+        t0 = time.perf_counter()
+        try:
+            response = await self.client.post('/webhook', json=payload)
+            if response.status_code != 200:
+                self.errors[f"HTTP {response.status_code}"] += 1
+        except httpx.HTTPError as e:
+            self.errors[type(e).__name__] += 1
+            return
+        self.latencies.setdefault(action, []).append(time.perf_counter() - t0)
+
+    async def think(self):
+        if self.think_time:
+            await asyncio.sleep(self.random.expovariate(1 / self.think_time))
+
+    async def wait_keyboard(self, user_id, since):
+        """
+        等待 since 之后发给该用户、带分区键盘的 editMessageText。只有返回按钮的错误提示不算。
+
+        Returns:
+            键盘所在消息的 message_id，超时返回 None。
+        """
+        partitions = set(self.partitions)
+        deadline = time.monotonic() + self.keyboard_timeout
+        while time.monotonic() < deadline:
+            response = await self.api_client.get('/calls', params={"chat_id": user_id})
+            for call in reversed(response.json()):
+                if call["received"] < since:
+                    break
+                if call["method"] == "editMessageText" and set(call["callbacks"]) & partitions:
+                    return int(call["message_id"])
+            await asyncio.sleep(KEYBOARD_POLL_INTERVAL)
+        self.errors["keyboard timeout"] += 1
+        return None
+
+    async def user_session(self, user_id):
+        started = time.time()
+        await self.post(user_id, "url", self.factory.message(user_id, self.rom_url))
+        message_id = await self.wait_keyboard(user_id, started)
+        if message_id is None:
+            return
+        await self.think()
+        started = time.time()
+        await self.post(user_id, "page", self.factory.callback(user_id, "page 1", message_id))
+        message_id = await self.wait_keyboard(user_id, started)
+        if message_id is None:
+            return
+        await self.think()
+        await self.post(
+            user_id, "partition", self.factory.callback(user_id, self.random.choice(self.partitions), message_id),
+        )
+
+    async def run(self, users, rate, first_user_id=100000):
+        sessions = []
+        for i in range(users):
+            sessions.append(asyncio.create_task(self.user_session(first_user_id + i)))
+            if rate:
+                await asyncio.sleep(self.random.expovariate(rate))
+        await asyncio.gather(*sessions)
+
+
+def attribute_calls(calls, actions):
+    """
+    把每次 Bot API 调用归到同一用户在调用之前发出的最后一个操作，answerCallbackQuery
+    按回调 ID 精确归属。
+
+    Returns:
+        tuple: ({操作: {方法: 次数}}, {操作: [完成耗时]})，完成耗时为操作发出到
+        归属于它的最后一次调用完成的时间。
+    """
+    by_user = {}
+    by_callback = {}
+    for index, (user_id, action, started, callback_id) in enumerate(actions):
+        by_user.setdefault(user_id, []).append((started, action, index))
+        if callback_id:
+            by_callback[callback_id] = (action, index, started)
+    for history in by_user.values():
+        history.sort()
+
+    counts = {}
+    last_call = {}
+    for call in calls:
+        user = call.get("chat_id") or call.get("user_id")
+        if user is None and call.get("callback_query_id"):
+            user = call["callback_query_id"].split('-')[0]
+        history = by_user.get(int(user)) if user is not None else None
+        owner = by_callback.get(call.get("callback_query_id"))
+        for started, action, index in history or () if owner is None else ():
+            if started > call["received"]:
+                break
+            owner = (action, index, started)
+        action = owner[0] if owner else "other"
+        methods = counts.setdefault(action, Counter())
+        methods[call["method"]] += 1
+        if owner:
+            last_call[owner[1]] = (action, call["completed"] - owner[2])
+
+    completion = {}
+    for action, seconds in last_call.values():
+        completion.setdefault(action, []).append(seconds)
+    return {action: dict(methods) for action, methods in counts.items()}, completion
+
+
+async def wait_idle(bot_module, api_url, timeout):
+    """等待后台任务、任务队列和 Bot API 调用全部结束。"""
+    deadline = time.monotonic() + timeout
+    previous = -1
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+            busy = bot_module.update_dispatcher.pending or bot_module.inflight_jobs or bot_module.api.queued
+            count = len((await client.get(f"{api_url}/calls")).json())
+            if not busy and count == previous:
+                return True
+            previous = count
+    return False
+
+
+async def run(args):
+    partitions = parse_partitions(args.partitions)
+    ota = build_ota(partitions, parse_ops(args.ops), args.compressibility, args.seed)
+    workdir = tempfile.mkdtemp(prefix='bench_load_')
+    serve_dir = os.path.join(workdir, 'www')
+    os.makedirs(serve_dir)
+    os.symlink(ota, os.path.join(serve_dir, ROM_NAME))
+
+    # 下载源和 Bot API 放在独立进程中，不占用被测进程的 GIL
+    range_process, range_url = start_service(
+        ['benchmarks.range_server', serve_dir, '--rate', args.rate, '--latency', str(args.rom_latency)],
+    )
+    api_process, api_url = start_service(['benchmarks.mock_bot_api', '--latency', str(args.api_latency)])
+    api_root = api_url.rsplit('/', 1)[0]
+
+    os.environ.update(
+        BOT_TOKEN=TOKEN, BOT_API_URL=api_url, WEBHOOK_URL='http://127.0.0.1/webhook',
+        DB_PATH=os.path.join(workdir, 'file_cache.db'),
+    )
+    os.chdir(workdir)  # 日志、output/ 和缓存都写到临时目录
+    sys.path.insert(0, REPO_DIR)
+    import uvicorn
+    import bot
+
+    config = uvicorn.Config(bot.app, host='127.0.0.1', port=0, log_level='warning', access_log=False)
+    server = uvicorn.Server(config)
+    serve_task = asyncio.create_task(server.serve())
+    while not server.started:
+        if serve_task.done():
+            serve_task.result()
+        await asyncio.sleep(0.05)
+    port = server.servers[0].sockets[0].getsockname()[1]
+
+    monitor = LoopLagMonitor()
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=60,
+                                     limits=httpx.Limits(max_connections=args.connections)) as client, \
+                httpx.AsyncClient(base_url=api_root, timeout=60) as api_client:
+            await api_client.delete("/calls")  # 不统计启动时的 setWebhook
+            generator = LoadGenerator(
+                client, api_client, f"{range_url}/{ROM_NAME}", [name for name, _ in partitions],
+                args.think_time, args.seed, args.keyboard_timeout,
+            )
+            monitor.start()
+            started = time.monotonic()
+            await generator.run(args.users, args.rate_users)
+            send_seconds = time.monotonic() - started
+            idle = await wait_idle(bot, api_root, args.timeout)
+            total_seconds = time.monotonic() - started
+            await monitor.stop()
+            calls = (await api_client.get("/calls")).json()
+    finally:
+        server.should_exit = True
+        await serve_task
+        for process in (api_process, range_process):
+            process.terminate()
+            process.wait()
+
+    api_calls, completion = attribute_calls(calls, generator.actions)
+    all_latencies = [value for values in generator.latencies.values() for value in values]
+    return {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            "git_revision": _git_revision(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "users": args.users,
+            "arrival_rate": args.rate_users,
+            "think_time": args.think_time,
+            "api_latency": args.api_latency,
+            "partitions": args.partitions,
+            "workdir": workdir,
+        },
+        "updates": len(generator.actions),
+        "errors": dict(generator.errors),
+        "drained": idle,
+        "send_seconds": round(send_seconds, 3),
+        "total_seconds": round(total_seconds, 3),
+        "webhook_latency": {
+            "all": latency_summary(all_latencies),
+            **{action: latency_summary(values) for action, values in generator.latencies.items()},
+        },
+        "action_completion": {action: latency_summary(values) for action, values in completion.items()},
+        "event_loop_lag": latency_summary(monitor.samples),
+        "api_calls_total": len(calls),
+        "api_calls": api_calls,
+        "api_calls_per_action": {
+            action: round(sum(methods.values()) / max(1, sum(1 for _, a, _, _ in generator.actions if a == action)), 2)
+            for action, methods in api_calls.items()
+        },
+    }
+
+
+def print_report(report):
+    print(f"{report['updates']} updates, errors={report['errors'] or 0}, "
+          f"sent in {report['send_seconds']}s, drained in {report['total_seconds']}s"
+          f"{'' if report['drained'] else ' (timed out)'}")
+    print(f"{'latency':<28} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    rows = [(f"webhook/{key}", value) for key, value in report["webhook_latency"].items()]
+    rows += [(f"completion/{key}", value) for key, value in report["action_completion"].items()]
+    rows.append(("event loop lag", report["event_loop_lag"]))
+    for name, s in rows:
+        print(f"{name:<28} {s['count']:>6} {s['p50_ms']!s:>9} {s['p95_ms']!s:>9} {s['p99_ms']!s:>9} {s['max_ms']!s:>9}")
+    print(f"Bot API calls: {report['api_calls_total']}")
+    for action, methods in report["api_calls"].items():
+        detail = ', '.join(f"{method}={count}" for method, count in sorted(methods.items()))
+        print(f"  {action:<10} {report['api_calls_per_action'][action]:>6}/action  {detail}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=50, help='virtual users, each sends url, page and partition')
+    parser.add_argument('--rate', dest='rate_users', type=float, default=10, help='new users per second, 0 = all at once')
+    parser.add_argument('--think-time', type=float, default=0.5, help='mean delay between actions of one user (s)')
+    parser.add_argument('--connections', type=int, default=100, help='max concurrent HTTP connections to /webhook')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='mock Bot API delay per call (s)')
+    parser.add_argument('--partitions', default='boot:16M,vendor_boot:8M,dtbo:2M')
+    parser.add_argument('--ops', default='xz=4,raw=1,zero=1')
+    parser.add_argument('--compressibility', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rom-rate', dest='rate', default='0', help='ROM download limit per connection, e.g. 20M')
+    parser.add_argument('--rom-latency', type=float, default=0.0, help='extra delay per ROM request (s)')
+    parser.add_argument('--timeout', type=float, default=300, help='max seconds to wait for jobs to finish')
+    parser.add_argument('--keyboard-timeout', type=float, default=60,
+                        help='max seconds a user waits for the partition keyboard before giving up')
+    parser.add_argument('--output', help='write the report as JSON')
+    args = parser.parse_args(argv)
+    if args.output:
+        args.output = os.path.abspath(args.output)  # run() 会切换到临时工作目录
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""模拟 Telegram Bot API 的本地服务，记录每一次调用及其时间。
+
+bot 通过 BOT_API_URL=http://127.0.0.1:PORT/bot 连接本服务。GET /calls 返回全部调用记录，
+GET /calls?chat_id=ID 只返回该会话的记录，DELETE /calls 清空记录。
+
+    python -m benchmarks.mock_bot_api --port 8081 --latency 0.05
+"""
+import re
+import json
+import time
+import argparse
+import itertools
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlsplit
+
+_PATH = re.compile(r'^/bot[^/]+/(\w+)$')
+_MULTIPART_FIELD = re.compile(rb'name="([^"]+)"(?:; filename="[^"]*")?\r\n(?:[^\r\n]+\r\n)*\r\n(.*?)\r\n--', re.S)
+
+
+def _callback_data(reply_markup):
+    """内联键盘中所有按钮的 callback_data，表单参数中 reply_markup 是 JSON 字符串。"""
+    if isinstance(reply_markup, str):
+        try:
+            reply_markup = json.loads(reply_markup)
+        except ValueError:
+            return []
+    if not isinstance(reply_markup, dict):
+        return []
+    return [
+        button["callback_data"]
+        for row in reply_markup.get("inline_keyboard") or ()
+        for button in row
+        if "callback_data" in button
+    ]
+
+
+def _parse_params(content_type, body):
+    """取出请求参数，上传的文件只记录大小。"""
+    if content_type.startswith('multipart/form-data'):
+        params = {}
+        for name, value in _MULTIPART_FIELD.findall(body):
+            name = name.decode()
+            try:
+                params[name] = value.decode()
+            except UnicodeDecodeError:
+                params[name] = f"<{len(value)} bytes>"
+        return params
+    if content_type.startswith('application/json'):
+        return json.loads(body or b'{}')
+    return {key: values[-1] for key, values in parse_qs(body.decode()).items()}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/calls':
+            chat_id = parse_qs(url.query).get('chat_id', [None])[-1]
+            self._reply(self.server.snapshot(chat_id))
+        else:
+            self._reply({"ok": False, "description": "Not Found"}, 404)
+
+    def do_DELETE(self):
+        if self.path == '/calls':
+            self.server.reset()
+            self._reply({"ok": True})
+        else:
+            self._reply({"ok": False, "description": "Not Found"}, 404)
+
+    def do_POST(self):
+        received = time.time()
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        match = _PATH.match(self.path)
+        if not match:
+            self._reply({"ok": False, "description": "Not Found"}, 404)
+            return
+        method = match.group(1)
+        params = _parse_params(self.headers.get('Content-Type', ''), body)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.server.record(method, params, received, len(body))
+        self._reply({"ok": True, "result": self.server.result(method, params)})
+
+
+class MockBotApi(ThreadingHTTPServer):
+    """
+    模拟 Bot API 服务。
+
+    Args:
+        port: 监听端口，0 表示自动分配。
+        latency: 每次调用的额外延迟（秒），模拟到 Telegram 的往返时间。
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.latency = latency
+        self._calls = []
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1000)
+        self._file_ids = itertools.count(1)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/bot"
+
+    def record(self, method, params, received, size):
+        with self._lock:
+            self._calls.append({
+                "method": method,
+                "chat_id": params.get("chat_id"),
+                "user_id": params.get("user_id"),
+                "callback_query_id": params.get("callback_query_id"),
+                "message_id": params.get("message_id"),
+                "callbacks": _callback_data(params.get("reply_markup")),
+                "received": received,
+                "completed": time.time(),
+                "bytes": size,
+            })
+
+    def snapshot(self, chat_id=None):
+        with self._lock:
+            if chat_id is None:
+                return list(self._calls)
+            return [call for call in self._calls if str(call["chat_id"]) == chat_id]
+
+    def reset(self):
+        with self._lock:
+            self._calls = []
+
+    def _message(self, params, **extra):
+        chat_id = int(params.get("chat_id") or 0)
+        return {
+            "message_id": int(params.get("message_id") or next(self._message_ids)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": params.get("text", ""),
+            **extra,
+        }
+
+    def result(self, method, params):
+        if method in ("sendMessage", "editMessageText"):
+            return self._message(params)
+        if method == "sendDocument":
+            document = params.get("document", "")
+            file_id = document if not document.startswith("attach://") and document else f"file-{next(self._file_ids)}"
+            return self._message(params, document={"file_id": file_id, "file_unique_id": file_id})
+        if method == "getChatMember":
+            user_id = int(params.get("user_id") or 0)
+            return {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": "bench"}}
+        return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0)
+    args = parser.parse_args(argv)
+    server = MockBotApi(args.port, args.latency)
+    print(f"Mock Bot API at {server.url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""支持 Range 请求、可限速的本地 HTTP 文件服务器，代替 ROM 下载源。
+
+    python -m benchmarks.range_server DIR --port 8765 --rate 20M --latency 0.05
+"""
+import os
+import re
+import time
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote, urlparse
+
+CHUNK_SIZE = 64 * 1024
+_RANGE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def do_GET(self):
+        self._serve(body=True)
+
+    def _serve(self, body):
+        server = self.server
+        path = os.path.join(server.directory, os.path.basename(unquote(urlparse(self.path).path)))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        if server.latency:
+            time.sleep(server.latency)
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        status = 200
+        header = self.headers.get('Range')
+        if header:
+            match = _RANGE.match(header.strip())
+            if not match or match.groups() == ('', ''):
+                self.send_error(416)
+                return
+            first, last = match.groups()
+            if first == '':
+                start = max(0, size - int(last))
+            else:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+            if start > end:
+                self.send_error(416)
+                return
+            status = 206
+
+        length = end - start + 1
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', f'"{int(os.path.getmtime(path))}-{size}"')
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        server.count_request()
+        if not body:
+            return
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = length
+            started = time.monotonic()
+            sent = 0
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                try:
+                    self.wfile.write(chunk)
+                except (BrokenPipeError, ConnectionResetError):
+                    break
+                remaining -= len(chunk)
+                sent += len(chunk)
+                server.count_bytes(len(chunk))
+                if server.rate:
+                    # 每个连接单独限速
+                    delay = sent / server.rate - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+
+
+class RangeServer(ThreadingHTTPServer):
+    """
+    在后台线程中提供 directory 下的文件。
+
+    Args:
+        directory: 文件目录。
+        port: 监听端口，0 表示自动分配。
+        rate: 每个连接的限速（字节/秒），0 表示不限速。
+        latency: 每个请求的额外延迟（秒），模拟远端往返时间。
+    """
+
+    daemon_threads = True
+
+    def __init__(self, directory, port=0, rate=0, latency=0.0):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.directory = directory
+        self.rate = rate
+        self.latency = latency
+        self.bytes_sent = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count_bytes(self, n):
+        with self._lock:
+            self.bytes_sent += n
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def snapshot(self):
+        with self._lock:
+            return self.bytes_sent, self.requests
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main(argv=None):
+    from benchmarks.synthetic_ota import parse_size
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('directory')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--rate', default='0', help='per-connection limit, e.g. 20M (bytes/s)')
+    parser.add_argument('--latency', type=float, default=0.0)
+    args = parser.parse_args(argv)
+    server = RangeServer(args.directory, args.port, parse_size(args.rate), args.latency)
+    print(f"Serving {args.directory} at {server.url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+"""file_processor.py 端到端基准测试。
+
+生成合成 OTA 包并通过本地限速 Range 服务器提供，依次运行 --list、--metadata
+和各分区的 --dump，记录每条命令及其各阶段的耗时、峰值内存和 CPU 时间，以及每条命令的
+传输字节数和请求数，结果保存为 JSON，可以与之前的结果对比。
+
+    python -m benchmarks.run --rate 20M --repeat 3 --output after.json --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+
+from benchmarks.range_server import RangeServer
+from benchmarks.synthetic_ota import generate, parse_ops, parse_partitions, parse_size
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FILE_PROCESSOR = os.path.join(REPO_DIR, 'file_processor.py')
+CACHE_DIR = os.path.join(REPO_DIR, 'benchmarks', '.cache')  # 生成的 OTA 包按参数缓存
+
+
+def build_ota(partitions, ops, compressibility, seed):
+    """生成（或复用已缓存的）合成 OTA 包，返回其路径。"""
+    spec = json.dumps([partitions, ops, compressibility, seed], sort_keys=True)
+    digest = hashlib.sha1(spec.encode()).hexdigest()[:12]
+    path = os.path.join(CACHE_DIR, f"benchmark_ota_{digest}.zip")
+    if not os.path.exists(path):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        started = time.monotonic()
+        generate(f"{path}.tmp", partitions, ops, compressibility, seed)
+        os.replace(f"{path}.tmp", path)
+        print(f"Generated {path} in {time.monotonic() - started:.1f}s", file=sys.stderr)
+    return path
+
+
+def _sample_process(pid):
+    """
+    读取进程当前的累计 CPU 时间和自上次采样以来的峰值 RSS，并重置峰值（仅 Linux）。
+
+    Returns:
+        tuple: (CPU 秒数, 峰值 RSS KB)，进程已退出或没有 /proc 时返回 None。
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/status') as f:
+            peak = next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+    except (OSError, StopIteration, IndexError, ValueError):
+        return None
+    try:
+        # 重置 VmHWM，下一次采样得到的是这一段时间内的峰值；无权限时峰值为累计值
+        with open(f'/proc/{pid}/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+    ticks = os.sysconf('SC_CLK_TCK')
+    return (int(fields[11]) + int(fields[12])) / ticks, peak
+
+
+def run_command(argv, workdir, env, server):
+    """
+    在 workdir 中运行一条 file_processor 命令并测量资源占用。
+
+    阶段由命令输出的 status/progress 事件划分：从该阶段的第一个事件开始，到下一个阶段、
+    artifact 或 error 事件为止。每个阶段边界从 /proc 采样一次 CPU 时间和峰值 RSS，
+    最后一个阶段在进程退出前未能采样时，CPU 时间取自 wait4，峰值 RSS 为 None。
+    """
+    bytes_before, requests_before = server.snapshot()
+    started = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, FILE_PROCESSOR, *argv],
+        cwd=workdir, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+    )
+    stages = {}
+    error = None
+    current = None  # (阶段, 开始时间, 开始时的 CPU 秒数)
+
+    def close_stage(now, sample, total_cpu=None):
+        stage, began, cpu = current
+        result = stages.setdefault(stage, {"seconds": 0.0, "cpu_seconds": 0.0, "max_rss_kb": None})
+        result["seconds"] += now - began
+        end_cpu = sample[0] if sample else total_cpu
+        if end_cpu is not None and cpu is not None:
+            result["cpu_seconds"] += end_cpu - cpu
+        if sample:
+            result["max_rss_kb"] = max(result["max_rss_kb"] or 0, sample[1])
+
+    for line in process.stdout:
+        now = time.monotonic() - started
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+        if not isinstance(event, dict):
+            continue
+        kind = event.get("event")
+        if kind == "error":
+            error = event.get("code")
+        stage = event.get("stage") if kind in ("status", "progress") else None
+        if current and stage == current[0]:
+            continue
+        if stage is None and kind not in ("artifact", "error"):
+            continue
+        sample = _sample_process(process.pid)
+        if current:
+            close_stage(now, sample)
+        current = (stage, now, sample[0] if sample else None) if stage else None
+    # wait4 返回该子进程自己的资源占用
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.monotonic() - started
+    if current:
+        close_stage(wall, None, usage.ru_utime + usage.ru_stime)
+    bytes_after, requests_after = server.snapshot()
+    return {
+        "exit_code": process.returncode,
+        "error": error,
+        "wall_seconds": round(wall, 4),
+        "bytes_transferred": bytes_after - bytes_before,
+        "requests": requests_after - requests_before,
+        "cpu_user_seconds": round(usage.ru_utime, 4),
+        "cpu_system_seconds": round(usage.ru_stime, 4),
+        "max_rss_kb": usage.ru_maxrss,
+        "stages": {
+            stage: {**result, "seconds": round(result["seconds"], 4), "cpu_seconds": round(result["cpu_seconds"], 4)}
+            for stage, result in stages.items()
+        },
+    }
+
+
+def run(args):
+    partitions = parse_partitions(args.partitions)
+    ota = build_ota(partitions, parse_ops(args.ops), args.compressibility, args.seed)
+    dump = args.dump.split(',') if args.dump else [name for name, _ in partitions]
+
+    serve_dir = tempfile.mkdtemp(prefix='bench_www_')
+    rom_name = 'benchmark_rom_ota_full.zip'
+    os.symlink(ota, os.path.join(serve_dir, rom_name))
+    server = RangeServer(serve_dir, rate=parse_size(args.rate), latency=args.latency).start()
+    url = f"{server.url}/{rom_name}"
+
+    results = []
+    try:
+        for mode in args.mode.split(','):
+            for repeat in range(args.repeat):
+                # 每轮使用新的工作目录和数据库，模拟首次请求（无探测缓存、无产物缓存）
+                workdir = tempfile.mkdtemp(prefix='bench_run_')
+                env = dict(os.environ, EXTRACT_MODE=mode, DB_PATH=os.path.join(workdir, 'file_cache.db'))
+                commands = [('list', ['--list', url]), ('metadata', ['--metadata', url])]
+                commands += [(f'dump:{name}', ['--dump', name, url]) for name in dump]
+                try:
+                    for name, argv in commands:
+                        result = run_command(argv, workdir, env, server)
+                        result.update(command=name, mode=mode, repeat=repeat)
+                        results.append(result)
+                        print(
+                            f"{mode:>14} #{repeat} {name:<20} {result['wall_seconds']:>8.3f}s "
+                            f"{result['bytes_transferred']:>12} B {result['max_rss_kb']:>8} KB "
+                            f"exit={result['exit_code']}",
+                            file=sys.stderr,
+                        )
+                finally:
+                    shutil.rmtree(workdir, ignore_errors=True)
+    finally:
+        server.stop()
+        shutil.rmtree(serve_dir, ignore_errors=True)
+
+    return {
+        "meta": {
+            "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            "git_revision": _git_revision(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "partitions": args.partitions,
+            "ops": args.ops,
+            "compressibility": args.compressibility,
+            "seed": args.seed,
+            "rate": args.rate,
+            "latency": args.latency,
+            "ota_size": os.path.getsize(ota),
+        },
+        "results": results,
+        "summary": summarize(results),
+    }
+
+
+def summarize(results):
+    """按 (模式, 命令) 汇总各次运行的中位数。"""
+    groups = {}
+    for result in results:
+        groups.setdefault(f"{result['mode']}/{result['command']}", []).append(result)
+    summary = {}
+    for key, runs in groups.items():
+        summary[key] = {
+            field: statistics.median(run[field] for run in runs)
+            for field in ("wall_seconds", "bytes_transferred", "requests", "cpu_user_seconds",
+                          "cpu_system_seconds", "max_rss_kb")
+        }
+        summary[key]["failures"] = sum(1 for run in runs if run["exit_code"] != 0)
+    return summary
+
+
+def compare(baseline, current):
+    """打印与基线结果的对比。"""
+    print(f"{'benchmark':<36} {'field':<18} {'baseline':>12} {'current':>12} {'change':>8}")
+    for key, fields in current["summary"].items():
+        base = baseline.get("summary", {}).get(key)
+        if base is None:
+            continue
+        for field in ("wall_seconds", "bytes_transferred", "max_rss_kb", "cpu_user_seconds"):
+            old, new = base.get(field, 0), fields[field]
+            change = f"{(new - old) * 100 / old:+.1f}%" if old else "-"
+            print(f"{key:<36} {field:<18} {old:>12.6g} {new:>12.6g} {change:>8}")
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--partitions', default='boot:64M,vendor_boot:32M,dtbo:8M',
+                        help='name:size list for the synthetic payload')
+    parser.add_argument('--ops', default='xz=4,raw=1,zero=1', help='operation type weights')
+    parser.add_argument('--compressibility', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--dump', default='', help='partitions to dump, default all')
+    parser.add_argument('--mode', default='parallel', help='EXTRACT_MODE values, comma separated')
+    parser.add_argument('--rate', default='0', help='per-connection bandwidth limit, e.g. 20M')
+    parser.add_argument('--latency', type=float, default=0.0, help='extra delay per request (seconds)')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--compare', help='baseline JSON to compare against')
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    else:
+        json.dump(report["summary"], sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""生成用于基准测试的合成 OTA 包。
+
+包内的 payload.bin 为 CrAU v2 格式（url_probe.probe_url 可以通过），分区大小、
+操作类型比例和数据可压缩程度都可以配置，相同参数生成的文件完全相同。
+
+    python -m benchmarks.synthetic_ota out.zip --partitions boot:64M,dtbo:8M --ops xz=4,raw=1,zero=1
+"""
+import os
+import bz2
+import sys
+import lzma
+import random
+import shutil
+import struct
+import zipfile
+import argparse
+import tempfile
+
+import payload_dumper.update_metadata_pb2 as um
+
+BLOCK_SIZE = 4096
+OP_BLOCKS = 512  # 每个操作覆盖的块数（2 MiB），与真实 payload 的分块大小相近
+COPY_CHUNK = 8 * 1024 * 1024
+
+_OP_TYPES = {
+    'xz': um.InstallOperation.REPLACE_XZ,
+    'bz2': um.InstallOperation.REPLACE_BZ,
+    'raw': um.InstallOperation.REPLACE,
+    'zero': um.InstallOperation.ZERO,
+}
+
+
+def parse_size(text):
+    """解析 64M、512K、1G 这样的大小，按 1024 进制。"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = text.strip().upper()
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def parse_partitions(text):
+    """boot:64M,dtbo:8M -> [('boot', 字节数), ...]"""
+    partitions = []
+    for item in text.split(','):
+        name, size = item.split(':')
+        partitions.append((name.strip(), parse_size(size)))
+    return partitions
+
+
+def parse_ops(text):
+    """xz=4,raw=1,zero=1 -> {'xz': 4, 'raw': 1, 'zero': 1}"""
+    weights = {}
+    for item in text.split(','):
+        kind, weight = item.split('=')
+        kind = kind.strip()
+        if kind not in _OP_TYPES:
+            raise ValueError(f"Unknown operation type {kind}, expected one of {', '.join(_OP_TYPES)}")
+        weights[kind] = float(weight)
+    return weights
+
+
+def _block_data(rnd, size, compressibility):
+    """生成 size 字节数据，其中约 compressibility 比例为可压缩的重复内容。"""
+    random_size = int(size * (1 - compressibility)) // 16 * 16
+    data = rnd.randbytes(random_size)
+    pattern = rnd.randbytes(16)
+    return data + pattern * ((size - random_size) // 16)
+
+
+def _encode(kind, data):
+    if kind == 'xz':
+        return lzma.compress(data, preset=1)
+    if kind == 'bz2':
+        return bz2.compress(data, compresslevel=1)
+    return data
+
+
+def generate(path, partitions, ops=None, compressibility=0.5, seed=0):
+    """
+    生成合成 OTA 包。
+
+    Args:
+        path: 输出的 zip 路径。
+        partitions: [(分区名, 字节数)]，字节数向上取整到块大小。
+        ops: 各操作类型的权重，默认 {'xz': 1}。
+        compressibility: 非零数据中可压缩内容的比例（0~1）。
+        seed: 随机种子。
+
+    Returns:
+        dict: 分区名 -> 镜像的 (大小, 操作数)。
+    """
+    ops = ops or {'xz': 1}
+    kinds = list(ops)
+    weights = [ops[kind] for kind in kinds]
+    rnd = random.Random(seed)
+
+    manifest = um.DeltaArchiveManifest()
+    manifest.block_size = BLOCK_SIZE
+    manifest.minor_version = 0
+    summary = {}
+
+    with tempfile.TemporaryFile() as blob:
+        offset = 0
+        for name, size in partitions:
+            blocks = -(-size // BLOCK_SIZE)
+            partition = manifest.partitions.add()
+            partition.partition_name = name
+            partition.new_partition_info.size = blocks * BLOCK_SIZE
+            start = 0
+            while start < blocks:
+                count = min(OP_BLOCKS, blocks - start)
+                kind = rnd.choices(kinds, weights)[0]
+                operation = partition.operations.add()
+                operation.type = _OP_TYPES[kind]
+                extent = operation.dst_extents.add()
+                extent.start_block = start
+                extent.num_blocks = count
+                if kind != 'zero':
+                    data = _encode(kind, _block_data(rnd, count * BLOCK_SIZE, compressibility))
+                    operation.data_offset = offset
+                    operation.data_length = len(data)
+                    blob.write(data)
+                    offset += len(data)
+                start += count
+            summary[name] = (blocks * BLOCK_SIZE, len(partition.operations))
+
+        manifest_bytes = manifest.SerializeToString()
+        blob.seek(0)
+        with zipfile.ZipFile(path, 'w', allowZip64=True) as archive:
+            archive.writestr(
+                'META-INF/com/android/metadata',
+                'ota-type=AB\npre-device=benchmark\npost-build=benchmark/synthetic\n',
+                compress_type=zipfile.ZIP_DEFLATED,
+            )
+            # payload.bin 必须以 STORED 方式存放，才能按偏移直接 Range 读取
+            info = zipfile.ZipInfo('payload.bin')
+            info.compress_type = zipfile.ZIP_STORED
+            with archive.open(info, 'w', force_zip64=True) as payload:
+                payload.write(b'CrAU' + struct.pack('>QQL', 2, len(manifest_bytes), 0))
+                payload.write(manifest_bytes)
+                shutil.copyfileobj(blob, payload, COPY_CHUNK)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('output')
+    parser.add_argument('--partitions', default='boot:64M,vendor_boot:32M,dtbo:8M')
+    parser.add_argument('--ops', default='xz=4,raw=1,zero=1')
+    parser.add_argument('--compressibility', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    summary = generate(
+        args.output, parse_partitions(args.partitions), parse_ops(args.ops), args.compressibility, args.seed,
+    )
+    for name, (size, operations) in summary.items():
+        print(f"{name}: {size} bytes, {operations} operations")
+    print(f"{args.output}: {os.path.getsize(args.output)} bytes", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
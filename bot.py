@@ -2,15 +2,14 @@ import os
 import re
 import asyncio
 import shlex
+import time
 import json
 import file_check
 import logging
-import sqlite3
-from datetime import datetime, timedelta, timezone
 from urllib.parse import urlparse
 
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel
 import httpx
 
@@ -18,25 +17,69 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot
 from telegram.ext import CallbackContext
 from telegram.error import RetryAfter, BadRequest
 from telegram.request import HTTPXRequest
-from aiocache import cached, caches
 from contextlib import asynccontextmanager
+from storage import db, layout_page_rows
+from worker_pool import worker_pool
+from scheduler import extraction_scheduler
+from upload_pool import upload_pool
+from singleflight import SingleFlight, SharedJob
+from session_store import SessionStore
+from update_dispatcher import UpdateDispatcher
+from metrics import registry
+from ttl_cache import TTLCache
+from edit_coalescer import EditCoalescer
+from api_scheduler import ApiScheduler, API_CONCURRENCY, PRIORITY_HIGH, PRIORITY_LOW, retry_seconds
+from url_probe import format_size
+import size_predictor
+import keyboard_layout
+import artifact_cache
+import split_archive
+import events
+import structured_logging
 
 # 设置 Telegram Bot 的 API 密钥
 TOKEN = os.getenv('BOT_TOKEN')
 CHANNEL_USERNAME = os.getenv('CHANNEL_NAME')  # 替换为您的频道用户名
 WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+BOT_API_URL = os.getenv('BOT_API_URL', 'https://api.telegram.org/bot')  # Bot API 地址，压测时指向本地模拟服务
 CDN_URL = "https://bkt-sgp-miui-ota-update-alisgp.oss-ap-southeast-1.aliyuncs.com/"
 MIUI_URL_REGEX = r"https://(?:bn|bigota|cdnorg|hugeota)\.d\.miui\.com/(.*)"
 BLACKLISTED_PARTITIONS = [
     "modem", "modemfirmware", "odm", "product", "system", "system_ext", "vendor"
 ]
-request = HTTPXRequest(connection_pool_size=8)
-bot = Bot(token=TOKEN, request=request)
+request = HTTPXRequest(connection_pool_size=API_CONCURRENCY)
+bot = Bot(token=TOKEN, request=request, base_url=BOT_API_URL)
+api = ApiScheduler()  # 所有 Bot API 请求经由此处限速和排队
 MAX_RETRIES = 3
 RETRY_INTERVAL = 5  # 秒
-
-user_data_store = {}  # 全局字典存储用户数据
-user_locks = {}  # 每个用户独立的锁
+LAYOUT_CACHE_SIZE = int(os.getenv('LAYOUT_CACHE_SIZE', '512'))  # 最多缓存的 ROM 布局数
+LAYOUT_CACHE_TTL = int(os.getenv('LAYOUT_CACHE_TTL', '3600'))  # 秒
+FILENAME_CACHE_SIZE = int(os.getenv('FILENAME_CACHE_SIZE', '4096'))
+FILENAME_CACHE_TTL = int(os.getenv('FILENAME_CACHE_TTL', '3600'))  # 秒
+FILENAME_RESOLVE_TIMEOUT = float(os.getenv('FILENAME_RESOLVE_TIMEOUT', '10'))  # 秒
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv('SUBSCRIPTION_CACHE_SIZE', '10000'))
+SUBSCRIPTION_CACHE_TTL = int(os.getenv('SUBSCRIPTION_CACHE_TTL', '600'))  # 已订阅结果的有效期（秒）
+SUBSCRIPTION_NEGATIVE_TTL = int(os.getenv('SUBSCRIPTION_NEGATIVE_TTL', '30'))  # 未订阅结果的有效期，用户订阅后很快生效
+
+user_data_store = SessionStore()  # 用户会话及每个用户独立的锁，闲置或超过数量上限时淘汰
+# ROM 文件名 -> {"total_pages": 总页数, "pages": {页码: InlineKeyboardMarkup}}
+layout_cache = TTLCache(maxsize=LAYOUT_CACHE_SIZE, ttl=LAYOUT_CACHE_TTL)
+rom_file_name_cache = TTLCache(maxsize=FILENAME_CACHE_SIZE, ttl=FILENAME_CACHE_TTL)  # URL -> ROM 文件名
+inflight_jobs = {}  # (命令, ROM 文件名, 分区名) -> SharedJob，相同任务只执行一次
+upload_flight = SingleFlight()  # 相同文件只上传一次，其余用户复用 file_id
+subscription_cache = TTLCache(maxsize=SUBSCRIPTION_CACHE_SIZE, ttl=SUBSCRIPTION_CACHE_TTL)  # 用户 ID -> 是否已订阅
+subscription_flight = SingleFlight()  # 同一用户的并发查询只请求一次 Bot API
+background_tasks = set()  # 事件循环只保留任务的弱引用，后台任务结束前由这里引用
+
+QUEUE_WAIT = registry.histogram('dumper_queue_wait_seconds', 'Time --dump jobs wait for an extraction slot')
+JOB_DURATION = registry.histogram(
+    'dumper_job_duration_seconds', 'Worker job duration by command, excluding queue wait', ['command', 'result'],
+)
+COMPRESS_SECONDS = registry.histogram('dumper_compress_seconds', 'Time from compression start to the finished zip')
+DOWNLOAD_BYTES = registry.counter('dumper_download_bytes_total', 'Payload bytes downloaded by origin host', ['origin'])
+CACHE_LOOKUPS = registry.counter(
+    'dumper_cache_lookups_total', 'Cache lookups by cache (artifact, file_id, keyboard_layouts)', ['cache', 'result'],
+)
 
 # 全局 http_client
 http_client = httpx.AsyncClient(
@@ -44,102 +87,23 @@ http_client = httpx.AsyncClient(
     timeout=httpx.Timeout(90.0)  # 增加超时时间
 )
 
-caches.set_config({
-    'default': {
-        'cache': "aiocache.SimpleMemoryCache",
-        'serializer': {
-            'class': "aiocache.serializers.StringSerializer"
-        }
-    }
-})
-
-def init_db():
-    conn = sqlite3.connect('file_cache.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS file_cache (
-            file_name TEXT PRIMARY KEY,
-            file_id TEXT
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS keyboard_layouts (
-            file_name TEXT PRIMARY KEY,
-            layout_data TEXT
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-# 在程序启动时初始化数据库
-init_db()
-
 # --- 日志设置 ---
-# 创建UTC+8时区
-utc_8_timezone = timezone(timedelta(hours=8))
-
-# 获取当前UTC+8时间
-now = datetime.now(utc_8_timezone)
-
-# 指定日志目录和文件名
-log_dir = "logs"
-log_filename = f"bot_{now.strftime('%Y%m%d_%H%M%S')}.log"
-log_filepath = os.path.join(log_dir, log_filename)
-
-# 确保日志目录存在
-os.makedirs(log_dir, exist_ok=True)
-
-# 过滤HTTP请求的过滤器
-class HTTPFilter(logging.Filter):
-    def filter(self, record):
-        if "HTTP REQUEST" in record.getMessage().upper():
-            return False
-        else:
-            return True
-
-# 创建一个自定义的Formatter
-class UTC8Formatter(logging.Formatter):
-    def formatTime(self, record, datefmt=None):
-        dt = datetime.fromtimestamp(record.created, tz=utc_8_timezone)
-        if datefmt:
-            return dt.strftime(datefmt)
-        else:
-            return dt.isoformat(sep=' ', timespec='milliseconds')
-
-# 创建一个logger
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-
-# 创建一个handler，用于写入日志文件
-file_handler = logging.FileHandler(log_filepath)
-file_handler.setLevel(logging.INFO)
-
-# 创建一个formatter，用于格式化日志信息
-formatter = UTC8Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S %Z%z')
-file_handler.setFormatter(formatter)
-
-# 将handler添加到logger
-logger.addHandler(file_handler)
-
-# 添加过滤器到handler
-http_filter = HTTPFilter()
-file_handler.addFilter(http_filter)
-
-# 修改日志记录的时间为UTC+8时间
-old_factory = logging.getLogRecordFactory()
-def record_factory(*args, **kwargs):
-    record = old_factory(*args, **kwargs)
-    record.created = datetime.fromtimestamp(record.created, tz=timezone.utc).astimezone(utc_8_timezone).timestamp()
-    return record
-logging.setLogRecordFactory(record_factory)
-
-logger.info(f"Bot started at {now.strftime('%Y-%m-%d %H%M%S')}")
+# 记录经队列交给后台线程写入按大小轮转的 JSON 日志，不阻塞事件循环
+log_listener = structured_logging.setup()
+logging.info("Bot started")
 
 class TelegramUpdate(BaseModel):
     update_id: int
     message: dict = None
     callback_query: dict = None
 
+def spawn(coro):
+    """在后台运行协程，并在任务结束前保留对它的引用，避免被垃圾回收。"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
 def display_message(url, partition_name=None, file_name=None):
     """组织消息内容。
 
@@ -159,6 +123,22 @@ def display_message(url, partition_name=None, file_name=None):
         message += f"\n📄FILE: \n<code>{file_name}</code>\n"
     return message
 
+PROGRESS_LABELS = {
+    "download": ("Downloading", "下载中"),
+    "compress": ("Compressing", "压缩中"),
+}
+
+def format_progress(progress):
+    """把各阶段最新的进度事件格式化为进度、大小和速度。"""
+    lines = []
+    for stage, event in progress.items():
+        done, total, elapsed = event["done"], event["total"], event.get("elapsed") or 0
+        percent = done * 100 / total if total else 100
+        speed = format_size(int(done / elapsed)) if elapsed else "-"
+        en, zh = PROGRESS_LABELS.get(stage, (stage, stage))
+        lines.append(f"{en} / {zh}: {percent:.0f}% ({format_size(done)}/{format_size(total)}, {speed}/s)")
+    return "\n".join(lines)
+
 async def retry_async(chat_id, status_message_id, coro_function, *args, retry_msg=None, max_retries=3):
     for retry in range(max_retries):
         try:
@@ -168,27 +148,26 @@ async def retry_async(chat_id, status_message_id, coro_function, *args, retry_ms
                 logging.warning(retry_msg)
             
             if isinstance(e, RetryAfter):
-                retry_after = e.retry_after
+                # api 已经按 RetryAfter 重试过，到这里说明多次被限流
+                retry_after = retry_seconds(e)
                 logging.warning(f"Retrying in {retry_after} seconds...")
             else:
                 retry_after = RETRY_INTERVAL
                 logging.warning(f"Error occurred: {e}. Retrying in {retry_after} seconds...")
 
             if retry < max_retries - 1:
-                await bot.edit_message_text(
-                    chat_id=chat_id,
-                    message_id=status_message_id,
-                    text=f"Upload error, attempt {retry + 1}\n上传错误，第{retry + 1}次尝试",
-                    parse_mode="HTML"
+                await edit_message(
+                    chat_id,
+                    status_message_id,
+                    f"Upload error, attempt {retry + 1}\n上传错误，第{retry + 1}次尝试",
                 )
                 await asyncio.sleep(retry_after)
             else:
                 logging.error(f"Error occurred: {e}. Maximum retries reached.")
-                await bot.edit_message_text(
-                    chat_id=chat_id,
-                    message_id=status_message_id,
-                    text=f"Upload error, failed to retry {max_retries} times. Please try again later\n上传错误，重试{max_retries}次失败。请稍后再试",
-                    parse_mode="HTML"
+                await edit_message(
+                    chat_id,
+                    status_message_id,
+                    f"Upload error, failed to retry {max_retries} times. Please try again later\n上传错误，重试{max_retries}次失败。请稍后再试",
                 )
                 raise Exception(f"Error occurred: {e}. Maximum retries reached.")
                 raise e
@@ -197,7 +176,7 @@ async def send_inline_message(chat_id, text, inline_keyboard=None):
     if inline_keyboard is None:
         inline_keyboard = []
 
-    logging.info(f"Inline keyboard passed: {inline_keyboard}")
+    logging.debug("Inline keyboard passed: %s", inline_keyboard)
 
     if isinstance(inline_keyboard, InlineKeyboardMarkup):
         inline_keyboard_markup = inline_keyboard
@@ -208,10 +187,12 @@ async def send_inline_message(chat_id, text, inline_keyboard=None):
             logging.error(f"Failed to create inline keyboard markup: {e}")
             inline_keyboard_markup = None
 
-    logging.info(f"Sending message to chat {chat_id}: {text}")
+    logging.debug("Sending message to chat %s: %s", chat_id, text)
     try:
-        message = await bot.send_message(
+        message = await api.call(
+            bot.send_message,
             chat_id=chat_id,
+            priority=PRIORITY_HIGH,
             text=text,
             reply_markup=inline_keyboard_markup,
             parse_mode='HTML'
@@ -221,112 +202,145 @@ async def send_inline_message(chat_id, text, inline_keyboard=None):
         return None
     return message
 
-async def edit_message(chat_id, message_id, text, reply_markup=None):
-    try:
-        await bot.edit_message_text(
-            chat_id=chat_id,
-            message_id=message_id,
-            text=text,
-            parse_mode="HTML",
-            reply_markup=reply_markup,
-        )
-    except Exception as e:
-        logging.warning(f"Failed to edit message content: {e}")
-
-def create_partition_keyboard(partitions_info, page=1):
-    priority_partitions = ["boot", "init_boot", "vbmeta", "vbmeta_system"]
-    partitions_info = sorted(
-        partitions_info,
-        key=lambda x: (x["partition_name"] not in priority_partitions, x["partition_name"]),
+async def send_edit(chat_id, message_id, text, reply_markup=None, final=False):
+    # 最终结果优先于进度更新发出
+    await api.call(
+        bot.edit_message_text,
+        chat_id=chat_id,
+        priority=PRIORITY_HIGH if final else PRIORITY_LOW,
+        message_id=message_id,
+        text=text,
+        parse_mode="HTML",
+        reply_markup=reply_markup,
     )
 
-    per_page_first = 12
-    per_page_other = 14
-
-    if len(partitions_info) <= per_page_first:
-        total_pages = 1
-    else:
-        total_pages = ((len(partitions_info) - per_page_first) + per_page_other - 1) // per_page_other + 1
-
-    start_index = (page - 1) * per_page_other
-    if page == 1:
-        per_page = per_page_first
-        start_index = 0
-    else:
-        per_page = per_page_other
-        start_index = per_page_first + (page - 2) * per_page_other
+edit_coalescer = EditCoalescer(send_edit)
 
-    end_index = min(start_index + per_page, len(partitions_info))
+async def edit_message(chat_id, message_id, text, reply_markup=None, final=True):
+    """编辑消息。final=False 用于进度等中间状态：立即返回，并与同一条消息的后续编辑合并。"""
+    await edit_coalescer.edit(chat_id, message_id, text, reply_markup, final=final)
 
-    keyboard = []
-    if page == 1:
-        keyboard.append([InlineKeyboardButton(text="🏷️Fetch metadata", callback_data="metadata")])
+def build_keyboard_markup(keyboard):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(**button) for button in row]
+        for row in keyboard
+    ])
 
-    row = []
-    for i in range(start_index, end_index):
-        p = partitions_info[i]
-        row.append(
-            InlineKeyboardButton(text=f"{p['partition_name']}({p['size_readable']})", callback_data=f"{p['partition_name']}")
-        )
-        if len(row) == 2:
-            keyboard.append(row)
-            row = []
-    if row:
-        keyboard.append(row)
-
-    prev_button = InlineKeyboardButton(text="⬅️", callback_data=f"page {page - 1}") if page > 1 else InlineKeyboardButton(text="⏹️", callback_data=" ")
-    next_button = InlineKeyboardButton(text="➡️", callback_data=f"page {page + 1}") if page < total_pages else InlineKeyboardButton(text="⏹️", callback_data=" ")
-
-    keyboard.append(
-        [prev_button, InlineKeyboardButton(text=f"📄{page}/{total_pages}", callback_data=" "), next_button]
-    )
-
-    return keyboard, total_pages
-
-def store_keyboard_layout(file_name, layout_data):
+async def store_keyboard_layout(file_name, layout_data):
     if file_name is None or not isinstance(file_name, str):
         logging.error("Invalid file_name: cannot store keyboard layout for None or non-string value")
         return
     if not file_name.endswith(".zip"):
         file_name += ".zip"
-    conn = sqlite3.connect('file_cache.db')
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO keyboard_layouts (file_name, layout_data) VALUES (?, ?)', (file_name, json.dumps(layout_data)))
-    conn.commit()
-    conn.close()
-    
+    total_pages = layout_data["total_pages"]
+    # 删除多余的页和写入新页在同一个事务里提交
+    await db.batch([
+        (
+            'delete_keyboard_layout_pages',
+            'DELETE FROM keyboard_layout_pages WHERE file_name = ? AND page_number > ?',
+            (file_name, total_pages),
+            False,
+        ),
+        (
+            'store_keyboard_layout',
+            'INSERT OR REPLACE INTO keyboard_layout_pages (file_name, page_number, total_pages, keyboard) VALUES (?, ?, ?, ?)',
+            layout_page_rows(file_name, layout_data),
+            True,
+        ),
+    ])
+    layout_cache.set(file_name, {
+        "total_pages": total_pages,
+        "pages": {page["page_number"]: build_keyboard_markup(page["keyboard"]) for page in layout_data["pages"]},
+    })
+
     logging.info(f"Keyboard layout data stored for {file_name}")
 
-def get_keyboard_layout(file_name, page=1):
+async def get_keyboard_layout(file_name, page=1):
+    """获取指定页的键盘，优先从内存缓存读取，只在未命中时查询该页的数据库记录。"""
     if file_name is None or not isinstance(file_name, str):
         logging.error("Invalid file_name: cannot get keyboard layout for None or non-string value")
         return None
     if not file_name.endswith(".zip"):
         file_name += ".zip"
-    conn = sqlite3.connect('file_cache.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT layout_data FROM keyboard_layouts WHERE file_name = ?', (file_name,))
-    result = cursor.fetchone()
-    conn.close()
-    if result:
-        layout_data = json.loads(result[0])
-        if page <= layout_data["total_pages"]:
-            return layout_data["pages"][page - 1]["keyboard"]
-    return None
-    
-@cached(ttl=60)
-async def cache_subscription_status():
-    return True
+    if page < 1:
+        return None
+
+    entry = layout_cache.get(file_name)
+    if entry is not None:
+        if page > entry["total_pages"]:
+            return None
+        markup = entry["pages"].get(page)
+        if markup is not None:
+            CACHE_LOOKUPS.inc(cache="keyboard_layouts", result="hit")
+            return markup
+
+    result = await db.fetchone(
+        'get_keyboard_layout',
+        'SELECT total_pages, keyboard FROM keyboard_layout_pages WHERE file_name = ? AND page_number = ?',
+        (file_name, page),
+    )
+    if not result:
+        CACHE_LOOKUPS.inc(cache="keyboard_layouts", result="miss")
+        return None
+    CACHE_LOOKUPS.inc(cache="keyboard_layouts", result="hit")
+    total_pages, keyboard = result
+    markup = build_keyboard_markup(json.loads(keyboard))
+    if entry is None:
+        entry = {"total_pages": total_pages, "pages": {}}
+        layout_cache.set(file_name, entry)
+    entry["pages"][page] = markup
+    return markup
+
+async def fetch_subscription(user_id):
+    """向 Bot API 查询用户是否订阅了频道并缓存结果，查询失败时返回 None 且不缓存。"""
+    try:
+        member = await api.call(bot.get_chat_member, CHANNEL_USERNAME, user_id)
+    except Exception as e:
+        logging.error(f"Failed to check user subscription for user {user_id}: {e}")
+        return None
+    subscribed = member.status in ['member', 'administrator', 'creator']
+    subscription_cache.set(user_id, subscribed, ttl=None if subscribed else SUBSCRIPTION_NEGATIVE_TTL)
+    return subscribed
 
 async def check_user_subscription(user_id):
-    async with httpx.AsyncClient() as client:
-        try:
-            member = await bot.get_chat_member(CHANNEL_USERNAME, user_id)
-            if member.status in ['member', 'administrator', 'creator']:
-                return await cache_subscription_status()
-        except Exception as e:
-            logging.error(f"Failed to check user subscription for user {user_id}: {e}")
-    return False
+    subscribed = subscription_cache.get(user_id)
+    if subscribed is None:
+        subscribed, _ = await subscription_flight.do(user_id, fetch_subscription, user_id)
+    return bool(subscribed)
+
+async def resolve_rom_file_name(url):
+    """通过一次 Range 请求异步获取 ROM 文件名，结果按 URL 缓存。
+
+    与 url_probe 探测时使用相同的命名规则（file_check.build_filename），但只发出一个请求，
+    并且不会阻塞事件循环。
+
+    Returns:
+        str: ROM 文件名；请求失败时返回 None。
+    """
+    file_name = rom_file_name_cache.get(url)
+    if file_name:
+        return file_name
+
+    try:
+        async with http_client.stream(
+            'GET',
+            url,
+            headers={'Range': 'bytes=0-0'},
+            follow_redirects=True,
+            timeout=FILENAME_RESOLVE_TIMEOUT,
+        ) as response:
+            if response.status_code not in (200, 206):
+                logging.warning(f"Failed to resolve file name for {url}: HTTP {response.status_code}")
+                return None
+            content_disposition = response.headers.get('Content-Disposition')
+    except httpx.HTTPError as e:
+        logging.warning(f"Failed to resolve file name for {url}: {e}")
+        return None
+
+    file_name = file_check.build_filename(url, content_disposition)
+    if file_name:
+        rom_file_name_cache.set(url, file_name)
+    return file_name
 
 def is_valid_url(url):
     try:
@@ -336,9 +350,7 @@ def is_valid_url(url):
         return False
 
 async def get_user_lock(user_id):
-    if user_id not in user_locks:
-        user_locks[user_id] = asyncio.Lock()
-    return user_locks[user_id]
+    return user_data_store.lock(user_id)
 
 async def handle_url(update: Update, context: CallbackContext):
     if update.message and update.message.new_chat_members:
@@ -352,15 +364,11 @@ async def handle_url(update: Update, context: CallbackContext):
     user_lock = await get_user_lock(user_id)
     async with user_lock:
         # 清空之前的文件名和分区名
-        if user_id in user_data_store:
-            user_data_store[user_id].pop("file_name", None)
-            user_data_store[user_id].pop("partition_name", None)
-            user_data_store[user_id].pop("partitions_info", None)
-            user_data_store[user_id].pop("partition_file_path", None)
-            user_data_store[user_id].pop("ROM_file_name", None)
-
-        if user_id not in user_data_store:
-            user_data_store[user_id] = {}
+        user_data_store[user_id].pop("file_name", None)
+        user_data_store[user_id].pop("partition_name", None)
+        user_data_store[user_id].pop("partitions_info", None)
+        user_data_store[user_id].pop("partition_file_path", None)
+        user_data_store[user_id].pop("ROM_file_name", None)
 
     logging.info(f"Received message from user: {update.message.text}")
     text = update.message.text.strip()
@@ -392,21 +400,22 @@ async def handle_url(update: Update, context: CallbackContext):
             f"The link you provided has been officially speed-limited by Xiaomi and has been replaced with a high-speed CDN link.\n\n你提供的链接被小米官方限速，已替换为高速CDN链接。\n\nCDN URL: \n<code>{url}</code>",
         )
 
+    ROM_file_name = await resolve_rom_file_name(url)
     async with user_lock:
         user_data_store[user_id]["url"] = url
-        user_data_store[user_id]["ROM_file_name"] = file_check.get_filename_from_url(url)
+        user_data_store[user_id]["ROM_file_name"] = ROM_file_name
 
     file_name = os.path.basename(url)
     user_data_store[user_id]["file_name"] = file_name
 
     if file_name:
-        layout_data = get_keyboard_layout(user_data_store[user_id]["ROM_file_name"])
+        layout_data = await get_keyboard_layout(user_data_store[user_id]["ROM_file_name"])
         if layout_data:
             logging.info("Found stored keyboard layout, using it.")
             await send_inline_message(
                 update.message.chat_id,
                 display_message(url=user_data_store[user_id]["url"], file_name=file_name),
-                InlineKeyboardMarkup(layout_data)
+                layout_data
             )
             return
 
@@ -440,11 +449,6 @@ async def help(update: Update, context: CallbackContext):
         )
         return
 
-    user_lock = await get_user_lock(user_id)
-    async with user_lock:
-        if user_id not in user_data_store:
-            user_data_store[user_id] = {}
-
     logging.info("Help command received.")
     help_message = (
         "Help:\n"
@@ -466,18 +470,30 @@ async def help(update: Update, context: CallbackContext):
         help_message
     )
 
+async def find_partition_info(partitions_info, ROM_file_name, partition_name):
+    """查找分区信息。键盘布局来自缓存时会话中没有分区列表，改为读取 --list 生成的分区文件。"""
+    if not partitions_info and ROM_file_name:
+        path = os.path.join("output", "partitions", f"{ROM_file_name}.json")
+
+        def load():
+            with open(path, "r") as f:
+                return json.load(f)
+
+        try:
+            partitions_info = await asyncio.to_thread(load)
+        except (IOError, json.JSONDecodeError):
+            return None
+    return next((p for p in partitions_info if p.get("partition_name") == partition_name), None)
+
 async def button_callback(update: Update, context: CallbackContext):
     if not update.callback_query or not update.callback_query.from_user:
         logging.warning("button_callback: Received update without callback_query or from_user.")
         return
 
     query = update.callback_query
-    await query.answer()
+    await api.call(query.answer, chat=query.message.chat.id if query.message else None)
     user_id = query.from_user.id
     user_lock = await get_user_lock(user_id)
-    async with user_lock:
-        if user_id not in user_data_store:
-            user_data_store[user_id] = {}
 
     logging.info(f"Button callback received: {query.data}")
 
@@ -498,17 +514,12 @@ async def button_callback(update: Update, context: CallbackContext):
             return
 
         # 从数据库中读取键盘布局数据
-        keyboard = get_keyboard_layout(ROM_file_name, 1)
-        if keyboard is None:
+        reply_markup = await get_keyboard_layout(ROM_file_name, 1)
+        if reply_markup is None:
             logging.warning("No stored keyboard layout found, regenerating layout.")
             await run_payload_dumper_command(update, context, "--list", [url])
         else:
             logging.info(f"Found stored keyboard layout for {ROM_file_name}, using it.")
-            reply_markup = InlineKeyboardMarkup([
-                [InlineKeyboardButton(**button) for button in row]
-                for row in keyboard
-            ])
-
             await edit_message(
                 query.message.chat.id,
                 query.message.message_id,
@@ -521,14 +532,8 @@ async def button_callback(update: Update, context: CallbackContext):
         logging.info(f"Current file name: {file_name}")
         logging.info(f"Requested page: {requested_page}")
 
-        keyboard = get_keyboard_layout(ROM_file_name, requested_page)
-        logging.info(f"Layout data for {ROM_file_name} page {requested_page}: {keyboard}")
-        if keyboard:
-            reply_markup = InlineKeyboardMarkup([
-                [InlineKeyboardButton(**button) for button in row]
-                for row in keyboard
-            ])
-
+        reply_markup = await get_keyboard_layout(ROM_file_name, requested_page)
+        if reply_markup:
             await edit_message(
                 query.message.chat.id,
                 query.message.message_id,
@@ -560,6 +565,7 @@ async def button_callback(update: Update, context: CallbackContext):
             query.message.chat.id,
             query.message.message_id,
             f"{display_message(url=user_data_store[user_id]['url'], file_name=file_name, partition_name=user_data_store[user_id].get('partition_name'))}\nFetching metadata, please wait...\n正在获取元数据，请稍候...",
+            final=False,
         )
         logging.info(f"Running payload_dumper command with --metadata argument for URL: {url}")
         await run_payload_dumper_command(update, context, "--metadata", [url])
@@ -575,97 +581,143 @@ async def button_callback(update: Update, context: CallbackContext):
                 text=f"{display_message(url=user_data_store[user_id]['url'], file_name=file_name, partition_name=user_data_store[user_id].get('partition_name'))}\nServer restricted, partition {partition_name} is not supported.\n\n由于服务器限制，不支持'{partition_name}'分区",
                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("返回", callback_data="return")]]),
             )
-        else:
+            return
+
+        partition_info = await find_partition_info(partitions_info, ROM_file_name, partition_name)
+        if partition_info and partition_info.get("oversize"):
+            # 预测压缩后必然超过上传上限，不再排队下载
+            predicted = format_size(partition_info["predicted_size"])
+            logging.info(f"Refusing partition '{partition_name}': predicted compressed size {predicted}")
             await edit_message(
                 query.message.chat.id,
                 query.message.message_id,
-                f"{display_message(url=user_data_store[user_id]['url'], file_name=file_name, partition_name=partition_name)}\nDumping partition '{partition_name}', please wait...\n正在提取分区 '{partition_name}'，请稍候...",
+                text=f"{display_message(url=user_data_store[user_id]['url'], file_name=file_name, partition_name=partition_name)}\nPartition '{partition_name}' is expected to exceed {format_size(size_predictor.SIZE_LIMIT)} after compression (about {predicted}), unable to upload.\n\n分区 '{partition_name}' 压缩后预计超过 {format_size(size_predictor.SIZE_LIMIT)}（约 {predicted}），无法上传。",
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("返回", callback_data="return")]]),
             )
-            logging.info(f"Running payload_dumper command with --dump argument for URL: {url} and partition: {partition_name}")
-            await run_payload_dumper_command(update, context, "--dump", [url, partition_name])
+            return
+
+        if ROM_file_name:
+            # 已有产物时直接发送，不排队、不启动任务、不访问 ROM 链接
+            artifact_name = f"{partition_name}_{ROM_file_name}.zip"
+            artifact_path = os.path.join("output", "zip", partition_name, artifact_name)
+            parts = None
+            found = await find_cached_artifact(artifact_path)
+            if not found:
+                parts = await find_cached_parts(artifact_path)
+            # 每次点击只在这里统计一次产物缓存命中，任务输出中的 cached/dump 事件不再重复统计
+            CACHE_LOOKUPS.inc(cache="artifact", result="hit" if found or parts else "miss")
+            if found or parts:
+                logging.info(f"Serving cached artifact {artifact_name} without starting a job")
+                async with user_lock:
+                    user_data_store[user_id]["partition_name"] = partition_name
+                    user_data_store[user_id]["file_name"] = artifact_name
+                if await send_artifact(query.message, query.message.chat.id, user_id, artifact_path, artifact_name, parts):
+                    return
+                # file_id 已失效且本地文件已被淘汰，继续提取
+
+        await edit_message(
+            query.message.chat.id,
+            query.message.message_id,
+            f"{display_message(url=user_data_store[user_id]['url'], file_name=file_name, partition_name=partition_name)}\nDumping partition '{partition_name}', please wait...\n正在提取分区 '{partition_name}'，请稍候...",
+            final=False,
+        )
+        logging.info(f"Running payload_dumper command with --dump argument for URL: {url} and partition: {partition_name}")
+        await run_payload_dumper_command(update, context, "--dump", [url, partition_name])
 
 
-def get_file_id(file_name):
-    conn = sqlite3.connect('file_cache.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT file_id FROM file_cache WHERE file_name = ?', (file_name,))
-    result = cursor.fetchone()
-    conn.close()
+async def get_file_id(file_name):
+    result = await db.fetchone(
+        'get_file_id',
+        'SELECT file_id FROM file_cache WHERE file_name = ?',
+        (file_name,),
+    )
     return result[0] if result else None
 
 # 存储文件ID
-def store_file_id(file_name, file_id):
-    conn = sqlite3.connect('file_cache.db')
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO file_cache (file_name, file_id) VALUES (?, ?)', (file_name, file_id))
-    conn.commit()
-    conn.close()
-    
+async def store_file_id(file_name, file_id):
+    await db.execute(
+        'store_file_id',
+        'INSERT OR REPLACE INTO file_cache (file_name, file_id) VALUES (?, ?)',
+        (file_name, file_id),
+    )
+
+async def find_cached_artifact(file_path):
+    """不启动任务直接查找产物：本地文件存在或已有 file_id 时返回 True，与工作进程共用 artifact_cache.lookup。"""
+    return await db.call('artifact_lookup', artifact_cache.lookup, file_path, True)
+
+async def find_cached_parts(file_path):
+    """查找分卷产物：每一卷都有 file_id 或本地文件时返回各分卷路径。"""
+    parts = await asyncio.to_thread(split_archive.read_parts, file_path)
+    if not parts:
+        return None
+    for part in parts:
+        if not await find_cached_artifact(part):
+            return None
+    return parts
+
+async def delete_file_id(file_name):
+    await db.execute(
+        'delete_file_id',
+        'DELETE FROM file_cache WHERE file_name = ?',
+        (file_name,),
+    )
+
 async def handle_subprocess_output(process, status_message, update, context, command):
     file_path = None
     file_name = None
-    multi_line_message = False
-    message_buffer = []
-
-    async def read_stream(stream):
-        while True:
-            output = await stream.readline()
-            if output:
-                output_str = output.decode().strip()
-                logging.error(f"Subprocess {stream.pipe} output: {output_str}")
-            else:
-                break
+    parts = None
 
-    asyncio.create_task(read_stream(process.stderr))
+    async def drain(stream):
+        # 标准错误已由 job_observer 按任务记录，这里只读空缓冲区
+        while await stream.readline():
+            pass
+
+    spawn(drain(process.stderr))
 
     user_id = update.message.from_user.id if update.message else update.callback_query.from_user.id
     chat_id = update.message.chat.id if update.message else update.callback_query.message.chat.id
 
+    progress = {}  # 阶段 -> 该阶段最新的进度事件
+
     while True:
-        try:
-            output = await asyncio.wait_for(process.stdout.readline(), timeout=0.1)
-        except asyncio.TimeoutError:
+        output = await process.stdout.readline()
+        if not output:
+            break
+        output_str = output.decode().strip()
+        event = events.decode(output_str)
+        if event is None:
             continue
 
-        if output:
-            output_str = output.decode().strip()
-            logging.info(f"Subprocess output: {output_str}")
-            if output_str.startswith("STATUS:"):
-                multi_line_message = True
-                output_str = output_str[7:]
-            elif output_str.startswith("ERROR:"):
-                multi_line_message = True
-                output_str = output_str[6:]
-                logging.error(output_str)
-            elif output_str.startswith("STATUS_END") or output_str.startswith("ERROR_END"):
-                multi_line_message = False
-                message = "\n".join(message_buffer[1:])
-                if output_str.startswith("ERROR_END"):
-                    logging.error(message)
-                else:
-                    logging.info(message)
-                await edit_message(
-                    chat_id,
-                    status_message.message_id,
-                    f"{display_message(url=user_data_store[user_id]['url'], file_name=user_data_store[user_id].get("file_name"), partition_name=user_data_store[user_id]['partition_name'])}\n{message}",
-                )
-                message_buffer = []
-                if output_str.startswith("ERROR_END"):
-                    return
-            elif output_str.startswith("FILE:"):
-                file_path = output_str.split(":", 1)[1].strip()
-                logging.info(f"File path received: {file_path}")
-                if file_path.startswith("output/partitions/"):
-                    file_name = os.path.splitext(os.path.basename(file_path))[0]
-                else:
-                    file_name = os.path.basename(file_path)
-                logging.info(f"Setting file name: {file_name}")
-                async with user_locks[user_id]:
-                    user_data_store[user_id]["file_name"] = file_name
-                break
-            if multi_line_message:
-                message_buffer.append(output_str)
-        else:
+        kind = event["event"]
+        if kind == events.PROGRESS:
+            progress[event["stage"]] = event
+            await edit_message(
+                chat_id,
+                status_message.message_id,
+                f"{display_message(url=user_data_store[user_id]['url'], file_name=user_data_store[user_id].get('file_name'), partition_name=user_data_store[user_id]['partition_name'])}\n{format_progress(progress)}",
+                final=False,
+            )
+        elif kind in (events.STATUS, events.ERROR):
+            message = event["message"]
+            await edit_message(
+                chat_id,
+                status_message.message_id,
+                f"{display_message(url=user_data_store[user_id]['url'], file_name=user_data_store[user_id].get('file_name'), partition_name=user_data_store[user_id]['partition_name'])}\n{message}",
+                final=kind == events.ERROR,
+            )
+            if kind == events.ERROR:
+                return
+        elif kind == events.ARTIFACT:
+            file_path = event["path"]
+            parts = event.get("parts")
+            logging.info(f"File path received: {file_path}")
+            if file_path.startswith("output/partitions/"):
+                file_name = os.path.splitext(os.path.basename(file_path))[0]
+            else:
+                file_name = os.path.basename(file_path)
+            logging.info(f"Setting file name: {file_name}")
+            async with await get_user_lock(user_id):
+                user_data_store[user_id]["file_name"] = file_name
             break
 
     return_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Return", callback_data="return")]])
@@ -676,43 +728,23 @@ async def handle_subprocess_output(process, status_message, update, context, com
                 chat_id,
                 status_message.message_id,
                 f"{display_message(url=user_data_store[user_id]['url'], file_name=user_data_store[user_id]['file_name'])}\nLoading partition, please wait...\n正在加载分区，请稍候...",
+                final=False,
             )
             with open(file_path, "r") as f:
                 partitions_info = json.load(f)
-            async with user_locks[user_id]:
+            async with await get_user_lock(user_id):
                 user_data_store[user_id]["partitions_info"] = partitions_info
                 user_data_store[user_id]["partition_file_path"] = file_path
 
-            layout_data = {
-                "file_name": file_name,
-                "total_pages": 1,
-                "pages": []
-            }
-            page_number = 1
-            while True:
-                keyboard, total_pages = create_partition_keyboard(partitions_info, page=page_number)
-                layout_data["pages"].append({
-                    "page_number": page_number,
-                    "keyboard": [[button.to_dict() for button in row] for row in keyboard]
-                })
-                layout_data["total_pages"] = total_pages
-                if page_number >= total_pages:
-                    break
-                page_number += 1
-
-            store_keyboard_layout(user_data_store[user_id]["ROM_file_name"], layout_data)
+            layout_data = keyboard_layout.build_layout(partitions_info, file_name)
+            await store_keyboard_layout(user_data_store[user_id]["ROM_file_name"], layout_data)
 
             logging.info(f"Attempting to retrieve keyboard layout for {user_data_store[user_id]['ROM_file_name']}")
-            keyboard = get_keyboard_layout(user_data_store[user_id]["ROM_file_name"], 1)
-            if keyboard is None:
+            reply_markup = await get_keyboard_layout(user_data_store[user_id]["ROM_file_name"], 1)
+            if reply_markup is None:
                 logging.error(f"Failed to retrieve keyboard layout for {user_data_store[user_id]['ROM_file_name']} page 1")
             else:
-                logging.info(f"Retrieved layout data for {user_data_store[user_id]['ROM_file_name']} page 1: {keyboard}")
-                reply_markup = InlineKeyboardMarkup([
-                    [InlineKeyboardButton(**button) for button in row]
-                    for row in keyboard
-                ])
-
+                logging.info(f"Retrieved layout data for {user_data_store[user_id]['ROM_file_name']} page 1")
                 await edit_message(
                     chat_id,
                     status_message.message_id,
@@ -745,81 +777,316 @@ async def handle_subprocess_output(process, status_message, update, context, com
                 reply_markup=return_markup,
             )
     elif file_path:
+        if not await send_artifact(status_message, chat_id, user_id, file_path, file_name, parts):
+            # 任务报告的缓存产物已不可用（file_id 已删除），重新提取。先等任务结束并移出
+            # inflight_jobs，避免加入同一个已完成的任务
+            await process.wait()
+            await run_payload_dumper_command(
+                update, context, "--dump", [user_data_store[user_id]['url'], user_data_store[user_id]['partition_name']],
+            )
+    else:
+        logging.error("Payload dumper execution failed.")
+        await edit_message(
+            chat_id,
+            status_message.message_id,
+            f"{display_message(url=user_data_store[user_id]['url'], file_name=user_data_store[user_id].get('file_name'), partition_name=user_data_store[user_id].get('partition_name'))}\nPayload dumper execution failed.\nPayload dumper 执行失败。",
+            reply_markup=return_markup,
+        )
+
+async def send_part(status_message, chat_id, part_path, index, total):
+    """发送一个分卷，成功返回 True。每个分卷的 file_id 单独缓存。"""
+    part_name = os.path.basename(part_path)
+    cached_file_id = await get_file_id(part_name)
+    CACHE_LOOKUPS.inc(cache="file_id", result="hit" if cached_file_id else "miss")
+    if cached_file_id:
         try:
-            if os.path.getsize(file_path) == 0:
-                raise ValueError("File is empty")
-            
-            # Check for cached file ID
-            cached_file_id = get_file_id(file_name)
-            if cached_file_id:
-                await bot.send_document(chat_id=chat_id, document=cached_file_id)
-                await edit_message(
-                    chat_id,
-                    status_message.message_id,
-                    f"{display_message(url=user_data_store[user_id]['url'], file_name=user_data_store[user_id].get('file_name'), partition_name=user_data_store[user_id]['partition_name'])}\nFile sent successfully.\n文件上传成功。",
-                    reply_markup=return_markup,
-                )
-                return
+            await api.call(bot.send_document, chat_id=chat_id, document=cached_file_id, priority=PRIORITY_HIGH)
+            return True
+        except BadRequest as e:
+            logging.warning(f"Cached file_id for {part_name} is no longer valid: {e}")
+            await delete_file_id(part_name)
+    if part_name not in upload_flight and not await asyncio.to_thread(os.path.isfile, part_path):
+        raise FileNotFoundError(f"Part {index}/{total} was evicted: {part_path}")
+
+    async def upload(document):
+        message = await api.call(
+            bot.send_document, chat_id=chat_id, document=document, priority=PRIORITY_HIGH, upload=True
+        )
+        return message.document.file_id
 
-            async def send_document():
-                with open(file_path, "rb") as f:
-                    await edit_message(
-                        chat_id,
-                        status_message.message_id,
-                        f"{display_message(url=user_data_store[user_id]['url'], file_name=user_data_store[user_id].get('file_name'), partition_name=user_data_store[user_id]['partition_name'])}\nUploading...\n上传中...",
-                    )
-                    message = await bot.send_document(chat_id=chat_id, document=f)
-                    return message.document.file_id
+    async def send_document():
+        if await asyncio.to_thread(os.path.getsize, part_path) == 0:
+            raise ValueError(f"Part {index}/{total} is empty")
+        return await upload_pool.run(part_path, upload)
 
+    async def upload_document():
+        try:
             file_id = await retry_async(
                 chat_id,
                 status_message.message_id,
                 send_document,
-                retry_msg="Error occurred while sending document.",
+                retry_msg=f"Error occurred while sending part {index}/{total}.",
             )
-            if file_id:
-                logging.info("File uploaded successfully.")
-                store_file_id(file_name, file_id)
+        except Exception as e:
+            logging.error(f"Failed to upload {part_name}: {e}")
+            return None
+        if file_id:
+            await store_file_id(part_name, file_id)
+        return file_id
+
+    file_id, shared = await upload_flight.do(part_name, upload_document)
+    if file_id and shared:
+        await api.call(bot.send_document, chat_id=chat_id, document=file_id, priority=PRIORITY_HIGH)
+    return file_id is not None
+
+async def send_parts(status_message, chat_id, user_id, parts):
+    """并行发送分卷产物的所有分卷，有分卷既没有有效 file_id 也没有本地文件时返回 False。"""
+    return_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Return", callback_data="return")]])
+    header = display_message(
+        url=user_data_store[user_id]['url'],
+        file_name=user_data_store[user_id].get('file_name'),
+        partition_name=user_data_store[user_id].get('partition_name'),
+    )
+    total = len(parts)
+    await edit_message(
+        chat_id,
+        status_message.message_id,
+        f"{header}\nUploading {total} parts...\n正在上传 {total} 个分卷...",
+        final=False,
+    )
+    results = await asyncio.gather(
+        *(send_part(status_message, chat_id, part, index, total) for index, part in enumerate(parts, start=1)),
+        return_exceptions=True,
+    )
+    if any(isinstance(result, FileNotFoundError) for result in results):
+        logging.warning(f"Parts of {user_data_store[user_id].get('file_name')} were evicted: {results}")
+        return False
+    failed = [index for index, ok in enumerate(results, start=1) if ok is not True]
+    if failed:
+        logging.error(f"Failed to upload parts {failed} of {user_data_store[user_id].get('file_name')}: {results}")
+        text = (
+            f"{header}\nFailed to upload part(s) {', '.join(map(str, failed))} of {total}.\n"
+            f"第 {', '.join(map(str, failed))} 卷上传失败（共 {total} 卷）。"
+        )
+    else:
+        text = (
+            f"{header}\nAll {total} parts uploaded. Open them with 7-Zip, or join with <code>cat *.zip.0* &gt; file.zip</code>.\n"
+            f"{total} 个分卷已全部上传。可用 7-Zip 直接解压，或用 <code>cat *.zip.0* &gt; file.zip</code> 合并。"
+        )
+    await edit_message(chat_id, status_message.message_id, text, reply_markup=return_markup)
+    return True
+
+async def send_artifact(status_message, chat_id, user_id, file_path, file_name, parts=None):
+    """发送产物：优先使用缓存的 file_id，否则上传本地文件并记录 file_id。
+
+    Returns:
+        bool: file_id 失效且本地文件已被淘汰时返回 False，需要重新提取；其余情况返回 True。
+    """
+    return_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Return", callback_data="return")]])
+    if parts:
+        return await send_parts(status_message, chat_id, user_id, parts)
+    try:
+        # Check for cached file ID
+        # 本地产物可能已被淘汰，只要 file_id 有效就不需要本地文件
+        cached_file_id = await get_file_id(file_name)
+        CACHE_LOOKUPS.inc(cache="file_id", result="hit" if cached_file_id else "miss")
+        if cached_file_id:
+            try:
+                await api.call(bot.send_document, chat_id=chat_id, document=cached_file_id, priority=PRIORITY_HIGH)
+            except BadRequest as e:
+                logging.warning(f"Cached file_id for {file_name} is no longer valid: {e}")
+                await delete_file_id(file_name)
+            else:
                 await edit_message(
                     chat_id,
                     status_message.message_id,
-                    f"{display_message(url=user_data_store[user_id]['url'], file_name=user_data_store[user_id].get('file_name'), partition_name=user_data_store[user_id]['partition_name'])}\nFile uploaded successfully.\n文件上传成功。",
+                    f"{display_message(url=user_data_store[user_id]['url'], file_name=user_data_store[user_id].get('file_name'), partition_name=user_data_store[user_id]['partition_name'])}\nFile sent successfully.\n文件上传成功。",
                     reply_markup=return_markup,
                 )
-                return  # Ensure we return here to avoid error message
-                
-            else:
-                logging.error("Failed to upload file.")
-                await edit_message(
+                return True
+
+        if os.path.getsize(file_path) == 0:
+            raise ValueError("File is empty")
+
+        def show_upload_position(position):
+            spawn(edit_message(
+                chat_id,
+                status_message.message_id,
+                f"{display_message(url=user_data_store[user_id]['url'], file_name=user_data_store[user_id].get('file_name'), partition_name=user_data_store[user_id]['partition_name'])}\nWaiting to upload... {position} ahead\n等待上传...前方还有{position}个文件",
+                final=False,
+            ))
+
+        async def upload(document):
+            await edit_message(
+                chat_id,
+                status_message.message_id,
+                f"{display_message(url=user_data_store[user_id]['url'], file_name=user_data_store[user_id].get('file_name'), partition_name=user_data_store[user_id]['partition_name'])}\nUploading...\n上传中...",
+                final=False,
+            )
+            message = await api.call(
+                bot.send_document, chat_id=chat_id, document=document, priority=PRIORITY_HIGH, upload=True
+            )
+            return message.document.file_id
+
+        async def send_document():
+            # 每次尝试单独排队，重试等待期间不占用上传槽位
+            return await upload_pool.run(file_path, upload, show_upload_position)
+
+        async def upload_document():
+            try:
+                file_id = await retry_async(
                     chat_id,
                     status_message.message_id,
-                    f"{display_message(url=user_data_store[user_id]['url'], file_name=user_data_store[user_id].get('file_name'), partition_name=user_data_store[user_id]['partition_name'])}\nFailed to upload file.\n文件上传失败。",
-                    reply_markup=return_markup,
+                    send_document,
+                    retry_msg="Error occurred while sending document.",
                 )
-        except IOError as e:
-            logging.error(f"Error reading file: {e}")
+            except Exception as e:
+                # retry_async 已经在状态消息中提示了失败
+                logging.error(f"Failed to upload {file_name}: {e}")
+                return None
+            if file_id:
+                await store_file_id(file_name, file_id)
+            return file_id
+
+        if file_name in upload_flight:
+            await edit_message(
+                chat_id,
+                status_message.message_id,
+                f"{display_message(url=user_data_store[user_id]['url'], file_name=user_data_store[user_id].get('file_name'), partition_name=user_data_store[user_id]['partition_name'])}\nUploading...\n上传中...",
+                final=False,
+            )
+        file_id, shared = await upload_flight.do(file_name, upload_document)
+        if file_id and shared:
+            # 其他用户已经上传了同一个文件，直接复用 file_id 发送
+            await api.call(bot.send_document, chat_id=chat_id, document=file_id, priority=PRIORITY_HIGH)
+        if file_id:
+            logging.info("File uploaded successfully.")
             await edit_message(
                 chat_id,
                 status_message.message_id,
-                f"{display_message(url=user_data_store[user_id]['url'], file_name=user_data_store[user_id].get('file_name'), partition_name=user_data_store[user_id].get('partition_name'))}\nError reading file: {e}\n读取文件时出错: {e}",
+                f"{display_message(url=user_data_store[user_id]['url'], file_name=user_data_store[user_id].get('file_name'), partition_name=user_data_store[user_id]['partition_name'])}\nFile uploaded successfully.\n文件上传成功。",
                 reply_markup=return_markup,
             )
-        except ValueError as e:
-            logging.error(f"Error: {e}")
+            return True  # Ensure we return here to avoid error message
+
+        elif shared:
+            logging.error("Failed to upload file.")
             await edit_message(
                 chat_id,
                 status_message.message_id,
-                f"{display_message(url=user_data_store[user_id]['url'], file_name=user_data_store[user_id].get('file_name'), partition_name=user_data_store[user_id].get('partition_name'))}\nError: {e}\n错误: {e}",
+                f"{display_message(url=user_data_store[user_id]['url'], file_name=user_data_store[user_id].get('file_name'), partition_name=user_data_store[user_id]['partition_name'])}\nFailed to upload file.\n文件上传失败。",
                 reply_markup=return_markup,
             )
-    else:
-        logging.error("Payload dumper execution failed.")
+    except FileNotFoundError:
+        logging.warning(f"Artifact {file_name} has no valid file_id and its local file was evicted")
+        return False
+    except IOError as e:
+        logging.error(f"Error reading file: {e}")
         await edit_message(
             chat_id,
             status_message.message_id,
-            f"{display_message(url=user_data_store[user_id]['url'], file_name=user_data_store[user_id].get('file_name'), partition_name=user_data_store[user_id].get('partition_name'))}\nPayload dumper execution failed.\nPayload dumper 执行失败。",
+            f"{display_message(url=user_data_store[user_id]['url'], file_name=user_data_store[user_id].get('file_name'), partition_name=user_data_store[user_id].get('partition_name'))}\nError reading file: {e}\n读取文件时出错: {e}",
             reply_markup=return_markup,
         )
+    except ValueError as e:
+        logging.error(f"Error: {e}")
+        await edit_message(
+            chat_id,
+            status_message.message_id,
+            f"{display_message(url=user_data_store[user_id]['url'], file_name=user_data_store[user_id].get('file_name'), partition_name=user_data_store[user_id].get('partition_name'))}\nError: {e}\n错误: {e}",
+            reply_markup=return_markup,
+        )
+    return True
+
+
+def queue_status_event(position):
+    return events.encode(
+        events.STATUS, stage="queue", message=f"Waiting in queue... {position} ahead\n排队中...前方还有{position}个任务",
+    )
+
+def job_observer(url):
+    """
+    记录任务输出并从事件中统计下载量和压缩耗时。
+
+    每个任务只调用一次，不随订阅者数量重复，日志带有任务的关联 ID。工作进程的标准错误
+    和非事件输出只是诊断信息，采样后按 INFO 记录；真正的失败以 error 事件上报，按 ERROR 记录。
+    """
+    origin = urlparse(url).hostname or "unknown"
+    samplers = {'stdout': structured_logging.LogSampler(), 'stderr': structured_logging.LogSampler()}
+
+    def observe(stream, line):
+        event = events.decode(line) if stream == 'stdout' else None
+        if event is None:
+            sampler = samplers[stream]
+            if sampler():
+                logging.info("Worker %s (%d lines skipped): %s", stream, sampler.dropped, line)
+            return
+        kind = event["event"]
+        if kind == events.ERROR:
+            logging.error("Job error %s: %s", event.get("code"), event["message"])
+        elif kind == events.STATUS:
+            logging.info("Job status: %s", event["message"])
+        elif kind == events.PROGRESS and event["done"] >= event["total"]:
+            if event["stage"] == "download":
+                DOWNLOAD_BYTES.inc(event["done"], origin=origin)
+            elif event["stage"] == "compress":
+                COMPRESS_SECONDS.observe(event.get("elapsed") or 0)
+
+    return observe
+
+async def drive_shared_job(shared, key, command, job_args, job_cid):
+    """排队、提交到工作进程池，并把输出广播给所有等待同一结果的用户。"""
+    structured_logging.bind(job_cid)
+    def show_queue_position(position):
+        shared.feed('stdout', queue_status_event(position))
+
+    holds_slot = False
+    try:
+        if command == "--dump":
+            queued_at = time.monotonic()
+            await extraction_scheduler.acquire(show_queue_position)
+            QUEUE_WAIT.observe(time.monotonic() - queued_at)
+            holds_slot = True
+        started = time.monotonic()
+        job = worker_pool.submit(command, job_args)
+        if holds_slot:
+            # 提取结束即释放槽位，上传不占用提取槽位
+            job.add_done_callback(extraction_scheduler.release)
+            holds_slot = False
+        logging.info(f"Job {job.id} submitted with command: {command} {job_args}")
+        await shared.pump(job)
+        JOB_DURATION.observe(
+            time.monotonic() - started, command=command.lstrip("-"), result="ok" if job.returncode == 0 else "error",
+        )
+    except Exception as e:
+        logging.error(f"Job {command} {job_args} failed: {e}")
+        shared.feed('stdout', events.encode(events.ERROR, code=events.INTERNAL, message=f"Job failed: {e}\n任务失败: {e}"))
+    finally:
+        if holds_slot:
+            extraction_scheduler.release()
+        shared.finish()
+        inflight_jobs.pop(key, None)
+
+def submit_job(key, command, job_args):
+    """提交任务，若相同任务正在执行则直接订阅它的输出。"""
+    shared = inflight_jobs.get(key)
+    if shared is None:
+        shared = SharedJob(observer=job_observer(job_args[-1]))
+        inflight_jobs[key] = shared
+        job_cid = structured_logging.new_id("job")
+        logging.info(f"Starting {job_cid} for in-flight job {key}")
+        spawn(drive_shared_job(shared, key, command, job_args, job_cid))
+    else:
+        logging.info(f"Joining in-flight job {key} with {shared.subscriber_count} subscribers")
+    return shared.subscribe()
+
+async def run_job(key, command, job_args, status_message, update, context):
+    try:
+        process = submit_job(key, command, job_args)
+        await handle_subprocess_output(process, status_message, update, context, command)
+    except Exception as e:
+        logging.error(f"Job {command} {job_args} failed: {e}")
+
 async def run_payload_dumper_command(update: Update, context: CallbackContext, command: str, args: list):
     url = args[0]
     if len(args) > 1:
@@ -830,8 +1097,6 @@ async def run_payload_dumper_command(update: Update, context: CallbackContext, c
     user_id = update.message.from_user.id if update.message else update.callback_query.from_user.id
     user_lock = await get_user_lock(user_id)
     async with user_lock:
-        if user_id not in user_data_store:
-            user_data_store[user_id] = {}
         # 在处理新 URL 时清空相关用户数据
         user_data_store[user_id]["file_name"] = None
         user_data_store[user_id]["partition_name"] = None
@@ -841,15 +1106,16 @@ async def run_payload_dumper_command(update: Update, context: CallbackContext, c
     logging.info(f"Running payload_dumper command: {command} with arguments: {args}")
 
     if update.message:
-        status_message = await update.message.reply_text(
+        status_message = await api.call(
+            update.message.reply_text,
+            chat=chat_id,
+            priority=PRIORITY_HIGH,
             text="Parsing...\n解析中...",
             reply_markup=InlineKeyboardMarkup([]),
         )
     else:
         status_message = update.callback_query.message
 
-    env = os.environ.copy()
-    env["PYTHONUNBUFFERED"] = "1"
     try:
         if partition:
             async with user_lock:
@@ -858,12 +1124,9 @@ async def run_payload_dumper_command(update: Update, context: CallbackContext, c
                 chat_id,
                 status_message.message_id,
                 display_message(url=url, file_name=None, partition_name=partition),
+                final=False,
             )
-            command_args = (
-                ["python3", "queue_scripts.py", command]
-                + [f"{partition}"]
-                + [f'"{url}"']
-            )
+            job_args = [partition, url]
         else:
             async with user_lock:
                 user_data_store[user_id]["partition_name"] = None
@@ -871,16 +1134,14 @@ async def run_payload_dumper_command(update: Update, context: CallbackContext, c
                 chat_id,
                 status_message.message_id,
                 display_message(url=url, file_name=None),
+                final=False,
             )
-            command_args = ["python3", "concurrent_scripts.py", command] + [f'"{url}"']
-
-        process = await asyncio.create_subprocess_exec(
-            *command_args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, env=env
-        )
-
-        logging.info(f"Subprocess created with command: {command_args}")
+            job_args = [url]
 
-        asyncio.create_task(handle_subprocess_output(process, status_message, update, context, command))
+        async with user_lock:
+            ROM_file_name = user_data_store[user_id].get("ROM_file_name")
+        key = (command, ROM_file_name or url, partition)
+        spawn(run_job(key, command, job_args, status_message, update, context))
 
     except Exception as e:
         logging.error(f"An error occurred: {e}")
@@ -894,31 +1155,123 @@ async def run_payload_dumper_command(update: Update, context: CallbackContext, c
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    webhook_url = f"https://api.telegram.org/bot{TOKEN}/setWebhook"
+    webhook_url = f"{BOT_API_URL}{TOKEN}/setWebhook"
     data = {"url": WEBHOOK_URL}
-    async with http_client as client:
-        try:
-            response = await client.post(webhook_url, data=data)
-            response.raise_for_status()
-            logging.info(f"Webhook set successfully with URL: {WEBHOOK_URL}")
-        except httpx.RequestError as e:
-            logging.error(f"Failed to set webhook: {e}")
-    
+    try:
+        response = await http_client.post(webhook_url, data=data)
+        response.raise_for_status()
+        logging.info(f"Webhook set successfully with URL: {WEBHOOK_URL}")
+    except httpx.RequestError as e:
+        logging.error(f"Failed to set webhook: {e}")
+
+    added, removed, freed = await asyncio.to_thread(artifact_cache.reconcile)
+    logging.info(f"Artifact cache reconciled: {added} registered, {removed} removed, {freed} bytes freed")
+    await worker_pool.start()
+
     yield
 
+    await update_dispatcher.close()
+    await worker_pool.close()
+
     await http_client.aclose()  # 关闭全局http_client连接
+    await db.close()
 
 app = FastAPI(lifespan=lifespan)
 
+async def handle_update(update: Update):
+    structured_logging.bind(f"update-{update.update_id}")
+    context = CallbackContext.from_update(update, bot)
+    if update.message:
+        if update.message.text and (update.message.text == '/start' or update.message.text == '/help'):
+            await help(update, context)
+        else:
+            await handle_url(update, context)
+    elif update.callback_query:
+        await button_callback(update, context)
+    elif update.my_chat_member:
+        # 处理 my_chat_member 更新
+        logging.info(f"Received my_chat_member update: {update.my_chat_member}")
+        # 可以在此处添加更多处理逻辑，例如记录日志或执行某些操作
+
+update_dispatcher = UpdateDispatcher(handle_update)  # 同一用户的更新按顺序在后台处理
+
+# 各模块已有的计数器和状态在抓取时读取
+registry.gauge_callback('dumper_active_subprocesses', 'Worker processes currently running a job', lambda: worker_pool.busy)
+registry.gauge_callback(
+    'dumper_slots_in_use', 'Occupied slots by pool', lambda: {
+        ("extraction",): extraction_scheduler.active,
+        ("upload",): upload_pool.active,
+    }, ['pool'],
+)
+registry.gauge_callback(
+    'dumper_slots_waiting', 'Waiters by pool', lambda: {
+        ("extraction",): extraction_scheduler.waiting,
+        ("upload",): upload_pool.waiting,
+    }, ['pool'],
+)
+registry.counter_callback('dumper_upload_bytes_total', 'Bytes uploaded to Telegram', lambda: upload_pool.bytes_uploaded)
+registry.gauge_callback('dumper_telegram_api_queued', 'Bot API calls waiting in the scheduler', lambda: api.queued)
+registry.counter_callback(
+    'dumper_telegram_api_retry_after_total', 'RetryAfter responses from the Bot API', lambda: api.retry_after,
+)
+registry.counter_callback(
+    'dumper_message_edits_total', 'Status message edits by outcome', lambda: {
+        ("sent",): edit_coalescer.sent,
+        ("skipped",): edit_coalescer.skipped,
+        ("coalesced",): edit_coalescer.coalesced,
+    }, ['outcome'],
+)
+registry.counter_callback(
+    'dumper_cache_memory_lookups_total', 'In-memory cache lookups', lambda: {
+        ("layout", "hit"): layout_cache.hits,
+        ("layout", "miss"): layout_cache.misses,
+        ("rom_file_name", "hit"): rom_file_name_cache.hits,
+        ("rom_file_name", "miss"): rom_file_name_cache.misses,
+        ("subscription", "hit"): subscription_cache.hits,
+        ("subscription", "miss"): subscription_cache.misses,
+    }, ['cache', 'result'],
+)
+registry.counter_callback(
+    'dumper_db_queries_total', 'SQLite queries by name',
+    lambda: {(name,): stats[0] for name, stats in db.query_stats.items()}, ['query'],
+)
+registry.counter_callback(
+    'dumper_db_query_seconds_total', 'Total SQLite query time by name',
+    lambda: {(name,): stats[1] for name, stats in db.query_stats.items()}, ['query'],
+)
+registry.gauge_callback('dumper_sessions', 'User sessions held in memory', lambda: len(user_data_store))
+registry.gauge_callback(
+    'dumper_session_memory_bytes', 'Estimated memory held by user sessions',
+    lambda: user_data_store.stats()["memory_bytes"],
+)
+registry.counter_callback(
+    'dumper_sessions_removed_total', 'Sessions removed by reason', lambda: {
+        ("expired",): user_data_store.expired,
+        ("evicted",): user_data_store.evicted,
+    }, ['reason'],
+)
+registry.counter_callback(
+    'dumper_updates_total', 'Webhook updates by outcome', lambda: {
+        ("processed",): update_dispatcher.processed,
+        ("failed",): update_dispatcher.failed,
+        ("duplicate",): update_dispatcher.duplicates,
+    }, ['outcome'],
+)
+registry.gauge_callback('dumper_updates_pending', 'Accepted updates not yet handled', lambda: update_dispatcher.pending)
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.post("/webhook")
 async def webhook(request: Request):
     try:
         data = await request.json()
         update = Update.de_json(data, bot)
-        context = CallbackContext.from_update(update, bot)
 
-        # 记录接收到的更新
-        logging.info(f"Webhook received data: {data}")
+        structured_logging.bind(f"update-{update.update_id}")
+        # 完整的更新内容只在 DEBUG 级别记录
+        logging.debug("Webhook received data: %s", data)
 
         user_id = None
         chat_type = None
@@ -943,22 +1296,13 @@ async def webhook(request: Request):
             logging.error(f"Update content: {data}")
             raise HTTPException(status_code=400, detail="Invalid update")
 
-        user_lock = await get_user_lock(user_id)
-        async with user_lock:
-            if user_id not in user_data_store:
-                user_data_store[user_id] = {}
+        logging.info(f"Webhook update {update.update_id} from user {user_id}")
 
-        if update.message:
-            if update.message.text and (update.message.text == '/start' or update.message.text == '/help'):
-                await help(update, context)
-            else:
-                await handle_url(update, context)
-        elif update.callback_query:
-            await button_callback(update, context)
-        elif update.my_chat_member:
-            # 处理 my_chat_member 更新
-            logging.info(f"Received my_chat_member update: {update.my_chat_member}")
-            # 可以在此处添加更多处理逻辑，例如记录日志或执行某些操作
+        # 立即确认，处理放到后台，避免 Telegram 因响应慢而重发更新
+        if not update_dispatcher.submit(update.update_id, user_id, update):
+            return JSONResponse(content={"status": "duplicate"})
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"An error occurred in webhook: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,189 @@
+import os
+import time
+import zlib
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+COMPRESS_THREADS = int(os.getenv('COMPRESS_THREADS', str(os.cpu_count() or 2)))
+COMPRESS_BLOCK_SIZE = 1024 * 1024  # 每个独立压缩块的大小
+COMPRESS_LEVEL = 6
+DICT_SIZE = 32 * 1024  # deflate 窗口大小，用上一块的末尾作为字典以保持压缩率
+
+_ZIP64_LIMIT = 0xFFFFFFFF
+_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+_CENTRAL_HEADER = struct.Struct('<4s6H3L5H2L')
+_EOCD = struct.Struct('<4s4H2LH')
+_ZIP64_EOCD = struct.Struct('<4sQ2H2L4Q')
+_ZIP64_LOCATOR = struct.Struct('<4sLQL')
+_RESERVED_EXTRA = 20  # 本地文件头预留的扩展字段，收尾时写入 ZIP64 信息或对齐填充
+_PADDING_EXTRA_ID = 0xD935  # zipalign 使用的填充字段 ID
+
+
+class SizeLimitExceeded(Exception):
+    """压缩后的大小超过了上限。"""
+
+
+def _compress_block(block, zdict, level):
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    # Z_SYNC_FLUSH 让每块在字节边界结束，各块可以直接拼接成一个 deflate 流
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def _dos_datetime(timestamp):
+    t = time.localtime(timestamp)
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+class ParallelZipWriter:
+    """多线程写入只包含一个 deflate 条目的 zip 文件。
+
+    数据按顺序写入，被切成固定大小的块后在线程池中独立压缩（与 pigz 相同的方式），
+    再按顺序拼接。写入过程中一旦压缩后的大小超过 limit 就抛出 SizeLimitExceeded。
+    """
+
+    def __init__(self, path, arcname, limit=None, threads=COMPRESS_THREADS, level=COMPRESS_LEVEL):
+        self.path = path
+        self.arcname = arcname.encode()
+        self.limit = limit
+        self.level = level
+        self.crc = 0
+        self.file_size = 0
+        self.compress_size = 0
+        self._file = open(path, 'wb')
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='deflate')
+        self._pending = deque()
+        self._max_pending = threads * 2
+        self._buffer = bytearray()
+        self._zdict = b''
+        self._mtime = _dos_datetime(time.time())
+        self._file.write(_LOCAL_HEADER.pack(
+            b'PK\x03\x04', 45, 0, 8, self._mtime[0], self._mtime[1], 0, 0, 0, len(self.arcname), _RESERVED_EXTRA,
+        ))
+        self._file.write(self.arcname)
+        self._file.write(b'\x00' * _RESERVED_EXTRA)
+        self._data_start = self._file.tell()
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= COMPRESS_BLOCK_SIZE:
+            self._submit(bytes(self._buffer[:COMPRESS_BLOCK_SIZE]))
+            del self._buffer[:COMPRESS_BLOCK_SIZE]
+
+    def _submit(self, block):
+        self.crc = zlib.crc32(block, self.crc)
+        self.file_size += len(block)
+        self._pending.append(self._executor.submit(_compress_block, block, self._zdict, self.level))
+        self._zdict = block[-DICT_SIZE:]
+        while len(self._pending) > self._max_pending:
+            self._drain_one()
+
+    def _drain_one(self):
+        self._write_compressed(self._pending.popleft().result())
+
+    def _write_compressed(self, data):
+        self._file.write(data)
+        self.compress_size += len(data)
+        if self.limit is not None and self.compress_size > self.limit:
+            raise SizeLimitExceeded(self.compress_size)
+
+    def close(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self._drain_one()
+        # 最后写入一个空的结束块，标记 deflate 流结束
+        self._write_compressed(zlib.compressobj(self.level, zlib.DEFLATED, -15).flush(zlib.Z_FINISH))
+        self._executor.shutdown(wait=True)
+
+        zip64 = self.file_size >= _ZIP64_LIMIT or self.compress_size >= _ZIP64_LIMIT
+        size_fields = (_ZIP64_LIMIT, _ZIP64_LIMIT) if zip64 else (self.compress_size, self.file_size)
+        if zip64:
+            extra = struct.pack('<2H2Q', 0x0001, 16, self.file_size, self.compress_size)
+        else:
+            extra = struct.pack('<2H', _PADDING_EXTRA_ID, 16) + b'\x00' * 16
+
+        central_offset = self._file.tell()
+        self._file.write(_CENTRAL_HEADER.pack(
+            b'PK\x01\x02', 45, 45, 0, 8, self._mtime[0], self._mtime[1], self.crc, *size_fields,
+            len(self.arcname), len(extra) if zip64 else 0, 0, 0, 0, 0o644 << 16, 0,
+        ))
+        self._file.write(self.arcname)
+        if zip64:
+            self._file.write(extra)
+        central_size = self._file.tell() - central_offset
+
+        if central_offset >= _ZIP64_LIMIT:
+            zip64_eocd_offset = self._file.tell()
+            self._file.write(_ZIP64_EOCD.pack(
+                b'PK\x06\x06', _ZIP64_EOCD.size - 12, 45, 45, 0, 0, 1, 1, central_size, central_offset,
+            ))
+            self._file.write(_ZIP64_LOCATOR.pack(b'PK\x06\x07', 0, zip64_eocd_offset, 1))
+            central_offset = _ZIP64_LIMIT
+        self._file.write(_EOCD.pack(b'PK\x05\x06', 0, 0, 1, 1, central_size, central_offset, 0))
+
+        # 回填本地文件头中的 CRC、大小和扩展字段
+        self._file.seek(14)
+        self._file.write(struct.pack('<3L', self.crc, *size_fields))
+        self._file.seek(self._data_start - _RESERVED_EXTRA)
+        self._file.write(extra)
+        self._file.close()
+
+    def abort(self):
+        for future in self._pending:
+            future.cancel()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def compress_image(image_path, output_path, arcname, limit=None, state=None, progress=None):
+    """
+    把分区镜像压缩为 zip。
+
+    传入 state（extractor.ExtractionState）时与提取同时进行：只读取镜像中已经写完的部分，
+    超过 limit 时取消提取。progress(已压缩字节数, 镜像大小) 在每块读入后调用。
+
+    Raises:
+        SizeLimitExceeded: 压缩后的大小超过 limit，输出文件已删除。
+    """
+    writer = ParallelZipWriter(output_path, arcname, limit=limit)
+    fd = None
+    try:
+        position = 0
+        while True:
+            if state is None:
+                available = total = os.path.getsize(image_path)
+            else:
+                available = state.wait_for(position)
+                total = state.image_size
+            if available <= position:
+                break
+            if fd is None:
+                # 与提取同时进行时，镜像文件在第一个操作完成后才一定存在
+                fd = os.open(image_path, os.O_RDONLY)
+            while position < available:
+                chunk = os.pread(fd, min(COMPRESS_BLOCK_SIZE, available - position), position)
+                if not chunk:
+                    raise IOError(f"Unexpected end of image file at {position}")
+                writer.write(chunk)
+                position += len(chunk)
+                if progress is not None:
+                    progress(position, total)
+        writer.close()
+    except BaseException:
+        if state is not None:
+            state.cancel()
+        writer.abort()
+        raise
+    finally:
+        if fd is not None:
+            os.close(fd)
+    return writer.compress_size
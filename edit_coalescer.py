@@ -0,0 +1,91 @@
+import os
+import asyncio
+import logging
+
+from ttl_cache import TTLCache
+
+EDIT_MIN_INTERVAL = float(os.getenv('EDIT_MIN_INTERVAL', '1.5'))  # 同一条消息两次编辑的最小间隔（秒）
+EDIT_SLOTS_SIZE = 10000
+EDIT_SLOTS_TTL = 600  # 闲置消息的合并状态保留时间（秒）
+
+
+class _Slot:
+    __slots__ = ('sent', 'sending', 'pending', 'final', 'last_edit', 'task')
+
+    def __init__(self):
+        self.sent = None  # 最后一次发出的 (text, reply_markup)
+        self.sending = None  # 正在发送的 (text, reply_markup)
+        self.pending = None  # 等待发出的最新 (text, reply_markup)
+        self.final = False  # 有 final 编辑尚未发出（待发或正在发送）
+        self.last_edit = float('-inf')
+        self.task = None
+
+
+class EditCoalescer:
+    """按 (chat_id, message_id) 合并消息编辑。
+
+    每条消息只保留最新的待发内容，两次编辑之间至少间隔 min_interval，
+    与上次发出内容相同的编辑直接跳过。final=True 的编辑会等待其内容真正发出，
+    在它发出之前到达的非 final 编辑（排队位置、迟到的进度等）直接丢弃，
+    保证消息最终停留在结果或错误上。
+    """
+
+    def __init__(self, send, min_interval=EDIT_MIN_INTERVAL):
+        self._send = send  # async send(chat_id, message_id, text, reply_markup, final)
+        self.min_interval = min_interval
+        self._slots = TTLCache(maxsize=EDIT_SLOTS_SIZE, ttl=EDIT_SLOTS_TTL)
+        self.sent = 0
+        self.skipped = 0  # 与已发出内容相同而跳过的编辑
+        self.coalesced = 0  # 被更新内容覆盖、没有发出的编辑
+
+    async def edit(self, chat_id, message_id, text, reply_markup=None, final=False):
+        key = (chat_id, message_id)
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = _Slot()
+        self._slots.set(key, slot)
+
+        state = (text, reply_markup)
+        if slot.final and not final:
+            self.coalesced += 1
+            return
+        running = slot.task is not None and not slot.task.done()
+        # 与消息即将显示的内容相同才跳过；正在发送时 final 编辑总是排队，发送失败后仍会重发
+        latest = slot.sending if slot.sending is not None else slot.sent
+        if slot.pending is None and latest == state and not (final and running):
+            self.skipped += 1
+            return
+        if slot.pending is not None:
+            self.coalesced += 1
+        slot.pending = state
+        slot.final = slot.final or final
+        if not running:
+            slot.task = asyncio.create_task(self._flush(key, slot))
+        if final:
+            await asyncio.shield(slot.task)
+
+    async def _flush(self, key, slot):
+        loop = asyncio.get_running_loop()
+        while slot.pending is not None:
+            delay = slot.last_edit + self.min_interval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            state, slot.pending = slot.pending, None
+            final = slot.final
+            if state == slot.sent:
+                self.skipped += 1
+            else:
+                slot.sending = state
+                try:
+                    await self._send(key[0], key[1], *state, final)
+                except Exception as e:
+                    logging.warning(f"Failed to edit message {key}: {e}")
+                else:
+                    slot.sent = state
+                    self.sent += 1
+                finally:
+                    slot.sending = None
+                slot.last_edit = loop.time()
+            if slot.pending is None:
+                # 发送期间只可能有新的 final 编辑进入待发，此时保持 final 标记
+                slot.final = False
@@ -0,0 +1,87 @@
+import sys
+import json
+import time
+import threading
+
+# 事件类型
+STATUS = "status"  # {"stage", "message"}
+PROGRESS = "progress"  # {"stage", "done", "total", "elapsed"}
+ERROR = "error"  # {"code", "message"}
+ARTIFACT = "artifact"  # {"path", "parts"}，parts 仅在产物被分卷时出现
+
+# 错误码
+INVALID_COMMAND = "invalid_command"
+INVALID_PARTITION = "invalid_partition"
+PARTITION_NOT_FOUND = "partition_not_found"
+PROBE_FAILED = "probe_failed"
+PREDICTED_OVERSIZE = "predicted_oversize"
+SIZE_LIMIT = "size_limit"
+DOWNLOAD_TIMEOUT = "download_timeout"
+IMAGE_NOT_FOUND = "image_not_found"
+TOOL_FAILED = "tool_failed"
+TIMEOUT = "timeout"
+WORKER_CRASHED = "worker_crashed"
+INTERNAL = "internal"
+
+PROGRESS_INTERVAL = 0.5  # 同一阶段两次进度事件的最小间隔（秒）
+
+_lock = threading.Lock()
+
+
+def encode(event, **fields):
+    """把事件编码为一行 JSON（不含换行符）。"""
+    return json.dumps({"event": event, **fields}, ensure_ascii=False)
+
+
+def decode(line):
+    """解析一行输出，不是事件的行返回 None。"""
+    if not line.startswith("{"):
+        return None
+    try:
+        event = json.loads(line)
+    except ValueError:
+        return None
+    return event if isinstance(event, dict) and "event" in event else None
+
+
+def emit(event, **fields):
+    """输出一个事件。提取线程也会上报进度，所以整行在锁内一次写出。"""
+    line = encode(event, **fields) + "\n"
+    with _lock:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+
+def status(stage, *lines):
+    """输出状态事件，lines 为逐行的中英文说明。"""
+    emit(STATUS, stage=stage, message="\n".join(lines))
+
+
+def error(code, *lines):
+    emit(ERROR, code=code, message="\n".join(lines))
+
+
+def artifact(path, parts=None):
+    if parts:
+        emit(ARTIFACT, path=path, parts=parts)
+    else:
+        emit(ARTIFACT, path=path)
+
+
+class ProgressReporter:
+    """限制频率的进度上报，可直接作为 extractor 的 progress 回调。"""
+
+    def __init__(self, stage, interval=PROGRESS_INTERVAL):
+        self.stage = stage
+        self.interval = interval
+        self._started = time.monotonic()
+        self._last = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self, done, total):
+        now = time.monotonic()
+        with self._lock:
+            if done < total and now - self._last < self.interval:
+                return
+            self._last = now
+        emit(PROGRESS, stage=self.stage, done=done, total=total, elapsed=round(now - self._started, 3))
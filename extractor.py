@@ -0,0 +1,256 @@
+import os
+import bz2
+import heapq
+import lzma
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+EXTRACT_CONNECTIONS = int(os.getenv('EXTRACT_CONNECTIONS', '8'))  # 并发连接数
+RANGE_SIZE = int(os.getenv('EXTRACT_RANGE_SIZE', str(4 * 1024 * 1024)))  # 单个分段请求的目标大小
+MERGE_GAP = 64 * 1024  # 相邻操作间隔小于该值时合并到同一个请求中
+RANGE_RETRIES = 3
+RANGE_TIMEOUT = float(os.getenv('EXTRACT_RANGE_TIMEOUT', '30'))
+
+_local = threading.local()
+
+
+class UnsupportedOperation(Exception):
+    """分区包含无法直接从 payload 数据还原的操作（例如增量包的 SOURCE_* 操作）。"""
+
+
+class ExtractionCancelled(Exception):
+    """提取被读取方取消。"""
+
+
+class ExtractionState:
+    """提取线程与读取方共享的进度。
+
+    frontier 是镜像从开头起已经完整写入的位置：所有起始位置在它之前的操作都已完成，
+    读取方可以在提取进行的同时安全地读取 [0, frontier)。
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = []  # 未完成操作的起始字节位置（最小堆）
+        self._completed = Counter()
+        self.image_size = None
+        self.frontier = 0
+        self.finished = False
+        self.cancelled = False
+        self.error = None
+
+    def _start(self, starts, image_size):
+        with self._cond:
+            self._pending = sorted(starts)
+            self.image_size = image_size
+            self._advance()
+
+    def _op_done(self, start):
+        with self._cond:
+            self._completed[start] += 1
+            self._advance()
+
+    def _advance(self):
+        while self._pending and self._completed[self._pending[0]]:
+            self._completed[heapq.heappop(self._pending)] -= 1
+        frontier = self._pending[0] if self._pending else self.image_size
+        if frontier > self.frontier:
+            self.frontier = frontier
+            self._cond.notify_all()
+
+    def _finish(self, error=None):
+        with self._cond:
+            self.finished = True
+            self.error = error
+            self._cond.notify_all()
+
+    def cancel(self):
+        with self._cond:
+            self.cancelled = True
+            self._cond.notify_all()
+
+    def wait_for(self, position):
+        """阻塞到 frontier 超过 position 或提取结束，返回当前 frontier。
+
+        Raises:
+            提取线程中抛出的异常，或在已取消时抛出 ExtractionCancelled。
+        """
+        with self._cond:
+            while self.frontier <= position and not self.finished and not self.cancelled:
+                self._cond.wait()
+            if self.error is not None:
+                raise self.error
+            if self.cancelled:
+                raise ExtractionCancelled()
+            return self.frontier
+
+
+def _session(connections):
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _local.session = session
+    return session
+
+
+def _operation_types():
+    import payload_dumper.update_metadata_pb2 as um
+    op = um.InstallOperation
+    return {
+        'REPLACE': op.REPLACE,
+        'REPLACE_BZ': op.REPLACE_BZ,
+        'REPLACE_XZ': op.REPLACE_XZ,
+        'ZERO': op.ZERO,
+        'DISCARD': op.DISCARD,
+    }
+
+
+def plan_ranges(partition, range_size=RANGE_SIZE):
+    """把分区的操作按数据位置合并成若干个字节范围。
+
+    Returns:
+        list: [(起始偏移, 结束偏移, [操作])]，偏移相对于 payload 数据区。
+    """
+    types = _operation_types()
+    data_types = (types['REPLACE'], types['REPLACE_BZ'], types['REPLACE_XZ'])
+    no_data_types = (types['ZERO'], types['DISCARD'])
+
+    operations = []
+    for operation in partition.operations:
+        if operation.type in data_types:
+            operations.append(operation)
+        elif operation.type not in no_data_types:
+            raise UnsupportedOperation(f"operation type {operation.type} in {partition.partition_name}")
+    operations.sort(key=lambda op: op.data_offset)
+
+    ranges = []
+    for operation in operations:
+        start = operation.data_offset
+        end = start + operation.data_length
+        if ranges:
+            last_start, last_end, last_ops = ranges[-1]
+            if start - last_end <= MERGE_GAP and end - last_start <= range_size:
+                ranges[-1] = (last_start, max(last_end, end), last_ops + [operation])
+                continue
+        ranges.append((start, end, [operation]))
+    return ranges
+
+
+def _decode(operation, data, types):
+    if operation.type == types['REPLACE_XZ']:
+        return lzma.LZMADecompressor().decompress(data)
+    if operation.type == types['REPLACE_BZ']:
+        return bz2.BZ2Decompressor().decompress(data)
+    return data
+
+
+def _write_extents(fd, operation, data, block_size):
+    position = 0
+    for extent in operation.dst_extents:
+        length = extent.num_blocks * block_size
+        os.pwrite(fd, data[position:position + length], extent.start_block * block_size)
+        position += length
+
+
+def _first_byte(operation, block_size):
+    return min(extent.start_block for extent in operation.dst_extents) * block_size
+
+
+def _fetch(url, start, end, connections):
+    last_error = None
+    for _ in range(RANGE_RETRIES):
+        try:
+            response = _session(connections).get(
+                url, headers={'Range': f'bytes={start}-{end - 1}'}, timeout=RANGE_TIMEOUT,
+            )
+            response.raise_for_status()
+            if response.status_code != 206 or len(response.content) != end - start:
+                raise IOError(f"unexpected response for range {start}-{end - 1}")
+            return response.content
+        except (requests.RequestException, IOError) as e:
+            last_error = e
+    raise IOError(f"Failed to download range {start}-{end - 1}: {last_error}")
+
+
+def extract_partition(record, partition_name, out_path, connections=EXTRACT_CONNECTIONS, progress=None, state=None):
+    """
+    通过多个并发的分段请求提取分区镜像。
+
+    Args:
+        record: url_probe.ProbeRecord 探测记录。
+        partition_name: 分区名称。
+        out_path: 输出的 .img 路径。
+        connections: 并发连接数。
+        progress: 可选回调 progress(已下载字节数, 总字节数)，会在工作线程中调用。
+        state: 可选的 ExtractionState，用于让其他线程边提取边读取镜像，或取消提取。
+
+    Raises:
+        UnsupportedOperation: 分区包含增量操作，需要回退到 payload_dumper。
+        ExtractionCancelled: 提取已通过 state 取消。
+        IOError: 分段下载失败。
+    """
+    if state is None:
+        return _extract(record, partition_name, out_path, connections, progress, None)
+    try:
+        total = _extract(record, partition_name, out_path, connections, progress, state)
+    except BaseException as e:
+        state._finish(e)
+        raise
+    state._finish()
+    return total
+
+
+def _extract(record, partition_name, out_path, connections, progress, state):
+    partition = record.find_partition(partition_name)
+    if partition is None:
+        raise KeyError(partition_name)
+    types = _operation_types()
+    block_size = record.manifest.block_size
+    ranges = plan_ranges(partition)
+    total = sum(end - start for start, end, _ in ranges)
+    done = 0
+    done_lock = threading.Lock()
+
+    def work(item):
+        nonlocal done
+        start, end, operations = item
+        if state is not None and state.cancelled:
+            raise ExtractionCancelled()
+        data = _fetch(record.url, record.data_offset + start, record.data_offset + end, connections)
+        for operation in operations:
+            chunk = data[operation.data_offset - start:operation.data_offset - start + operation.data_length]
+            _write_extents(fd, operation, _decode(operation, chunk, types), block_size)
+            if state is not None:
+                state._op_done(_first_byte(operation, block_size))
+        if progress is not None:
+            with done_lock:
+                done += end - start
+                progress(done, total)
+
+    fd = os.open(out_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        # ZERO/DISCARD 区域保持为稀疏文件中的空洞，读出来就是全零
+        image_size = max(
+            [partition.new_partition_info.size]
+            + [(e.start_block + e.num_blocks) * block_size for op in partition.operations for e in op.dst_extents]
+        )
+        os.ftruncate(fd, image_size)
+        if state is not None:
+            state._start([_first_byte(op, block_size) for _, _, ops in ranges for op in ops], image_size)
+        executor = ThreadPoolExecutor(max_workers=connections, thread_name_prefix='range')
+        try:
+            for _ in executor.map(work, ranges):
+                pass
+        finally:
+            # 任一分段失败时取消尚未开始的请求
+            executor.shutdown(wait=True, cancel_futures=True)
+    finally:
+        os.close(fd)
+    return total
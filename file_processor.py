@@ -3,17 +3,26 @@ import re
 import shutil
 import subprocess
 import sys
-import tempfile
-import zipfile
 
 import asyncio
 import hashlib
+import json
 import shlex
 import traceback
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
-import file_check
+import artifact_cache
+import compressor
+import events
+import extractor
 import requests
+import size_predictor
+import split_archive
+import url_probe
+from size_predictor import SIZE_LIMIT, UPLOAD_LIMIT
+
+EXTRACT_MODE = os.getenv('EXTRACT_MODE', 'parallel')  # parallel：多连接分段下载；payload_dumper：调用命令行工具
 
 async def run_payload_dumper(tempdir, url, command):
     """运行 payload_dumper 命令并返回输出结果。"""
@@ -27,166 +36,245 @@ async def run_payload_dumper(tempdir, url, command):
         try:
             await asyncio.wait_for(process.wait(), timeout=15.0)
         except asyncio.TimeoutError:
-            print('ERROR:', file=sys.stdout)
-            print('Download timed out, please try again or change URL', file=sys.stdout)
-            print('下载超时，请重试或更换链接', file=sys.stdout)
-            print('ERROR_END', file=sys.stdout)
+            events.error(
+                events.DOWNLOAD_TIMEOUT,
+                'Download timed out, please try again or change URL',
+                '下载超时，请重试或更换链接',
+            )
             return 1
 
         if process.returncode != 0:
             error_message = stderr.decode().strip().split('\n')[-1]  # 获取最后一行错误信息
-            print('ERROR:', file=sys.stdout)
-            print('payload_dumper execution failed:', file=sys.stdout)
-            print('payload_dumper 执行失败:', file=sys.stdout)
-            print(f'{error_message}', file=sys.stdout)
-            print('ERROR_END', file=sys.stdout)
+            events.error(
+                events.TOOL_FAILED,
+                'payload_dumper execution failed:',
+                'payload_dumper 执行失败:',
+                f'{error_message}',
+            )
             return 1
 
-        print(stdout.decode(), file=sys.stdout)  # 直接打印标准输出到控制台
+        output = stdout.decode().strip()
+        if output:
+            # 工具自身的输出不是事件，bot 只采样记录，不当作错误
+            print(output)
         return 0
     except Exception as e:
         error_message = traceback.format_exc().strip().split('\n')[-1]  # 获取最后一行错误信息
-        print('ERROR:', file=sys.stdout)
-        print(f"Unknown error", file=sys.stdout)
-        print(f"未知错误", file=sys.stdout)
-        print(f'{error_message}', file=sys.stdout)
-        print('ERROR_END', file=sys.stdout)
+        events.error(
+            events.INTERNAL,
+            f"Unknown error",
+            f"未知错误",
+            f'{error_message}',
+        )
+        return 1
+
+def extract_and_compress(url, partition_name, tempdir, probe, output_path):
+    """
+    提取分区镜像并压缩到 output_path，返回退出码。
+
+    并行模式下提取与压缩同时进行，压缩后的大小一旦超过分卷上限就取消剩余的下载。
+
+    Raises:
+        compressor.SizeLimitExceeded: 压缩后的文件超过 SIZE_LIMIT。
+    """
+    image_path = os.path.join(tempdir, f"{partition_name}.img")
+    arcname = f"{partition_name}.img"
+
+    if EXTRACT_MODE == 'parallel':
+        state = extractor.ExtractionState()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            extraction = executor.submit(
+                extractor.extract_partition, probe, partition_name, image_path,
+                progress=events.ProgressReporter('download'), state=state,
+            )
+            try:
+                compressor.compress_image(
+                    image_path, output_path, arcname, limit=SIZE_LIMIT, state=state,
+                    progress=events.ProgressReporter('compress'),
+                )
+                extraction.result()
+                return 0
+            except extractor.UnsupportedOperation as e:
+                print(f"Falling back to payload_dumper: {e}", file=sys.stderr)
+
+    command = f'payload_dumper --out {tempdir} --partitions {partition_name} "{url}"'
+    exit_code = asyncio.run(run_payload_dumper(tempdir, url, command))  # 直接执行命令
+    if exit_code != 0:
+        return exit_code
+
+    if not os.path.isfile(image_path):
+        events.error(
+            events.IMAGE_NOT_FOUND,
+            f'Partition image file not found: {image_path}',
+            f'未找到分区镜像文件: {image_path}',
+        )
         return 1
+    compressor.compress_image(
+        image_path, output_path, arcname, limit=SIZE_LIMIT, progress=events.ProgressReporter('compress'),
+    )
+    return 0
 
-def list_partitions(url, outputdir='output'):
-    """列出分区信息并保存到文件。"""
-    filename = "partitions_info"
+def list_partitions(url, outputdir='output', probe=None):
+    """列出分区信息并保存到文件。分区信息直接取自探测记录中的 manifest。"""
     extension = ".json"
     subdir = "partitions"
-    print('STATUS:', file=sys.stdout)
-    print("Listing partitions...", file=sys.stdout)
-    print("正在列出分区信息", file=sys.stdout)
-    print('STATUS_END', file=sys.stdout)
+    events.status(
+        'list',
+        "Listing partitions...",
+        "正在列出分区信息",
+    )
     try:
-        URLfilename = file_check.get_filename_from_url(url)
-        if URLfilename is None:
-            print(f"获取文件名失败", file=sys.stdout)
-            return
-        output_path = os.path.join(outputdir, subdir, f"{URLfilename}{extension}")
-
-        if os.path.exists(output_path):
-            print(f'FILE:{output_path}')
-            return 0
-
-        tempdir = tempfile.mkdtemp()
-
-        command = f'payload_dumper --out {tempdir} --list "{url}"'
-        exit_code = asyncio.run(run_payload_dumper(tempdir, url, command))  # 直接执行命令
-        if exit_code != 0:
-            shutil.rmtree(tempdir)
+        probe = probe or url_probe.probe_url(url)
+        if probe is None:
             return 1
+        output_path = os.path.join(outputdir, subdir, f"{probe.file_name}{extension}")
 
-        temp_output_path = os.path.join(tempdir, f"{filename}{extension}")
-
-        if os.path.isfile(temp_output_path):
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            shutil.move(temp_output_path, output_path)
-            print(f'FILE:{output_path}')
+        if artifact_cache.lookup(output_path):
+            events.artifact(output_path)
             return 0
-        else:
-            print('ERROR:', file=sys.stdout)
-            print('Partition information file not found', file=sys.stdout)
-            print('未找到分区信息文件', file=sys.stdout)
-            print('ERROR_END', file=sys.stdout)
-            shutil.rmtree(tempdir)
-            return 1
+
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        temp_output_path = artifact_cache.temp_path(output_path)
+        with open(temp_output_path, 'w') as f:
+            json.dump(url_probe.partitions_info(probe), f)
+        os.replace(temp_output_path, output_path)
+        artifact_cache.register(output_path)
+        events.artifact(output_path)
+        return 0
     except Exception as e:
-        print('ERROR:', file=sys.stdout)
-        print(f"Error in list_partitions: {str(e)}", file=sys.stdout)
-        print(f"列出分区信息时出错: {str(e)}", file=sys.stdout)
-        print('ERROR_END', file=sys.stdout)
+        events.error(
+            events.INTERNAL,
+            f"Error in list_partitions: {str(e)}",
+            f"列出分区信息时出错: {str(e)}",
+        )
         return 1
 
-def dump_partition(url, partition_name, outputdir='output'):
-    """导出指定分区并压缩保存。"""
+def dump_partition(url, partition_name, outputdir='output', probe=None, remote_ok=False):
+    """导出指定分区并压缩保存。
+
+    remote_ok 为 True 时，本地文件已被淘汰但仍有 file_id 的产物也直接返回，由 bot 用 file_id 发送；
+    命令行和 dumperweb 只能提供 output/ 中的文件，保持默认值以便重新提取。
+    """
     filename = partition_name
     extension = ".zip"
     subdir = f"zip/{partition_name}"
 
     try:
-        URLfilename = file_check.get_filename_from_url(url)
-        if URLfilename is None:
-            print(f"获取文件名失败", file=sys.stdout)
-            return
+        probe = probe or url_probe.probe_url(url)
+        if probe is None:
+            return 1
+        URLfilename = probe.file_name
         output_path = os.path.join(outputdir, subdir, f"{filename}_{URLfilename}{extension}")
 
-        if os.path.exists(output_path):
-            print('STATUS:', file=sys.stdout)
-            print('Found cached file, uploading...', file=sys.stdout)
-            print('找到缓存文件，正在上传...', file=sys.stdout)
-            print('STATUS_END', file=sys.stdout)
-            print(f'FILE:{output_path}')
+        if artifact_cache.lookup(output_path, remote_ok=remote_ok):
+            events.status(
+                'cached',
+                'Found cached file, uploading...',
+                '找到缓存文件，正在上传...',
+            )
+            events.artifact(output_path)
+            return 0
+        parts = split_archive.lookup(output_path, remote_ok=remote_ok)
+        if parts:
+            events.status(
+                'cached',
+                'Found cached file, uploading...',
+                '找到缓存文件，正在上传...',
+            )
+            events.artifact(output_path, parts)
             return 0
 
-        tempdir = tempfile.mkdtemp()
-        print('STATUS:', file=sys.stdout)
-        print('Dumping partition...', file=sys.stdout)
-        print('正在提取分区...', file=sys.stdout)
-        print('STATUS_END', file=sys.stdout)
+        partition = probe.find_partition(partition_name)
+        estimated = size_predictor.estimate(partition, probe.manifest.block_size)
+        predicted = size_predictor.predict(partition, block_size=probe.manifest.block_size)
+        if size_predictor.is_oversize(predicted):
+            events.error(
+                events.PREDICTED_OVERSIZE,
+                f'Partition {partition_name} is expected to exceed {url_probe.format_size(SIZE_LIMIT)} after compression '
+                f'(about {url_probe.format_size(predicted)}), unable to upload.',
+                f'分区 {partition_name} 压缩后预计超过 {url_probe.format_size(SIZE_LIMIT)}（约 {url_probe.format_size(predicted)}），无法上传。',
+            )
+            return 1
 
-        command = f'payload_dumper --out {tempdir} --partitions {partition_name} "{url}"'
-        exit_code = asyncio.run(run_payload_dumper(tempdir, url, command))  # 直接执行命令
+        tempdir = artifact_cache.make_tempdir()
+        events.status(
+            'dump',
+            'Dumping partition...',
+            '正在提取分区...',
+        )
+
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        temp_output_path = artifact_cache.temp_path(output_path)
+        try:
+            exit_code = extract_and_compress(url, partition_name, tempdir, probe, temp_output_path)
+        except compressor.SizeLimitExceeded:
+            events.error(
+                events.SIZE_LIMIT,
+                f'Compressed file size exceeds {url_probe.format_size(SIZE_LIMIT)}, unable to upload.',
+                f'压缩后的文件大小超过了 {url_probe.format_size(SIZE_LIMIT)}，无法上传。',
+            )
+            return 1
+        finally:
+            shutil.rmtree(tempdir, ignore_errors=True)
         if exit_code != 0:
-            shutil.rmtree(tempdir)
             return 1
 
-        temp_output_path = os.path.join(tempdir, f"{filename}.img")
-
-        if os.path.isfile(temp_output_path):
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            with zipfile.ZipFile(output_path, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
-                zip_file.write(temp_output_path, arcname=f"{filename}.img")
-            zip_file_size = os.path.getsize(output_path)
-            if zip_file_size > 50 * 1000 * 1000:
-                print('ERROR:', file=sys.stdout)
-                print('Compressed file size exceeds 50 MB, unable to upload.', file=sys.stdout)
-                print('压缩后的文件大小超过了 50 MB，无法上传。', file=sys.stdout)
-                print('ERROR_END', file=sys.stdout)
-                os.remove(output_path)
-                return 1
-            print(f'FILE:{output_path}')
+        compressed_size = os.path.getsize(temp_output_path)
+        size_predictor.record(partition_name, estimated, compressed_size)
+        if compressed_size > UPLOAD_LIMIT:
+            # 超过单个文件的上传上限，分卷后由 bot 并行上传
+            events.status(
+                'split',
+                f'Compressed file is {url_probe.format_size(compressed_size)}, splitting into parts...',
+                f'压缩后的文件为 {url_probe.format_size(compressed_size)}，正在分卷...',
+            )
+            parts = split_archive.split(temp_output_path, output_path)
+            split_archive.register(output_path, parts)
+            events.artifact(output_path, parts)
             return 0
-        else:
-            print('ERROR:', file=sys.stdout)
-            print('Partition image file not found: {temp_output_path}', file=sys.stdout)
-            print('未找到分区镜像文件: {temp_output_path}', file=sys.stdout)
-            print('ERROR_END', file=sys.stdout)
-            shutil.rmtree(tempdir)
-            return 1
+        os.replace(temp_output_path, output_path)
+        artifact_cache.register(output_path)
+        events.artifact(output_path)
+        return 0
     except Exception as e:
-        print('ERROR:', file=sys.stdout)
-        print(f"Error in dump_partition: {str(e)}", file=sys.stdout)
-        print(f"导出分区时出错: {str(e)}", file=sys.stdout)
-        print('ERROR_END', file=sys.stdout)
+        events.error(
+            events.INTERNAL,
+            f"Error in dump_partition: {str(e)}",
+            f"导出分区时出错: {str(e)}",
+        )
         return 1
 
-def fetch_metadata(url, outputdir='output'):
-    """获取元数据并保存到文件。"""
+def fetch_metadata(url, outputdir='output', probe=None):
+    """获取元数据并保存到文件。探测时已读取到元数据则不再运行 payload_dumper。"""
     filename = "metadata"
     extension = ""
     subdir = "metadata"
 
     try:
-        URLfilename = file_check.get_filename_from_url(url)
-        if URLfilename is None:
-            print(f"获取文件名失败", file=sys.stdout)
-            return
+        probe = probe or url_probe.probe_url(url)
+        if probe is None:
+            return 1
+        URLfilename = probe.file_name
         output_path = os.path.join(outputdir, subdir, f"{URLfilename}{extension}")
 
-        if os.path.exists(output_path):
-            print(f'FILE:{output_path}')
+        if artifact_cache.lookup(output_path):
+            events.artifact(output_path)
+            return 0
+
+        if probe.metadata is not None:
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            with open(output_path, 'w') as f:
+                f.write(probe.metadata)
+            artifact_cache.register(output_path)
+            events.artifact(output_path)
             return 0
 
-        tempdir = tempfile.mkdtemp()
-        print('STATUS:', file=sys.stdout)
-        print('Fetching metadata...', file=sys.stdout)
-        print('正在获取元数据...', file=sys.stdout)
-        print('STATUS_END', file=sys.stdout)
+        tempdir = artifact_cache.make_tempdir()
+        events.status(
+            'metadata',
+            'Fetching metadata...',
+            '正在获取元数据...',
+        )
 
         command = f'payload_dumper --out {tempdir} --metadata "{url}"'
         exit_code = asyncio.run(run_payload_dumper(tempdir, url, command))  # 直接执行命令
@@ -197,94 +285,120 @@ def fetch_metadata(url, outputdir='output'):
         temp_output_path = os.path.join(tempdir, f"{filename}{extension}")
 
         if os.path.isfile(temp_output_path):
-            print('STATUS:', file=sys.stdout)
-            print('Metadata file found, saving...', file=sys.stdout)
-            print('找到元数据文件，正在保存...', file=sys.stdout)
-            print('STATUS_END', file=sys.stdout)
+            events.status(
+                'metadata',
+                'Metadata file found, saving...',
+                '找到元数据文件，正在保存...',
+            )
             os.makedirs(os.path.dirname(output_path), exist_ok=True)
             shutil.move(temp_output_path, output_path)
-            print(f'FILE:{output_path}')
+            shutil.rmtree(tempdir, ignore_errors=True)
+            artifact_cache.register(output_path)
+            events.artifact(output_path)
             return 0
         else:
-            print('ERROR:', file=sys.stdout)
-            print('Metadata file not found: {temp_output_path}', file=sys.stdout)
-            print('未找到元数据文件: {temp_output_path}', file=sys.stdout)
-            print('ERROR_END', file=sys.stdout)
+            events.error(
+                events.IMAGE_NOT_FOUND,
+                f'Metadata file not found: {temp_output_path}',
+                f'未找到元数据文件: {temp_output_path}',
+            )
             shutil.rmtree(tempdir)
             return 1
     except Exception as e:
-        print('ERROR:', file=sys.stdout)
-        print(f"Error in fetch_metadata: {str(e)}", file=sys.stdout)
-        print(f"获取元数据时出错: {str(e)}", file=sys.stdout)
-        print('ERROR_END', file=sys.stdout)
+        events.error(
+            events.INTERNAL,
+            f"Error in fetch_metadata: {str(e)}",
+            f"获取元数据时出错: {str(e)}",
+        )
         return 1
 
-def main():
+def run(argv, remote_ok=False):
+    """执行一条命令并返回退出码，供命令行入口和常驻工作进程共用。
+
+    remote_ok 只由 bot 的工作进程设置，见 dump_partition。
+    """
     try:
-        if len(sys.argv) < 3:
-            print('ERROR:', file=sys.stdout)
-            print('Invalid command. Usage: <script> <command> <url> [<partition_name>]', file=sys.stdout)
-            print('无效的命令. 使用方法: <script> <command> <url> [<partition_name>]', file=sys.stdout)
-            print('ERROR_END', file=sys.stdout)
-            sys.exit(1)
+        if len(argv) < 2:
+            events.error(
+                events.INVALID_COMMAND,
+                'Invalid command. Usage: <script> <command> <url> [<partition_name>]',
+                '无效的命令. 使用方法: <script> <command> <url> [<partition_name>]',
+            )
+            return 1
 
-        command = sys.argv[1]
+        command = argv[0]
 
         if command == '--dump':
-            if len(sys.argv) < 4:
-                print('ERROR:', file=sys.stdout)
-                print('Invalid command. Usage: <script> --dump <url> <partition_name>', file=sys.stdout)
-                print('无效的命令. 使用方法: <script> --dump <url> <partition_name>', file=sys.stdout)
-                print('ERROR_END', file=sys.stdout)
-                sys.exit(1)
-            partition_name = sys.argv[2]
-            url = sys.argv[3].strip('"')
-            if not file_check.check_zip_file(url): 
-                sys.exit(1)
+            if len(argv) < 3:
+                events.error(
+                    events.INVALID_COMMAND,
+                    'Invalid command. Usage: <script> --dump <url> <partition_name>',
+                    '无效的命令. 使用方法: <script> --dump <url> <partition_name>',
+                )
+                return 1
+            partition_name = argv[1]
+            url = argv[2].strip('"')
             if not re.match(r'^[a-zA-Z0-9_]+$', partition_name):
-                print('ERROR:', file=sys.stdout)
-                print(f'Invalid partition name: {partition_name}', file=sys.stdout)
-                print(f'无效的分区名称: {partition_name}', file=sys.stdout)
-                print('ERROR_END', file=sys.stdout)
-                sys.exit(1)
+                events.error(
+                    events.INVALID_PARTITION,
+                    f'Invalid partition name: {partition_name}',
+                    f'无效的分区名称: {partition_name}',
+                )
+                return 1
             
             invalid_partitions = ['modem', 'modemfirmware', 'odm', 'product', 'system', 'system_ext', 'vendor']
             if partition_name in invalid_partitions:
-                print('ERROR:', file=sys.stdout)
-                print(f'Invalid partition name: {partition_name}', file=sys.stdout)
-                print(f'无效的分区名称: {partition_name}', file=sys.stdout)
-                print('ERROR_END', file=sys.stdout)
-                sys.exit(1)
+                events.error(
+                    events.INVALID_PARTITION,
+                    f'Invalid partition name: {partition_name}',
+                    f'无效的分区名称: {partition_name}',
+                )
+                return 1
+
+            probe = url_probe.probe_url(url)
+            if probe is None:
+                return 1
+            if probe.find_partition(partition_name) is None:
+                events.error(
+                    events.PARTITION_NOT_FOUND,
+                    f'Partition not found in payload: {partition_name}',
+                    f'payload 中不存在该分区: {partition_name}',
+                )
+                return 1
 
-            exit_code = dump_partition(url, partition_name)
-            sys.exit(exit_code)  # 根据返回值退出
+            return dump_partition(url, partition_name, probe=probe, remote_ok=remote_ok)
 
         elif command == '--metadata':
-            url = sys.argv[2].strip('"')
-            if not file_check.check_zip_file(url): 
-                sys.exit(1)
-            exit_code = fetch_metadata(url)
-            sys.exit(exit_code)  # 根据返回值退出
+            url = argv[1].strip('"')
+            probe = url_probe.probe_url(url)
+            if probe is None:
+                return 1
+            return fetch_metadata(url, probe=probe)
 
         elif command == '--list':
-            url = sys.argv[2].strip('"')
-            if not file_check.check_zip_file(url): 
-                sys.exit(1)
-            exit_code = list_partitions(url)
-            sys.exit(exit_code)  # 根据返回值退出
+            url = argv[1].strip('"')
+            probe = url_probe.probe_url(url)
+            if probe is None:
+                return 1
+            return list_partitions(url, probe=probe)
 
         else:
-            print('ERROR:', file=sys.stdout)
-            print('Unknown command', file=sys.stdout)
-            print('未知命令', file=sys.stdout)
-            print('ERROR_END', file=sys.stdout)
-            sys.exit(1)
+            events.error(
+                events.INVALID_COMMAND,
+                'Unknown command',
+                '未知命令',
+            )
+            return 1
     except Exception as e:
-        print('ERROR:', file=sys.stdout)
-        print(f"Error in main: {str(e)}", file=sys.stdout)
-        print(f"主函数中出错: {str(e)}", file=sys.stdout)
-        print('ERROR_END', file=sys.stdout)
-        sys.exit(1)
+        events.error(
+            events.INTERNAL,
+            f"Error in main: {str(e)}",
+            f"主函数中出错: {str(e)}",
+        )
+        return 1
+
+def main():
+    sys.exit(run(sys.argv[1:]))  # 根据返回值退出
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,74 @@
+import size_predictor
+
+PRIORITY_PARTITIONS = ["boot", "init_boot", "vbmeta", "vbmeta_system"]  # 排在最前面的分区
+PER_PAGE_FIRST = 12  # 第一页还有“获取元数据”按钮，分区按钮少一行
+PER_PAGE_OTHER = 14
+# 布局格式的版本，修改按钮内容或分页方式时加 1，reindex_layouts.py 会据此重建所有布局
+LAYOUT_VERSION = 1
+
+
+def sort_partitions(partitions_info):
+    return sorted(
+        partitions_info,
+        key=lambda x: (x["partition_name"] not in PRIORITY_PARTITIONS, x["partition_name"]),
+    )
+
+
+def count_pages(partition_count):
+    if partition_count <= PER_PAGE_FIRST:
+        return 1
+    return (partition_count - PER_PAGE_FIRST + PER_PAGE_OTHER - 1) // PER_PAGE_OTHER + 1
+
+
+def page_keyboard(partitions_info, page, total_pages):
+    """
+    生成一页分区键盘，按钮为 {"text", "callback_data"} 字典，与 InlineKeyboardButton.to_dict() 相同。
+
+    Args:
+        partitions_info: 已经过 sort_partitions 排序的分区信息。
+        page: 页码，从 1 开始。
+        total_pages: 总页数。
+    """
+    if page == 1:
+        start_index, per_page = 0, PER_PAGE_FIRST
+    else:
+        start_index, per_page = PER_PAGE_FIRST + (page - 2) * PER_PAGE_OTHER, PER_PAGE_OTHER
+    end_index = min(start_index + per_page, len(partitions_info))
+
+    keyboard = []
+    if page == 1:
+        keyboard.append([{"text": "🏷️Fetch metadata", "callback_data": "metadata"}])
+
+    row = []
+    for p in partitions_info[start_index:end_index]:
+        row.append({"text": size_predictor.button_text(p), "callback_data": f"{p['partition_name']}"})
+        if len(row) == 2:
+            keyboard.append(row)
+            row = []
+    if row:
+        keyboard.append(row)
+
+    prev_button = {"text": "⬅️", "callback_data": f"page {page - 1}"} if page > 1 else {"text": "⏹️", "callback_data": " "}
+    next_button = {"text": "➡️", "callback_data": f"page {page + 1}"} if page < total_pages else {"text": "⏹️", "callback_data": " "}
+    keyboard.append([prev_button, {"text": f"📄{page}/{total_pages}", "callback_data": " "}, next_button])
+    return keyboard
+
+
+def build_layout(partitions_info, file_name=None):
+    """
+    生成全部分页的键盘布局。
+
+    Returns:
+        dict: {"file_name", "total_pages", "pages": [{"page_number", "keyboard"}]}，
+        可直接交给 storage.layout_page_rows 存储。
+    """
+    partitions_info = sort_partitions(partitions_info)
+    total_pages = count_pages(len(partitions_info))
+    return {
+        "file_name": file_name,
+        "total_pages": total_pages,
+        "pages": [
+            {"page_number": page, "keyboard": page_keyboard(partitions_info, page, total_pages)}
+            for page in range(1, total_pages + 1)
+        ],
+    }
@@ -5,9 +5,12 @@ import fcntl
 import threading
 from contextlib import contextmanager
 
+import events
+from worker_pool import JOB_TIMEOUTS
+
 QUEUE_FILE = "/tmp/script_queue.lock"
 SCRIPT_TO_RUN = "file_processor.py"
-TIMEOUT = 60 # seconds
+TIMEOUT = 60 # seconds, 仅用于 JOB_TIMEOUTS 中没有的命令；--dump 与 bot 的工作进程池共用按分卷数放宽的超时
 
 event = threading.Event()
 
@@ -29,8 +32,18 @@ def read_queue():
     with locked_file(QUEUE_FILE, "r") as file:
         return [int(line.strip()) for line in file.readlines()]
 
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
 def get_queue_position():
-    queue = read_queue()
+    # 跳过已经崩溃退出的进程留下的记录，避免它们一直堵住队列
+    queue = [pid for pid in read_queue() if is_alive(pid)]
     current_pid = os.getpid()
     for idx, pid in enumerate(queue):
         if pid == current_pid:
@@ -42,14 +55,7 @@ def notify_next():
 
 def print_status(position):
     if position > 0:
-        messages = [
-            "STATUS:",
-            f"Waiting in queue... {position} ahead",
-            f"排队中...前方还有{position}个任务",
-            "STATUS_END"
-        ]
-        for message in messages:
-            print(message)
+        events.status("queue", f"Waiting in queue... {position} ahead", f"排队中...前方还有{position}个任务")
 
 def terminate_process(process):
     try:
@@ -57,15 +63,8 @@ def terminate_process(process):
         process.wait(timeout=5)  # give it a few seconds to terminate
         if process.poll() is None:
             process.kill()  # force kill if it did not terminate
-            messages = [
-                f"Running timeout：{' '.join(cmd)}"
-                "STATUS:",
-                "Running timeout, please retry",
-                "任务超时，请重试",
-                "STATUS_END"
-            ]
-            for message in messages:
-                print(message)
+        print(f"Running timeout: {' '.join(process.args)}", file=sys.stderr)
+        events.error(events.TIMEOUT, "Running timeout, please retry", "任务超时，请重试")
     except Exception as e:
         print(f"Error terminating process: {e}")
 
@@ -88,7 +87,8 @@ def main():
                 print(f"Executing command: {' '.join(cmd)}")
 
                 process = subprocess.Popen(cmd)
-                timer = threading.Timer(TIMEOUT, terminate_process, [process])
+                timeout = JOB_TIMEOUTS.get(sys.argv[1] if len(sys.argv) > 1 else None, TIMEOUT)
+                timer = threading.Timer(timeout, terminate_process, [process])
                 timer.start()
 
                 try:
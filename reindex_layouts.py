@@ -0,0 +1,149 @@
+"""根据 output/partitions/*.json 增量重建 keyboard_layout_pages。
+
+只处理新增或修改过的文件（按 mtime 和大小判断，布局版本变化时全部重建），在进程池中
+解析 JSON 并生成布局，最后在一个事务里批量写入。运行中的 bot 会在内存缓存过期
+（LAYOUT_CACHE_TTL）后读到新布局。
+
+    python reindex_layouts.py [--dir output/partitions] [--full] [--workers N]
+"""
+import os
+import json
+import time
+import sqlite3
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import keyboard_layout
+from storage import DB_PATH, SCHEMA, layout_page_rows
+
+PARTITIONS_DIR = os.path.join('output', 'partitions')
+POOL_THRESHOLD = 64  # 待处理文件少于该数量时直接在当前进程中解析
+
+
+def scan(directory):
+    """返回 {JSON 文件名: (mtime_ns, 大小)}。"""
+    files = {}
+    try:
+        entries = os.scandir(directory)
+    except FileNotFoundError:
+        return files
+    with entries:
+        for entry in entries:
+            if entry.name.endswith('.json') and entry.is_file():
+                stat = entry.stat()
+                files[entry.name] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+def build_rows(directory, json_file):
+    """
+    解析一个分区 JSON 文件并生成布局，在工作进程中执行。
+
+    Returns:
+        tuple: (JSON 文件名, ROM 文件名, 总页数, 逐页记录, 错误信息)，成功时错误信息为 None。
+    """
+    rom_file_name = os.path.splitext(json_file)[0] + ".zip"
+    try:
+        with open(os.path.join(directory, json_file), 'r') as f:
+            partitions_info = json.load(f)
+        layout_data = keyboard_layout.build_layout(partitions_info, rom_file_name)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        return json_file, rom_file_name, 0, [], str(e)
+    return json_file, rom_file_name, layout_data["total_pages"], layout_page_rows(rom_file_name, layout_data), None
+
+
+def build_all(directory, json_files, workers=None):
+    if len(json_files) < POOL_THRESHOLD or workers == 1:
+        return [build_rows(directory, json_file) for json_file in json_files]
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, len(json_files) // (workers * 8))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(build_rows, [directory] * len(json_files), json_files, chunksize=chunksize))
+
+
+def reindex(directory=PARTITIONS_DIR, db_path=DB_PATH, full=False, workers=None):
+    """
+    重建有变化的键盘布局。
+
+    Args:
+        directory: 分区 JSON 文件所在目录。
+        db_path: 数据库路径。
+        full: 忽略索引，重建全部布局。
+        workers: 解析 JSON 的进程数，默认等于 CPU 数。
+
+    Returns:
+        dict: 扫描、重建、失败、移除的文件数和总耗时。
+    """
+    started = time.monotonic()
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        for statement in SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+
+        files = scan(directory)
+        index = {
+            json_file: (mtime_ns, size, version)
+            for json_file, mtime_ns, size, version in conn.execute(
+                'SELECT json_file, mtime_ns, size, version FROM layout_index'
+            )
+        }
+        changed = [
+            json_file for json_file, stat in files.items()
+            if full or index.get(json_file) != (*stat, keyboard_layout.LAYOUT_VERSION)
+        ]
+        removed = [(json_file,) for json_file in index if json_file not in files]
+
+        page_rows, trim_rows, index_rows, failed = [], [], [], []
+        for json_file, rom_file_name, total_pages, rows, error in build_all(directory, changed, workers):
+            if error is not None:
+                failed.append((json_file, error))
+                continue
+            page_rows.extend(rows)
+            trim_rows.append((rom_file_name, total_pages))
+            index_rows.append((json_file, *files[json_file], keyboard_layout.LAYOUT_VERSION))
+
+        with conn:
+            conn.executemany(
+                'DELETE FROM keyboard_layout_pages WHERE file_name = ? AND page_number > ?', trim_rows,
+            )
+            conn.executemany(
+                'INSERT OR REPLACE INTO keyboard_layout_pages (file_name, page_number, total_pages, keyboard) VALUES (?, ?, ?, ?)',
+                page_rows,
+            )
+            conn.executemany(
+                'INSERT OR REPLACE INTO layout_index (json_file, mtime_ns, size, version) VALUES (?, ?, ?, ?)',
+                index_rows,
+            )
+            conn.executemany('DELETE FROM layout_index WHERE json_file = ?', removed)
+    finally:
+        conn.close()
+
+    for json_file, error in failed:
+        print(f"Skipping {json_file}: {error}")
+    return {
+        "scanned": len(files),
+        "rebuilt": len(index_rows),
+        "failed": len(failed),
+        "removed": len(removed),
+        "seconds": round(time.monotonic() - started, 3),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--dir', default=PARTITIONS_DIR, help='directory containing partition JSON files')
+    parser.add_argument('--db', default=DB_PATH, help='SQLite database path')
+    parser.add_argument('--full', action='store_true', help='rebuild every layout, ignoring the index')
+    parser.add_argument('--workers', type=int, help='parser processes, default CPU count')
+    args = parser.parse_args(argv)
+    result = reindex(args.dir, args.db, args.full, args.workers)
+    print(
+        f"Scanned {result['scanned']} files: {result['rebuilt']} rebuilt, {result['failed']} failed, "
+        f"{result['removed']} removed in {result['seconds']}s"
+    )
+
+
+if __name__ == '__main__':
+    main()
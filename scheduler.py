@@ -0,0 +1,81 @@
+import os
+import asyncio
+import logging
+import itertools
+from collections import OrderedDict
+
+EXTRACTION_SLOTS = int(os.getenv('EXTRACTION_SLOTS', '1'))  # 同时运行的提取任务数
+
+
+class _Ticket:
+    __slots__ = ('id', 'future', 'on_position', 'position')
+
+    def __init__(self, ticket_id, future, on_position):
+        self.id = ticket_id
+        self.future = future
+        self.on_position = on_position
+        self.position = None
+
+
+class JobScheduler:
+    """有 N 个执行槽位的 FIFO 任务调度器。
+
+    等待者按到达顺序排队，入队、出队和取消都是 O(1)。排队位置变化时主动回调
+    on_position(position)，position 表示轮到自己之前还需要完成的任务数。
+    等待中的协程被取消时会自动离开队列，持有槽位的任务结束时必须调用 release。
+    """
+
+    def __init__(self, slots=EXTRACTION_SLOTS):
+        self.slots = slots
+        self.active = 0
+        self._waiters = OrderedDict()
+        self._ticket_ids = itertools.count(1)
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    async def acquire(self, on_position=None):
+        if self.active < self.slots and not self._waiters:
+            self.active += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        ticket = _Ticket(next(self._ticket_ids), future, on_position)
+        self._waiters[ticket.id] = ticket
+        self._notify(ticket, len(self._waiters))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 槽位已经转交给我们，但调用方被取消了，交给下一个等待者
+                self.release()
+            elif self._waiters.pop(ticket.id, None) is not None:
+                self._push_positions()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, ticket = self._waiters.popitem(last=False)
+            if not ticket.future.done():
+                # 槽位直接转交给队首，active 计数不变
+                ticket.future.set_result(None)
+                self._push_positions()
+                return
+        self.active -= 1
+
+    def _notify(self, ticket, position):
+        if ticket.on_position is None or ticket.position == position:
+            return
+        ticket.position = position
+        try:
+            ticket.on_position(position)
+        except Exception as e:
+            logging.warning(f"Queue position callback failed: {e}")
+
+    def _push_positions(self):
+        for position, ticket in enumerate(self._waiters.values(), start=1):
+            self._notify(ticket, position)
+
+
+extraction_scheduler = JobScheduler()
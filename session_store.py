@@ -0,0 +1,154 @@
+import os
+import sys
+import time
+import asyncio
+from collections import OrderedDict
+
+SESSION_MAX_ENTRIES = int(os.getenv('SESSION_MAX_ENTRIES', '10000'))  # 最多保留的用户会话数
+SESSION_IDLE_TTL = int(os.getenv('SESSION_IDLE_TTL', '3600'))  # 会话闲置多久后淘汰（秒）
+
+
+class Session:
+    """一个用户的会话数据。
+
+    字段固定，使用 __slots__ 避免每个会话携带 __dict__。保留 session["url"]、
+    session.get("url") 这类字典式访问，未设置的字段为 None。
+
+    footprint 是会话的估算内存占用，在字段赋值时增量更新，变化量通过 on_resize(delta)
+    通知所属的 SessionStore。字段的值需要整体替换，原地修改不会计入。
+    """
+
+    __slots__ = (
+        'url', 'ROM_file_name', 'file_name', 'partition_name', 'partitions_info',
+        'partition_file_path', 'current_page', 'lock', 'last_access', 'footprint', 'on_resize',
+    )
+    FIELDS = __slots__[:7]
+
+    def __init__(self, on_resize=None):
+        for field in self.FIELDS:
+            setattr(self, field, None)
+        self.lock = asyncio.Lock()
+        self.last_access = time.monotonic()
+        self.footprint = sys.getsizeof(self) + len(self.FIELDS) * sys.getsizeof(None)
+        self.on_resize = on_resize
+
+    def _field(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return key
+
+    def __getitem__(self, key):
+        return getattr(self, self._field(key))
+
+    def __setitem__(self, key, value):
+        field = self._field(key)
+        delta = _deep_size(value, set()) - _deep_size(getattr(self, field), set())
+        setattr(self, field, value)
+        if delta:
+            self.footprint += delta
+            if self.on_resize is not None:
+                self.on_resize(delta)
+
+    def get(self, key, default=None):
+        value = getattr(self, self._field(key))
+        return default if value is None else value
+
+    def pop(self, key, default=None):
+        value = self.get(key, default)
+        self[key] = None
+        return value
+
+
+def _deep_size(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_size(k, seen) + _deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_deep_size(item, seen) for item in obj)
+    return size
+
+
+class SessionStore:
+    """有界的用户会话存储，替代按用户无限增长的全局字典。
+
+    会话按最近访问排序，闲置超过 idle_ttl 或总数超过 maxsize 时淘汰最久未访问的会话，
+    用户锁随会话一起释放。锁被持有的会话正在处理请求，不会被淘汰。
+    """
+
+    def __init__(self, maxsize=SESSION_MAX_ENTRIES, idle_ttl=SESSION_IDLE_TTL):
+        self.maxsize = maxsize
+        self.idle_ttl = idle_ttl
+        self._sessions = OrderedDict()  # user_id -> Session，最久未访问的在前
+        self.created = 0
+        self.expired = 0  # 因闲置超时淘汰的会话数
+        self.evicted = 0  # 因数量超限淘汰的会话数
+        self._footprint = 0  # 所有会话 footprint 之和
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, user_id):
+        session = self._sessions.get(user_id)
+        return session is not None and not self._is_expired(session, time.monotonic())
+
+    def __getitem__(self, user_id):
+        """取得用户会话并刷新访问时间，不存在时新建。"""
+        now = time.monotonic()
+        session = self._sessions.get(user_id)
+        if session is not None and self._is_expired(session, now):
+            self._drop(user_id)
+            self.expired += 1
+            session = None
+        if session is None:
+            session = Session(self._resize)
+            self._sessions[user_id] = session
+            self._footprint += session.footprint
+            self.created += 1
+            self._evict(now)
+        session.last_access = now
+        self._sessions.move_to_end(user_id)
+        return session
+
+    def lock(self, user_id):
+        return self[user_id].lock
+
+    def _is_expired(self, session, now):
+        return now - session.last_access > self.idle_ttl and not session.lock.locked()
+
+    def _resize(self, delta):
+        self._footprint += delta
+
+    def _drop(self, user_id):
+        session = self._sessions.pop(user_id)
+        # 处理中的请求可能仍持有该会话，之后的赋值不再计入
+        session.on_resize = None
+        self._footprint -= session.footprint
+
+    def _evict(self, now):
+        # 从最久未访问的一端开始检查，跳过锁被持有的会话
+        for _ in range(len(self._sessions)):
+            user_id, session = next(iter(self._sessions.items()))
+            over_size = len(self._sessions) > self.maxsize
+            if not over_size and now - session.last_access <= self.idle_ttl:
+                break
+            if session.lock.locked():
+                self._sessions.move_to_end(user_id)
+                continue
+            self._drop(user_id)
+            if over_size:
+                self.evicted += 1
+            else:
+                self.expired += 1
+
+    def stats(self):
+        """会话数量、淘汰次数和估算的内存占用（字节）。内存占用是增量维护的，不遍历会话。"""
+        return {
+            "sessions": len(self._sessions),
+            "created": self.created,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "memory_bytes": sys.getsizeof(self._sessions) + self._footprint,
+        }
@@ -0,0 +1,123 @@
+import asyncio
+
+STREAM_LIMIT = 1024 * 1024
+
+
+class SingleFlight:
+    """相同 key 的并发调用只真正执行一次，其余调用方等待并共享同一个结果。"""
+
+    def __init__(self):
+        self._inflight = {}
+
+    def __contains__(self, key):
+        return key in self._inflight
+
+    async def do(self, key, func, *args):
+        """执行 func(*args) 或加入正在执行的同 key 调用。
+
+        Returns:
+            tuple: (结果, 是否共享了其他调用方的执行)。
+        """
+        future = self._inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await func(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # 没有其他等待者时避免 "exception was never retrieved"
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self._inflight[key]
+
+
+class SharedJob:
+    """把一个任务的输出广播给多个订阅者。
+
+    后加入的订阅者会先收到已经输出过的全部内容，之后与其他订阅者同步接收新输出。
+    每个订阅者得到的对象都具有 stdout/stderr StreamReader 和 wait()，
+    与 worker_pool.Job 用法相同。
+    """
+
+    def __init__(self, observer=None):
+        self._observer = observer  # observer(stream, line)，每行输出调用一次，用于统计
+        self._history = []  # [(stream, line)]
+        self._subscribers = []
+        self._done = asyncio.get_running_loop().create_future()
+        self.id = None
+        self.returncode = None
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def subscribe(self):
+        subscriber = _Subscriber(self)
+        for stream, line in self._history:
+            subscriber.feed(stream, line)
+        if self._done.done():
+            subscriber.finish()
+        else:
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def feed(self, stream, line):
+        if self._observer is not None:
+            self._observer(stream, line)
+        self._history.append((stream, line))
+        for subscriber in self._subscribers:
+            subscriber.feed(stream, line)
+
+    async def pump(self, job):
+        """转发 job 的全部输出并在其结束后结束广播。"""
+        self.id = job.id
+
+        async def forward(reader, stream):
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.feed(stream, line.decode().rstrip("\n"))
+
+        await asyncio.gather(forward(job.stdout, 'stdout'), forward(job.stderr, 'stderr'))
+        self.finish(await job.wait())
+
+    def finish(self, returncode=1):
+        if self._done.done():
+            return
+        self.returncode = returncode
+        self._done.set_result(returncode)
+        for subscriber in self._subscribers:
+            subscriber.finish()
+        self._subscribers = []
+
+    async def wait(self):
+        return await asyncio.shield(self._done)
+
+
+class _Subscriber:
+    def __init__(self, shared):
+        self._shared = shared
+        self.stdout = asyncio.StreamReader(limit=STREAM_LIMIT)
+        self.stderr = asyncio.StreamReader(limit=STREAM_LIMIT)
+
+    @property
+    def id(self):
+        return self._shared.id
+
+    def feed(self, stream, line):
+        target = self.stdout if stream == 'stdout' else self.stderr
+        target.feed_data(f"{line}\n".encode())
+
+    def finish(self):
+        self.stdout.feed_eof()
+        self.stderr.feed_eof()
+
+    async def wait(self):
+        return await self._shared.wait()
@@ -0,0 +1,83 @@
+import os
+
+from storage import sync_connection
+
+UPLOAD_LIMIT = 50 * 1000 * 1000  # Telegram Bot API 上传文件大小上限
+SPLIT_MAX_PARTS = int(os.getenv('SPLIT_MAX_PARTS', '8'))  # 超过上传上限的产物最多分成的卷数
+SIZE_LIMIT = UPLOAD_LIMIT * SPLIT_MAX_PARTS  # 分卷后能够发送的压缩大小上限
+XZ_TO_DEFLATE = float(os.getenv('PREDICT_XZ_TO_DEFLATE', '1.25'))  # xz/bzip2 数据改用 deflate 压缩后大约变大的倍数
+ZERO_RATIO = 1 / 1000  # deflate 对全零数据的压缩比约为 1:1000
+OVERSIZE_MARGIN = float(os.getenv('PREDICT_OVERSIZE_MARGIN', '1.3'))  # 预测值超过上限的该倍数才认为必然失败
+RATIO_WINDOW = 20  # 历史修正系数按最近约 20 次的滑动平均更新
+DEFAULT_BLOCK_SIZE = 4096
+
+
+def estimate(partition, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    根据 manifest 中各操作的类型和数据长度估算分区压缩为 zip 后的大小。
+
+    Returns:
+        int: 估算的字节数；分区包含增量操作等无法估算的情况返回 None。
+    """
+    import payload_dumper.update_metadata_pb2 as um
+    op = um.InstallOperation
+    size = 0.0
+    for operation in partition.operations:
+        if operation.type in (op.REPLACE_XZ, op.REPLACE_BZ):
+            size += operation.data_length * XZ_TO_DEFLATE
+        elif operation.type == op.REPLACE:
+            # 生成 payload 时只有压缩无效的数据才会保留为 REPLACE
+            size += operation.data_length
+        elif operation.type in (op.ZERO, op.DISCARD):
+            size += sum(extent.num_blocks for extent in operation.dst_extents) * block_size * ZERO_RATIO
+        else:
+            return None
+    return int(size)
+
+
+def load_ratios():
+    """读取各分区名的历史修正系数（实际压缩大小 / 估算大小）。"""
+    return dict(sync_connection().execute('SELECT partition_name, ratio FROM compression_ratios').fetchall())
+
+
+def predict(partition, ratios=None, block_size=DEFAULT_BLOCK_SIZE):
+    """用历史修正系数校正后的压缩大小预测，无法估算时返回 None。"""
+    estimated = estimate(partition, block_size)
+    if estimated is None:
+        return None
+    if ratios is None:
+        ratios = load_ratios()
+    return int(estimated * ratios.get(partition.partition_name, 1.0))
+
+
+def is_oversize(predicted_size):
+    """预测值明显超过分卷后的大小上限时认为必然失败。"""
+    return predicted_size is not None and predicted_size > SIZE_LIMIT * OVERSIZE_MARGIN
+
+
+def record(partition_name, estimated, actual):
+    """用一次实际压缩结果更新该分区名的修正系数。"""
+    if not estimated:
+        return
+    sample = actual / estimated
+    conn = sync_connection()
+    with conn:
+        row = conn.execute(
+            'SELECT ratio, samples FROM compression_ratios WHERE partition_name = ?', (partition_name,)
+        ).fetchone()
+        if row is None:
+            ratio, samples = sample, 1
+        else:
+            ratio, samples = row
+            samples += 1
+            ratio += (sample - ratio) / min(samples, RATIO_WINDOW)
+        conn.execute(
+            'INSERT OR REPLACE INTO compression_ratios (partition_name, ratio, samples) VALUES (?, ?, ?)',
+            (partition_name, ratio, samples),
+        )
+
+
+def button_text(info):
+    """分区按钮的文字，预测必然超过大小上限的分区加上 🚫 标记。"""
+    text = f"{info['partition_name']}({info['size_readable']})"
+    return f"🚫{text}" if info.get("oversize") else text
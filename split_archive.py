@@ -0,0 +1,103 @@
+import os
+
+import artifact_cache
+from size_predictor import UPLOAD_LIMIT
+
+PART_SIZE = UPLOAD_LIMIT  # 每一卷的大小，保证单卷可以通过 Bot API 上传
+MANIFEST_SUFFIX = ".parts"  # 与 artifact_cache.UNTRACKED_SUFFIXES 一致，清单不参与淘汰
+COPY_CHUNK = 8 * 1024 * 1024
+
+
+def part_path(path, index):
+    """第 index 卷（从 1 开始）的路径，如 boot_xxx.zip.001，7-Zip 可以直接打开。"""
+    return f"{path}.{index:03d}"
+
+
+def manifest_path(path):
+    return f"{path}{MANIFEST_SUFFIX}"
+
+
+def _copy_range(src, dst, offset, length):
+    copied = 0
+    while copied < length:
+        try:
+            n = os.copy_file_range(src, dst, length - copied, offset + copied)
+        except (AttributeError, OSError):
+            # 不支持 copy_file_range 的平台或文件系统
+            n = os.write(dst, os.pread(src, min(COPY_CHUNK, length - copied), offset + copied))
+        if n == 0:
+            raise OSError(f"Unexpected end of file at {offset + copied}")
+        copied += n
+
+
+def split(source, path, part_size=PART_SIZE):
+    """
+    把 source 按 part_size 切成编号分卷并写出清单，完成后删除 source。
+
+    各卷按顺序拼接即得到完整的 zip（cat path.* > file.zip）。
+
+    Args:
+        source: 完整的 zip 文件。
+        path: 产物路径，分卷为 path.001、path.002…，清单为 path.parts。
+
+    Returns:
+        list: 各分卷的路径。
+    """
+    size = os.path.getsize(source)
+    parts = []
+    src = os.open(source, os.O_RDONLY)
+    try:
+        for offset in range(0, size, part_size):
+            part = part_path(path, len(parts) + 1)
+            temp = artifact_cache.temp_path(part)
+            dst = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                _copy_range(src, dst, offset, min(part_size, size - offset))
+            finally:
+                os.close(dst)
+            os.replace(temp, part)
+            parts.append(part)
+    finally:
+        os.close(src)
+    # 清单最后写出，存在清单即说明所有分卷都已完整生成
+    temp = artifact_cache.temp_path(manifest_path(path))
+    with open(temp, "w") as f:
+        f.write("\n".join(os.path.basename(part) for part in parts))
+    os.replace(temp, manifest_path(path))
+    os.remove(source)
+    return parts
+
+
+def read_parts(path):
+    """读取产物的分卷清单，没有分卷时返回 None。"""
+    try:
+        with open(manifest_path(path)) as f:
+            names = f.read().split()
+    except FileNotFoundError:
+        return None
+    directory = os.path.dirname(path)
+    return [os.path.join(directory, name) for name in names]
+
+
+def lookup(path, remote_ok=False):
+    """
+    检查分卷产物是否可用并记录命中。
+
+    Args:
+        remote_ok: 为 True 时，已有 file_id 的分卷即使本地文件已被淘汰也算可用。
+
+    Returns:
+        list: 每一卷都可用时返回各分卷路径，否则返回 None。
+    """
+    parts = read_parts(path)
+    if not parts:
+        return None
+    if all([artifact_cache.lookup(part, remote_ok=remote_ok) for part in parts]):
+        return parts
+    return None
+
+
+def register(path, parts):
+    """登记各分卷。清单不登记，只要还有分卷可用就一直保留。"""
+    for part in parts:
+        artifact_cache.register(part)
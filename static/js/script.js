@@ -126,6 +126,85 @@ $(document).ready(function() {
         startStream(partitionName, url);
     });
 
+    // 格式化字节数
+    const formatSize = (size) => {
+        const units = ['B', 'KB', 'MB', 'GB'];
+        let unit = 0;
+        while (size >= 1024 && unit < units.length - 1) {
+            size /= 1024;
+            unit++;
+        }
+        return unit === 0 ? `${size}B` : `${size.toFixed(1)}${units[unit]}`;
+    };
+
+    // 解析一行 JSON 事件，不是事件时返回 null
+    const parseEvent = (data) => {
+        if (!data.startsWith("{")) {
+            return null;
+        }
+        try {
+            const parsed = JSON.parse(data);
+            return parsed && parsed.event ? parsed : null;
+        } catch (e) {
+            return null;
+        }
+    };
+
+    // 显示生成的文件并开始下载
+    const showFile = (filePath) => {
+        const fileName = filePath.split('/').pop();
+        const subdir = filePath.split('/').slice(-2, -1).join('');
+        $('#file-name').html(fileName).off('click').on('click', function() {
+            window.location.href = `/download/zip/${subdir}/${fileName}`;
+        });
+        $('#file').removeClass('hidden');
+        $('#loading-bar').addClass('hidden');
+        $('#status').addClass('hidden').html('');
+        setTimeout(() => {
+            window.location.href = `/download/zip/${subdir}/${fileName}`;
+        }, 100);
+    };
+
+    // 显示分卷产物的下载链接，各卷需要分别下载后再合并
+    const showParts = (parts) => {
+        const links = parts.map((partPath) => {
+            const fileName = partPath.split('/').pop();
+            const subdir = partPath.split('/').slice(-2, -1).join('');
+            return `<a href="/download/zip/${subdir}/${fileName}">${fileName}</a>`;
+        });
+        $('#file-name').html(links.join('<br>')).off('click');
+        $('#file').removeClass('hidden');
+        $('#loading-bar').addClass('hidden');
+        $('#status').addClass('hidden').html('');
+    };
+
+    // 处理 file_processor 输出的事件
+    const handleEvent = (progressEvent) => {
+        switch (progressEvent.event) {
+            case "status":
+                $('#status').removeClass('hidden').html(progressEvent.message.replace(/\n/g, "<br>"));
+                break;
+            case "progress": {
+                const { stage, done, total, elapsed } = progressEvent;
+                const percent = total ? Math.floor(done * 100 / total) : 100;
+                const speed = elapsed ? `${formatSize(Math.floor(done / elapsed))}/s` : '-';
+                $('#status').removeClass('hidden').html(`${stage}: ${percent}% (${formatSize(done)}/${formatSize(total)}, ${speed})`);
+                break;
+            }
+            case "error":
+                $('#error').html('<span class="error-icon">&#x26A0;</span>' + progressEvent.message.replace(/\n/g, "<br>")).removeClass('hidden');
+                $('#loading-bar').addClass('hidden');
+                break;
+            case "artifact":
+                if (progressEvent.parts) {
+                    showParts(progressEvent.parts);
+                } else {
+                    showFile(progressEvent.path);
+                }
+                break;
+        }
+    };
+
     // 开始流处理
     const startStream = (partitionName, url) => {
         if (partitionName && !validateArg2()) {
@@ -144,6 +223,12 @@ $(document).ready(function() {
         const eventSource = new EventSource(`/stream?p=${encodeURIComponent(partitionName)}&u=${encodeURIComponent(url)}`);
 
         eventSource.onmessage = function(event) {
+            // file_processor 和排队脚本输出的 JSON 事件
+            const progressEvent = parseEvent(event.data);
+            if (progressEvent) {
+                handleEvent(progressEvent);
+                return;
+            }
             if (event.data === "SCRIPT_FINISHED") {
                 eventSource.close();
                 $('#loading-bar').addClass('hidden');
@@ -162,18 +247,7 @@ $(document).ready(function() {
                 $('#loading-bar').addClass('hidden');
                 currentError = '';
             } else if (event.data.startsWith("FILE:")) {
-                const filePath = event.data.substring(5).trim();
-                const fileName = filePath.split('/').pop();
-                const subdir = filePath.split('/').slice(-2, -1).join('');
-                $('#file-name').html(fileName).off('click').on('click', function() {
-                    window.location.href = `/download/zip/${subdir}/${fileName}`;
-                });
-                $('#file').removeClass('hidden');
-                $('#loading-bar').addClass('hidden');
-                $('#status').addClass('hidden').html('');
-                setTimeout(() => {
-                    window.location.href = `/download/zip/${subdir}/${fileName}`;
-                }, 100);
+                showFile(event.data.substring(5).trim());
             } else if (event.data.startsWith("BUTTONS:")) {
                 buttonsSection.html(event.data.substring(8).trim()).removeClass('hidden');
                 $('#loading-bar').addClass('hidden');
@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DB_PATH = os.getenv('DB_PATH', 'file_cache.db')
+SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS', '50'))  # 超过该耗时的查询记录警告
+STATEMENT_CACHE_SIZE = 128
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS file_cache (
+        file_name TEXT PRIMARY KEY,
+        file_id TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS keyboard_layouts (
+        file_name TEXT PRIMARY KEY,
+        layout_data TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS keyboard_layout_pages (
+        file_name TEXT NOT NULL,
+        page_number INTEGER NOT NULL,
+        total_pages INTEGER NOT NULL,
+        keyboard TEXT NOT NULL,
+        PRIMARY KEY (file_name, page_number)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS compression_ratios (
+        partition_name TEXT PRIMARY KEY,
+        ratio REAL NOT NULL,
+        samples INTEGER NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS artifacts (
+        path TEXT PRIMARY KEY,
+        file_name TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        last_access REAL NOT NULL,
+        hits INTEGER NOT NULL DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS layout_index (
+        json_file TEXT PRIMARY KEY,
+        mtime_ns INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        version INTEGER NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS url_probes (
+        url TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        etag TEXT,
+        file_name TEXT NOT NULL,
+        payload_offset INTEGER NOT NULL,
+        data_offset INTEGER NOT NULL,
+        payload_version INTEGER NOT NULL,
+        manifest BLOB NOT NULL,
+        metadata TEXT,
+        probed_at REAL NOT NULL
+    )
+    ''',
+]
+
+
+def layout_page_rows(file_name, layout_data):
+    """把整份键盘布局拆成 keyboard_layout_pages 的逐页记录。"""
+    total_pages = layout_data["total_pages"]
+    return [
+        (file_name, page["page_number"], total_pages, json.dumps(page["keyboard"]))
+        for page in layout_data["pages"]
+    ]
+
+
+def migrate_keyboard_layouts(conn):
+    """把旧版 keyboard_layouts 中的整份 JSON 布局迁移为逐页存储。"""
+    rows = conn.execute('SELECT file_name, layout_data FROM keyboard_layouts').fetchall()
+    if not rows:
+        return
+    page_rows = []
+    for file_name, layout_data in rows:
+        try:
+            page_rows.extend(layout_page_rows(file_name, json.loads(layout_data)))
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Skipping malformed keyboard layout for {file_name}: {e}")
+    with conn:
+        conn.executemany(
+            'INSERT OR IGNORE INTO keyboard_layout_pages (file_name, page_number, total_pages, keyboard) VALUES (?, ?, ?, ?)',
+            page_rows,
+        )
+        conn.execute('DELETE FROM keyboard_layouts')
+    logging.info(f"Migrated {len(rows)} keyboard layouts to per-page storage")
+
+
+_sync_conn = None
+
+
+def sync_connection():
+    """工作进程中使用的同步连接，整个进程共用一个。"""
+    global _sync_conn
+    if _sync_conn is None:
+        _sync_conn = sqlite3.connect(DB_PATH, timeout=30)
+        for statement in SCHEMA:
+            _sync_conn.execute(statement)
+        _sync_conn.commit()
+    return _sync_conn
+
+
+class Storage:
+    """file_cache.db 的异步访问层。
+
+    所有查询都在一个专用线程中通过同一个长连接执行，不会阻塞事件循环。
+    写操作会先进入缓冲区，由同一线程在一个事务里批量提交；由于线程按提交顺序
+    执行任务，之后发起的读操作总能读到之前的写入。
+    """
+
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+        self._conn = None
+        self._write_lock = threading.Lock()
+        self._pending_writes = []
+        self._batch_future = None
+        self.query_stats = {}  # 查询名 -> [次数, 总耗时, 最大耗时]
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                check_same_thread=False,
+                cached_statements=STATEMENT_CACHE_SIZE,
+            )
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            for statement in SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+            migrate_keyboard_layouts(conn)
+            self._conn = conn
+        return self._conn
+
+    def _record(self, name, elapsed):
+        stats = self.query_stats.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+        if elapsed * 1000 > SLOW_QUERY_MS:
+            logging.warning(f"Slow query {name}: {elapsed * 1000:.1f} ms")
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _query(self, name, sql, params, fetch):
+        started = time.perf_counter()
+        cursor = self._connect().execute(sql, params)
+        if fetch == 'one':
+            result = cursor.fetchone()
+        else:
+            result = cursor.fetchall()
+        self._record(name, time.perf_counter() - started)
+        return result
+
+    async def fetchone(self, name, sql, params=()):
+        return await self._run(self._query, name, sql, params, 'one')
+
+    async def fetchall(self, name, sql, params=()):
+        return await self._run(self._query, name, sql, params, 'all')
+
+    def _call(self, name, func, args):
+        started = time.perf_counter()
+        try:
+            return func(*args, conn=self._connect())
+        finally:
+            self._record(name, time.perf_counter() - started)
+
+    async def call(self, name, func, *args):
+        """在数据库线程中执行 func(*args, conn=连接)，用于复用工作进程中的同步查询函数。"""
+        return await self._run(self._call, name, func, args)
+
+    def _flush(self):
+        with self._write_lock:
+            pending, self._pending_writes = self._pending_writes, []
+            self._batch_future = None
+        if not pending:
+            return
+        conn = self._connect()
+        started = time.perf_counter()
+        try:
+            with conn:
+                for name, sql, params, many in pending:
+                    if many:
+                        conn.executemany(sql, params)
+                    else:
+                        conn.execute(sql, params)
+        except sqlite3.Error as e:
+            logging.error(f"Failed to commit {len(pending)} queued writes: {e}")
+            raise
+        finally:
+            self._record('write_batch', time.perf_counter() - started)
+
+    def _enqueue(self, writes):
+        with self._write_lock:
+            self._pending_writes.extend(writes)
+            if self._batch_future is None:
+                loop = asyncio.get_running_loop()
+                self._batch_future = loop.run_in_executor(self._executor, self._flush)
+            return self._batch_future
+
+    async def execute(self, name, sql, params=()):
+        """排队一条写语句，在所在批次提交后返回。"""
+        await self._enqueue([(name, sql, params, False)])
+
+    async def executemany(self, name, sql, seq_of_params):
+        await self._enqueue([(name, sql, list(seq_of_params), True)])
+
+    async def batch(self, writes):
+        """一次排队多条写语句，保证它们在同一个事务里提交。
+
+        Args:
+            writes: [(查询名, sql, 参数, 是否 executemany)]。
+        """
+        await self._enqueue([
+            (name, sql, list(params) if many else params, many) for name, sql, params, many in writes
+        ])
+
+    async def close(self):
+        await self._run(self._flush)
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+
+db = Storage()
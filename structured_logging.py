@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import queue
+import atexit
+import logging
+import itertools
+import contextvars
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_DIR = os.getenv('LOG_DIR', 'logs')
+LOG_FILE = os.getenv('LOG_FILE', 'bot.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(20 * 1024 * 1024)))  # 单个日志文件上限
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))  # 保留的轮转文件数
+LOG_SAMPLE_EVERY = int(os.getenv('LOG_SAMPLE_EVERY', '20'))  # 高频日志每 N 条记录 1 条
+LOG_UTC_OFFSET = 8 * 3600  # 日志时间使用 UTC+8
+# 这些库在 INFO 级别记录每一个 HTTP 请求
+QUIET_LOGGERS = ('httpx', 'httpcore')
+
+correlation_id = contextvars.ContextVar('correlation_id', default=None)
+_ids = itertools.count(1)
+
+
+def new_id(prefix):
+    """生成进程内唯一的关联 ID，如 job-12。"""
+    return f"{prefix}-{next(_ids)}"
+
+
+def bind(cid):
+    """把关联 ID 绑定到当前上下文，之后在此上下文（及其创建的任务）中记录的日志都带上它。"""
+    correlation_id.set(cid)
+
+
+class CorrelationFilter(logging.Filter):
+    """在产生日志的线程中读取关联 ID，写入 record.cid。"""
+
+    def filter(self, record):
+        record.cid = correlation_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志格式化为一行 JSON：ts、level、msg，以及可选的 cid、logger。"""
+
+    def __init__(self, utc_offset=LOG_UTC_OFFSET):
+        super().__init__()
+        self.utc_offset = utc_offset
+        sign = '+' if utc_offset >= 0 else '-'
+        self._suffix = f"{sign}{abs(utc_offset) // 3600:02d}:{abs(utc_offset) % 3600 // 60:02d}"
+        self._second = None
+        self._prefix = None
+
+    def _timestamp(self, created):
+        # 同一秒内的记录复用已格式化的日期时间部分
+        second = int(created)
+        if second != self._second:
+            self._second = second
+            self._prefix = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(second + self.utc_offset))
+        return f"{self._prefix}.{int((created - second) * 1000):03d}{self._suffix}"
+
+    def format(self, record):
+        entry = {"ts": self._timestamp(record.created), "level": record.levelname, "msg": record.getMessage()}
+        cid = getattr(record, 'cid', None)
+        if cid:
+            entry["cid"] = cid
+        if record.name != 'root':
+            entry["logger"] = record.name
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class LogSampler:
+    """
+    高频日志采样：第 1 条和之后每 every 条返回 True。
+
+    Args:
+        every (int): 采样间隔，小于等于 1 时全部记录。
+    """
+
+    def __init__(self, every=LOG_SAMPLE_EVERY):
+        self.every = every
+        self.count = 0
+
+    def __call__(self):
+        self.count += 1
+        return self.every <= 1 or (self.count - 1) % self.every == 0
+
+    @property
+    def dropped(self):
+        """到目前为止未记录的条数。"""
+        if self.every <= 1:
+            return 0
+        return self.count - (self.count + self.every - 1) // self.every
+
+
+def setup(log_dir=LOG_DIR, level=LOG_LEVEL):
+    """
+    配置根日志记录器：记录在调用线程中放入队列，由后台线程写入按大小轮转的 JSON 日志文件。
+
+    Returns:
+        QueueListener: 已启动的后台写入线程，进程退出时自动停止并写完剩余记录。
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    file_handler = RotatingFileHandler(
+        os.path.join(log_dir, LOG_FILE), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8',
+    )
+    file_handler.setFormatter(JsonFormatter())
+
+    records = queue.SimpleQueue()
+    queue_handler = QueueHandler(records)
+    queue_handler.addFilter(CorrelationFilter())
+
+    logger = logging.getLogger()
+    logger.setLevel(level)
+    logger.addHandler(queue_handler)
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    listener = QueueListener(records, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,79 @@
+import os
+import asyncio
+import logging
+from collections import deque
+
+from ttl_cache import TTLCache
+
+DISPATCH_WORKERS = int(os.getenv('DISPATCH_WORKERS', '16'))  # 同时处理的更新数
+UPDATE_DEDUPE_SIZE = 10000
+UPDATE_DEDUPE_TTL = 3600  # Telegram 重发更新的时间窗口内记住已收到的 update_id（秒）
+
+
+class UpdateDispatcher:
+    """在后台处理 webhook 更新。
+
+    webhook 收到更新后立即返回，更新交给这里排队：同一用户的更新按到达顺序逐个处理，
+    不同用户之间并行，总并发数不超过 workers。最近收到过的 update_id 直接丢弃，
+    避免 Telegram 重发的更新被处理两次。
+    """
+
+    def __init__(self, handler, workers=DISPATCH_WORKERS):
+        self._handler = handler  # async handler(update)
+        self._slots = asyncio.Semaphore(workers)
+        self._queues = {}  # user_id -> 待处理的更新
+        self._tasks = set()
+        self._seen = TTLCache(maxsize=UPDATE_DEDUPE_SIZE, ttl=UPDATE_DEDUPE_TTL)
+        self.received = 0
+        self.duplicates = 0
+        self.processed = 0
+        self.failed = 0
+
+    @property
+    def pending(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def submit(self, update_id, user_id, update):
+        """
+        把更新加入该用户的队列。
+
+        Returns:
+            bool: 是否接受；重复的 update_id 返回 False。
+        """
+        if update_id in self._seen:
+            self.duplicates += 1
+            logging.info(f"Dropping duplicate update {update_id}")
+            return False
+        self._seen.set(update_id, True)
+        self.received += 1
+
+        queue = self._queues.get(user_id)
+        if queue is None:
+            queue = deque()
+            self._queues[user_id] = queue
+            task = asyncio.create_task(self._drain(user_id, queue))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        queue.append(update)
+        return True
+
+    async def _drain(self, user_id, queue):
+        try:
+            while queue:
+                update = queue.popleft()
+                async with self._slots:
+                    try:
+                        await self._handler(update)
+                    except Exception as e:
+                        self.failed += 1
+                        logging.error(f"Failed to handle update {update.update_id} from user {user_id}: {e}")
+                    else:
+                        self.processed += 1
+        finally:
+            # 队列为空与删除之间没有 await，新更新不会丢失
+            del self._queues[user_id]
+
+    async def close(self):
+        """等待已接受的更新处理完。"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
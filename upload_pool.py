@@ -0,0 +1,114 @@
+import os
+import time
+import asyncio
+import logging
+
+from telegram import InputFile
+from telegram.error import RetryAfter
+
+from api_scheduler import API_MAX_RETRIES, retry_seconds
+from metrics import registry
+from scheduler import JobScheduler
+
+UPLOAD_SLOTS = int(os.getenv('UPLOAD_SLOTS', '2'))  # 同时进行的上传数，与提取槽位分开调节
+
+UPLOAD_WAIT = registry.histogram('dumper_upload_queue_wait_seconds', 'Time uploads wait for an upload slot')
+UPLOAD_SECONDS = registry.histogram('dumper_upload_seconds', 'Artifact upload duration', ['result'])
+
+
+class UploadPool:
+    """有界的上传池。
+
+    上传与提取使用各自的槽位，一批任务同时完成时上传在这里排队，不会占满上行带宽。
+    记录排队和上传耗时等指标，文件以流的方式从磁盘读取，不整体载入内存。
+    """
+
+    def __init__(self, slots=UPLOAD_SLOTS):
+        self._scheduler = JobScheduler(slots)
+        self.completed = 0
+        self.failed = 0
+        self.bytes_uploaded = 0
+        self.wait_seconds = 0.0  # 累计排队时间
+        self.upload_seconds = 0.0  # 累计上传时间
+
+    @property
+    def slots(self):
+        return self._scheduler.slots
+
+    @property
+    def active(self):
+        return self._scheduler.active
+
+    @property
+    def waiting(self):
+        return self._scheduler.waiting
+
+    async def run(self, file_path, upload, on_position=None):
+        """
+        排队获取上传槽位后执行 upload(document)。
+
+        收到 RetryAfter 时释放槽位，等待指定时间后重新排队，并重新打开文件，
+        避免重试时发送已读到末尾的文件流。
+
+        Args:
+            file_path: 要上传的文件。
+            upload: async upload(document)，document 为流式读取该文件的 InputFile。
+            on_position: 排队位置变化时的回调，与 JobScheduler.acquire 相同。
+
+        Returns:
+            upload 的返回值。
+        """
+        attempts = 0
+        while True:
+            try:
+                return await self._run_once(file_path, upload, on_position, retrying=attempts < API_MAX_RETRIES)
+            except RetryAfter as e:
+                if attempts >= API_MAX_RETRIES:
+                    raise
+                attempts += 1
+                seconds = retry_seconds(e)
+                logging.warning(f"Upload of {file_path} got RetryAfter {seconds}s, attempt {attempts}")
+                await asyncio.sleep(seconds)
+
+    async def _run_once(self, file_path, upload, on_position, retrying):
+        queued_at = time.monotonic()
+        await self._scheduler.acquire(on_position)
+        started = time.monotonic()
+        self.wait_seconds += started - queued_at
+        UPLOAD_WAIT.observe(started - queued_at)
+        result_label = 'error'
+        try:
+            with open(file_path, "rb") as f:
+                document = InputFile(f, filename=os.path.basename(file_path), read_file_handle=False)
+                result = await upload(document)
+        except RetryAfter:
+            if not retrying:
+                self.failed += 1
+            raise
+        except BaseException:
+            self.failed += 1
+            raise
+        else:
+            self.completed += 1
+            self.bytes_uploaded += os.path.getsize(file_path)
+            result_label = 'ok'
+            return result
+        finally:
+            self.upload_seconds += time.monotonic() - started
+            UPLOAD_SECONDS.observe(time.monotonic() - started, result=result_label)
+            self._scheduler.release()
+
+    def stats(self):
+        return {
+            "slots": self.slots,
+            "active": self.active,
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "failed": self.failed,
+            "bytes_uploaded": self.bytes_uploaded,
+            "wait_seconds": self.wait_seconds,
+            "upload_seconds": self.upload_seconds,
+        }
+
+
+upload_pool = UploadPool()
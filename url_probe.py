@@ -0,0 +1,333 @@
+import os
+import re
+import sys
+import time
+import zlib
+import struct
+
+import requests
+
+import events
+import file_check
+import size_predictor
+from storage import sync_connection
+
+PROBE_TTL = int(os.getenv('PROBE_TTL', '21600'))  # 探测记录免验证的有效期（秒）
+PROBE_TIMEOUT = float(os.getenv('PROBE_TIMEOUT', '15'))  # 单次请求超时（秒）
+TAIL_SIZE = 64 * 1024 + 22  # 一次取回 EOCD 以及通常情况下完整的中央目录
+HEADER_READ_SIZE = 4096  # 本地文件头加 payload 头部
+
+PAYLOAD_NAME = "payload.bin"
+METADATA_NAME = "META-INF/com/android/metadata"
+
+_EOCD = struct.Struct('<4s4H2LH')
+_ZIP64_LOCATOR = struct.Struct('<4sLQL')
+_ZIP64_EOCD = struct.Struct('<4sQ2H2L4Q')
+_CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+
+# 复用连接，同一个工作进程内的多次请求不再重复 TLS 握手
+session = requests.Session()
+
+class ProbeError(Exception):
+    """探测失败，message 为可直接展示给用户的中英文说明。"""
+
+
+class ProbeRecord:
+    """一次 URL 探测的结果，--list、--metadata、--dump 和校验共用。"""
+
+    __slots__ = (
+        'url', 'size', 'etag', 'file_name', 'payload_offset', 'data_offset',
+        'payload_version', 'manifest_bytes', 'metadata', 'probed_at', '_manifest',
+    )
+
+    def __init__(self, url, size, etag, file_name, payload_offset, data_offset,
+                 payload_version, manifest_bytes, metadata, probed_at):
+        self.url = url
+        self.size = size
+        self.etag = etag
+        self.file_name = file_name
+        self.payload_offset = payload_offset  # payload.bin 在 zip 中的起始位置
+        self.data_offset = data_offset  # payload 数据区在 zip 中的起始位置
+        self.payload_version = payload_version
+        self.manifest_bytes = manifest_bytes
+        self.metadata = metadata
+        self.probed_at = probed_at
+        self._manifest = None
+
+    @property
+    def manifest(self):
+        """解析后的 DeltaArchiveManifest。"""
+        if self._manifest is None:
+            import payload_dumper.update_metadata_pb2 as um
+            manifest = um.DeltaArchiveManifest()
+            manifest.ParseFromString(self.manifest_bytes)
+            self._manifest = manifest
+        return self._manifest
+
+    def find_partition(self, partition_name):
+        for partition in self.manifest.partitions:
+            if partition.partition_name == partition_name:
+                return partition
+        return None
+
+
+def _load(url):
+    row = sync_connection().execute(
+        'SELECT url, size, etag, file_name, payload_offset, data_offset, payload_version, manifest, metadata, probed_at '
+        'FROM url_probes WHERE url = ?',
+        (url,),
+    ).fetchone()
+    return ProbeRecord(*row) if row else None
+
+
+def _save(record):
+    conn = sync_connection()
+    with conn:
+        conn.execute(
+            'INSERT OR REPLACE INTO url_probes '
+            '(url, size, etag, file_name, payload_offset, data_offset, payload_version, manifest, metadata, probed_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (record.url, record.size, record.etag, record.file_name, record.payload_offset, record.data_offset,
+             record.payload_version, record.manifest_bytes, record.metadata, record.probed_at),
+        )
+
+
+def _touch(record):
+    record.probed_at = time.time()
+    conn = sync_connection()
+    with conn:
+        conn.execute('UPDATE url_probes SET probed_at = ? WHERE url = ?', (record.probed_at, record.url))
+
+
+def _fetch_range(url, start, end):
+    """获取 [start, end) 范围的数据。"""
+    response = session.get(url, headers={'Range': f'bytes={start}-{end - 1}'}, timeout=PROBE_TIMEOUT)
+    response.raise_for_status()
+    if response.status_code != 206:
+        raise ProbeError('The server does not support range requests\n服务器不支持分段下载')
+    return response.content
+
+
+def _fetch_tail(url):
+    """获取文件末尾数据，同时拿到文件大小、ETag 和 Content-Disposition。"""
+    with session.get(url, headers={'Range': f'bytes=-{TAIL_SIZE}'}, stream=True, timeout=PROBE_TIMEOUT) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise ProbeError('The server does not support range requests\n服务器不支持分段下载')
+        match = re.match(r'bytes (\d+)-(\d+)/(\d+)', response.headers.get('Content-Range', ''))
+        if not match:
+            raise ProbeError('Invalid Content-Range header\n无效的 Content-Range 头部')
+        tail_start, size = int(match.group(1)), int(match.group(3))
+        return response.content, tail_start, size, response.headers
+
+
+def _read_central_directory(url, tail, tail_start):
+    eocd_pos = tail.rfind(b'PK\x05\x06')
+    if eocd_pos < 0:
+        raise ProbeError('File is not a zip file\n文件不是 zip 格式')
+    _, _, _, _, _, cd_size, cd_offset, _ = _EOCD.unpack_from(tail, eocd_pos)
+
+    locator_pos = eocd_pos - _ZIP64_LOCATOR.size
+    if locator_pos >= 0 and tail[locator_pos:locator_pos + 4] == b'PK\x06\x07':
+        _, _, zip64_eocd_offset, _ = _ZIP64_LOCATOR.unpack_from(tail, locator_pos)
+        if zip64_eocd_offset >= tail_start:
+            record = tail[zip64_eocd_offset - tail_start:]
+        else:
+            record = _fetch_range(url, zip64_eocd_offset, zip64_eocd_offset + _ZIP64_EOCD.size)
+        *_, cd_size, cd_offset = _ZIP64_EOCD.unpack_from(record, 0)
+
+    if cd_offset >= tail_start:
+        return tail[cd_offset - tail_start:cd_offset - tail_start + cd_size]
+    return _fetch_range(url, cd_offset, cd_offset + cd_size)
+
+
+def _parse_central_directory(data):
+    """返回 {文件名: (压缩方式, 压缩后大小, 本地文件头偏移)}。"""
+    entries = {}
+    pos = 0
+    while pos + _CENTRAL_HEADER.size <= len(data) and data[pos:pos + 4] == b'PK\x01\x02':
+        fields = _CENTRAL_HEADER.unpack_from(data, pos)
+        compress_type, compress_size, file_size = fields[6], fields[10], fields[11]
+        name_len, extra_len, comment_len, header_offset = fields[12], fields[13], fields[14], fields[18]
+        name_start = pos + _CENTRAL_HEADER.size
+        name = data[name_start:name_start + name_len].decode('utf-8', 'replace')
+        extra = data[name_start + name_len:name_start + name_len + extra_len]
+
+        # ZIP64 扩展字段只包含取值为 0xFFFFFFFF 的字段
+        extra_pos = 0
+        while extra_pos + 4 <= len(extra):
+            tag, length = struct.unpack_from('<2H', extra, extra_pos)
+            if tag == 0x0001:
+                values = list(struct.unpack_from(f'<{length // 8}Q', extra, extra_pos + 4))
+                if file_size == 0xFFFFFFFF:
+                    file_size = values.pop(0)
+                if compress_size == 0xFFFFFFFF:
+                    compress_size = values.pop(0)
+                if header_offset == 0xFFFFFFFF:
+                    header_offset = values.pop(0)
+                break
+            extra_pos += 4 + length
+
+        entries[name] = (compress_type, compress_size, header_offset)
+        pos = name_start + name_len + extra_len + comment_len
+    return entries
+
+
+def _local_data_offset(header, header_offset):
+    if header[:4] != b'PK\x03\x04':
+        raise ProbeError('Corrupted zip local header\nzip 本地文件头损坏')
+    fields = _LOCAL_HEADER.unpack_from(header, 0)
+    name_len, extra_len = fields[10], fields[11]
+    return header_offset + _LOCAL_HEADER.size + name_len + extra_len
+
+
+def _read_metadata(url, entry):
+    compress_type, compress_size, header_offset = entry
+    data = _fetch_range(url, header_offset, header_offset + HEADER_READ_SIZE + compress_size)
+    start = _local_data_offset(data, header_offset) - header_offset
+    raw = data[start:start + compress_size]
+    if compress_type == 8:
+        raw = zlib.decompressobj(-15).decompress(raw)
+    elif compress_type != 0:
+        return None
+    return raw.decode('utf-8', 'replace')
+
+
+def _probe(url):
+    tail, tail_start, size, headers = _fetch_tail(url)
+    file_name = file_check.build_filename(url, headers.get('Content-Disposition'))
+    entries = _parse_central_directory(_read_central_directory(url, tail, tail_start))
+
+    entry = entries.get(PAYLOAD_NAME)
+    if entry is None:
+        raise ProbeError('The provided zip file does not a "payload.bin" ROM.\n提供的 zip 文件不是一个payload.bin格式的ROM。')
+    compress_type, compress_size, header_offset = entry
+    if compress_type != 0:
+        raise ProbeError('payload.bin is compressed inside the zip\nzip 中的 payload.bin 被压缩，无法直接读取')
+
+    header = _fetch_range(url, header_offset, min(header_offset + HEADER_READ_SIZE, size))
+    payload_offset = _local_data_offset(header, header_offset)
+    payload_header = header[payload_offset - header_offset:payload_offset - header_offset + 24]
+    if len(payload_header) < 24:
+        payload_header = _fetch_range(url, payload_offset, payload_offset + 24)
+
+    if payload_header[:4] != b"CrAU":
+        raise ProbeError('The provided URL does not point to a valid Chrome OS payload.\n提供的 URL 不指向一个有效的 Chrome OS payload。')
+    payload_version, manifest_size, signature_size = struct.unpack_from('>QQL', payload_header, 4)
+    if payload_version != 2:
+        raise ProbeError(f'Unsupported Chrome OS payload version: {payload_version}\n不支持的 Chrome OS payload 版本: {payload_version}')
+
+    manifest_start = payload_offset + 24
+    manifest_end = manifest_start + manifest_size
+    if manifest_end <= header_offset + len(header):
+        manifest_bytes = header[manifest_start - header_offset:manifest_end - header_offset]
+    else:
+        manifest_bytes = _fetch_range(url, manifest_start, manifest_end)
+
+    metadata = None
+    if METADATA_NAME in entries:
+        metadata = _read_metadata(url, entries[METADATA_NAME])
+
+    return ProbeRecord(
+        url=url,
+        size=size,
+        etag=headers.get('ETag'),
+        file_name=file_name,
+        payload_offset=payload_offset,
+        data_offset=manifest_end + signature_size,
+        payload_version=payload_version,
+        manifest_bytes=manifest_bytes,
+        metadata=metadata,
+        probed_at=time.time(),
+    )
+
+
+def _revalidate(record):
+    """TTL 过期后用 HEAD 请求确认远端文件未变化。"""
+    try:
+        response = session.head(record.url, allow_redirects=True, timeout=PROBE_TIMEOUT)
+    except requests.RequestException:
+        return False
+    if response.status_code != 200:
+        return False
+    etag = response.headers.get('ETag')
+    length = response.headers.get('Content-Length')
+    if record.etag and etag and etag != record.etag:
+        return False
+    if length is not None and int(length) != record.size:
+        return False
+    return True
+
+
+def probe_url(url):
+    """
+    获取 URL 的探测记录，优先使用缓存。
+
+    出错时输出 error 事件说明原因。
+
+    Args:
+        url: ROM zip 包的 URL。
+
+    Returns:
+        ProbeRecord 对象；URL 无效或不是 payload.bin 格式的 ROM 时返回 None。
+    """
+    if not re.match(r'https?://(?:[-\w.]|(?:%[\da-fA-F]{2}))+', url):
+        events.error(events.PROBE_FAILED, f'Invalid URL: {url}', f'无效的 URL: {url}')
+        return None
+
+    try:
+        record = _load(url)
+        if record is not None:
+            if time.time() - record.probed_at < PROBE_TTL:
+                return record
+            if _revalidate(record):
+                _touch(record)
+                return record
+
+        record = _probe(url)
+        _save(record)
+        return record
+    except ProbeError as e:
+        events.error(events.PROBE_FAILED, str(e))
+        return None
+    except Exception as e:
+        events.error(events.PROBE_FAILED, f"Error verifying URL: {e}", f"验证 URL 时出错: {e}")
+        return None
+
+
+def format_size(size):
+    """把字节数转换为便于阅读的大小。"""
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024 or unit == 'GB':
+            return f"{size:.1f}{unit}" if unit != 'B' else f"{size}B"
+        size /= 1024
+
+
+def partitions_info(record):
+    """从 manifest 生成 --list 输出的分区信息，附带压缩后大小的预测。"""
+    ratios = size_predictor.load_ratios()
+    block_size = record.manifest.block_size
+    info = []
+    for partition in record.manifest.partitions:
+        predicted_size = size_predictor.predict(partition, ratios, block_size)
+        info.append({
+            "partition_name": partition.partition_name,
+            "size_in_bytes": partition.new_partition_info.size,
+            "size_readable": format_size(partition.new_partition_info.size),
+            "predicted_size": predicted_size,
+            "oversize": size_predictor.is_oversize(predicted_size),
+        })
+    return info
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('Usage: url_probe.py <url>')
+        sys.exit(1)
+    probe = probe_url(sys.argv[1])
+    if probe is None:
+        sys.exit(1)
+    print(f"file_name={probe.file_name} size={probe.size} etag={probe.etag} data_offset={probe.data_offset}")
+    for info in partitions_info(probe):
+        print(f"{info['partition_name']}: {info['size_readable']}")
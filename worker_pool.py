@@ -0,0 +1,311 @@
+import os
+import io
+import sys
+import json
+import signal
+import threading
+import asyncio
+import logging
+import itertools
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+
+import events
+from metrics import registry
+from size_predictor import SPLIT_MAX_PARTS
+
+WORKER_POOL_SIZE = int(os.getenv('WORKER_POOL_SIZE', '3'))
+WORKER_SCRIPT = os.path.abspath(__file__)
+STREAM_LIMIT = 1024 * 1024  # 单行输出上限
+# 提取时每个上传分卷（约 50 MB 压缩数据）额外允许的下载、压缩和分卷时间（秒）
+DUMP_PART_TIMEOUT = int(os.getenv('DUMP_PART_TIMEOUT', '60'))
+# 各命令的执行超时（秒），不包含等待空闲工作进程的时间。提取的默认超时按最大分卷数放宽，
+# 默认 60 + 60 * 8 = 540 秒，足够产出 SPLIT_MAX_PARTS 卷的大分区；DUMP_TIMEOUT 可直接覆盖
+JOB_TIMEOUTS = {
+    '--dump': int(os.getenv('DUMP_TIMEOUT', str(60 + DUMP_PART_TIMEOUT * SPLIT_MAX_PARTS))),
+    '--list': int(os.getenv('LIST_TIMEOUT', '60')),
+    '--metadata': int(os.getenv('METADATA_TIMEOUT', '60')),
+}
+# 补充工作进程失败后的重试间隔（秒），每次失败翻倍，直到上限
+RESPAWN_BACKOFF_MIN = 1
+RESPAWN_BACKOFF_MAX = 60
+
+_job_ids = itertools.count(1)
+
+JOB_TIMEOUTS_TOTAL = registry.counter('dumper_job_timeouts_total', 'Jobs killed for exceeding their timeout', ['command'])
+WORKER_CRASHES_TOTAL = registry.counter('dumper_worker_crashes_total', 'Worker processes that died while running a job')
+
+
+class Job:
+    """提交到工作进程池的一次任务。
+
+    stdout/stderr 是 asyncio.StreamReader，用法与 asyncio 子进程相同，
+    任务结束后两者都会收到 EOF。
+    """
+
+    def __init__(self, command, args):
+        self.id = next(_job_ids)
+        self.command = command
+        self.args = args
+        self.stdout = asyncio.StreamReader(limit=STREAM_LIMIT)
+        self.stderr = asyncio.StreamReader(limit=STREAM_LIMIT)
+        self.returncode = None
+        self._done = asyncio.get_running_loop().create_future()
+
+    def feed(self, stream, text):
+        target = self.stdout if stream == 'stdout' else self.stderr
+        target.feed_data(f"{text}\n".encode())
+
+    def finish(self, returncode):
+        self.returncode = returncode
+        self.stdout.feed_eof()
+        self.stderr.feed_eof()
+        if not self._done.done():
+            self._done.set_result(returncode)
+
+    async def wait(self):
+        return await asyncio.shield(self._done)
+
+    def add_done_callback(self, callback):
+        """任务结束（包括超时和工作进程崩溃）后调用 callback()。"""
+        self._done.add_done_callback(lambda _: callback())
+
+
+class WorkerPool:
+    """常驻的 file_processor 工作进程池。
+
+    工作进程在启动时预先导入 file_processor，之后通过 stdin 接收 JSON 任务，
+    通过 stdout 以 JSON 行回传输出，省去每次任务的解释器启动和模块导入。
+    超时或崩溃的工作进程会被终止并在后台按退避间隔补充；池中已没有工作进程且补充失败时，
+    排队中的任务直接以 WORKER_CRASHED 结束，而不是无限等待。
+    """
+
+    def __init__(self, size=WORKER_POOL_SIZE):
+        self.size = size
+        self._idle = asyncio.Queue()
+        self._workers = set()
+        self._closing = False
+        self._respawn_failing = False
+        self._tasks = set()  # 事件循环只保留任务的弱引用
+        self._respawns = set()
+        self._waiting = set()  # 正在等待空闲工作进程的 _run 任务
+
+    async def start(self):
+        await asyncio.gather(*(self._spawn() for _ in range(self.size)))
+        logging.info(f"Worker pool started with {self.size} workers")
+
+    async def _spawn(self):
+        env = os.environ.copy()
+        env["PYTHONUNBUFFERED"] = "1"
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, WORKER_SCRIPT,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            env=env,
+            limit=STREAM_LIMIT,
+            start_new_session=True,  # 独立进程组，终止时连同 payload_dumper 子进程一起结束
+        )
+        ready = await process.stdout.readline()
+        if not ready:
+            raise RuntimeError(f"Worker {process.pid} exited during startup")
+        self._workers.add(process)
+        self._idle.put_nowait(process)
+        return process
+
+    async def _replace(self, process):
+        self._workers.discard(process)
+        if process.returncode is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            await process.wait()
+        if not self._closing:
+            self._track(asyncio.create_task(self._respawn()), self._respawns)
+
+    async def _respawn(self):
+        delay = RESPAWN_BACKOFF_MIN
+        while not self._closing:
+            try:
+                await self._spawn()
+                self._respawn_failing = False
+                return
+            except Exception as e:
+                logging.error(f"Failed to respawn worker, retrying in {delay} seconds: {e}")
+                self._respawn_failing = True
+                if not self._workers:
+                    self._cancel_waiting()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RESPAWN_BACKOFF_MAX)
+
+    def _track(self, task, tasks=None):
+        tasks = self._tasks if tasks is None else tasks
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return task
+
+    def _cancel_waiting(self):
+        for task in list(self._waiting):
+            task.cancel()
+
+    @property
+    def _unavailable(self):
+        """池已关闭，或已没有工作进程且补充失败。"""
+        return self._closing or (self._respawn_failing and not self._workers)
+
+    @property
+    def busy(self):
+        """正在执行任务的工作进程数。"""
+        return len(self._workers) - self._idle.qsize()
+
+    def submit(self, command, args, timeout=None):
+        """提交一个任务并立即返回 Job，任务会在有空闲工作进程时开始执行。"""
+        if timeout is None:
+            timeout = JOB_TIMEOUTS.get(command)
+        job = Job(command, args)
+        self._track(asyncio.create_task(self._run(job, timeout)))
+        return job
+
+    async def _acquire(self):
+        """等待空闲工作进程；池不可用时返回 None。"""
+        if self._unavailable:
+            return None
+        task = asyncio.current_task()
+        self._waiting.add(task)
+        try:
+            return await self._idle.get()
+        except asyncio.CancelledError:
+            if self._unavailable:
+                return None
+            raise
+        finally:
+            self._waiting.discard(task)
+
+    async def _run(self, job, timeout):
+        process = await self._acquire()
+        if process is None:
+            logging.error(f"Job {job.id} {job.command} failed: no worker process available")
+            job.feed('stdout', events.encode(
+                events.ERROR, code=events.WORKER_CRASHED, message="No worker process available, please retry\n没有可用的工作进程，请重试",
+            ))
+            job.finish(1)
+            return
+        returncode = 1
+        try:
+            message = json.dumps({"id": job.id, "command": job.command, "args": job.args})
+            process.stdin.write(f"{message}\n".encode())
+            await process.stdin.drain()
+            returncode = await asyncio.wait_for(self._pump(process, job), timeout)
+            self._idle.put_nowait(process)
+        except asyncio.TimeoutError:
+            logging.error(f"Job {job.id} {job.command} timed out after {timeout} seconds")
+            JOB_TIMEOUTS_TOTAL.inc(command=job.command)
+            job.feed('stdout', events.encode(
+                events.ERROR, code=events.TIMEOUT, message="Running timeout, please retry\n任务超时，请重试",
+            ))
+            await self._replace(process)
+        except Exception as e:
+            logging.error(f"Worker {process.pid} failed while running job {job.id}: {e}")
+            WORKER_CRASHES_TOTAL.inc()
+            job.feed('stdout', events.encode(
+                events.ERROR, code=events.WORKER_CRASHED, message="Worker process crashed, please retry\n工作进程崩溃，请重试",
+            ))
+            await self._replace(process)
+        finally:
+            job.finish(returncode)
+
+    async def _pump(self, process, job):
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                raise RuntimeError(f"worker exited with code {process.returncode}")
+            message = json.loads(line)
+            if message.get("id") != job.id:
+                continue
+            if message["type"] == "exit":
+                return message["code"]
+            job.feed(message["type"], message["data"])
+
+    async def close(self):
+        self._closing = True
+        self._cancel_waiting()
+        for task in list(self._respawns):
+            task.cancel()
+        for process in list(self._workers):
+            if process.returncode is None:
+                process.stdin.close()
+        for process in list(self._workers):
+            try:
+                await asyncio.wait_for(process.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                process.kill()
+        self._workers.clear()
+
+
+worker_pool = WorkerPool()
+
+
+# --- 工作进程 ---
+
+class _LineForwarder(io.TextIOBase):
+    """把 print 的输出按行转换为带任务 ID 的 JSON 消息。"""
+
+    def __init__(self, emit, job_id, stream):
+        self._emit = emit
+        self._job_id = job_id
+        self._stream = stream
+        self._buffer = ""
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self._buffer += text
+        while "\n" in self._buffer:
+            line, self._buffer = self._buffer.split("\n", 1)
+            self._emit({"id": self._job_id, "type": self._stream, "data": line})
+        return len(text)
+
+    def close_pending(self):
+        if self._buffer:
+            self._emit({"id": self._job_id, "type": self._stream, "data": self._buffer})
+            self._buffer = ""
+
+
+def worker_main():
+    import artifact_cache
+    import file_processor
+
+    # 被终止的工作进程来不及清理自己的临时文件和临时目录
+    try:
+        artifact_cache.remove_orphans()
+    except OSError as e:
+        print(f"Failed to remove orphaned temporary files: {e}", file=sys.stderr)
+
+    real_stdout = sys.stdout
+    lock = threading.Lock()  # 提取线程上报进度时与主线程同时输出
+
+    def emit(message):
+        with lock:
+            real_stdout.write(json.dumps(message) + "\n")
+            real_stdout.flush()
+
+    emit({"type": "ready", "pid": os.getpid()})
+    for line in sys.stdin:
+        job = json.loads(line)
+        stdout = _LineForwarder(emit, job["id"], "stdout")
+        stderr = _LineForwarder(emit, job["id"], "stderr")
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            try:
+                # bot 可以用 file_id 发送本地已淘汰的产物
+                code = file_processor.run([job["command"], *job["args"]], remote_ok=True)
+            except Exception:
+                traceback.print_exc()
+                code = 1
+        stdout.close_pending()
+        stderr.close_pending()
+        emit({"id": job["id"], "type": "exit", "code": code or 0})
+
+
+if __name__ == '__main__':
+    worker_main()